@@ -0,0 +1,199 @@
+"""Rà soát hàng loạt hồ sơ khai thuế không cần giao diện Streamlit.
+
+Mỗi thư mục con của thư mục hồ sơ là một người nộp thuế (tên thư mục = MST), gồm các tờ khai .xml,
+bảng kê hóa đơn (.xlsx/.csv) và thuyết minh BCTC (.docx). Kết quả của từng người nộp thuế được ghi vào
+KET_QUA_DIR/<MST>/, bảng tổng hợp toàn bộ lô ghi vào KET_QUA_DIR/tong_hop.csv và bảng xếp hạng rủi ro
+của cả danh mục (ma trận người nộp thuế x chỉ tiêu) ghi vào KET_QUA_DIR/sang_loc_rui_ro.csv. Các tỷ số tài chính
+(biên lãi gộp, giá vốn/doanh thu, tồn kho/doanh thu, lãi vay/tiền) được xếp hạng trong nhóm quy mô doanh thu;
+người nộp thuế nằm ở đuôi rủi ro của nhóm được đánh dấu trong KET_QUA_DIR/so_sanh_nhom.csv. Luồng hóa đơn giữa
+các người nộp thuế trong lô được đối chiếu chéo: nhóm mua bán vòng tròn ghi vào KET_QUA_DIR/doi_tac_vong_tron.csv,
+luồng bên bán và bên mua kê khai lệch nhau ghi vào KET_QUA_DIR/doi_tac_khong_khop.csv.
+
+    python batch_audit.py HO_SO_DIR KET_QUA_DIR --standard TT200 --workers 8
+"""
+import argparse
+import logging
+import os
+import re
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import streamlit_app as app
+
+logger = logging.getLogger("batch_audit")
+
+ACCOUNTING_STANDARDS = {
+    'none': "Chưa chọn",
+    'TT133': "Thông tư 133",
+    'TT200': "Thông tư 200",
+}
+INVOICE_EXTENSIONS = ('.xlsx', '.csv')
+NOTES_EXTENSIONS = ('.docx', '.pdf', '.xls', '.doc')
+
+
+def _normalize_name(file_name):
+    text = unicodedata.normalize('NFD', file_name.lower()).replace('đ', 'd')
+    text = ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn')
+    return re.sub(r'[^a-z0-9]', '', text)
+
+
+def classify_dossier_files(dossier_dir):
+    # Phân loại tệp trong hồ sơ theo tên tệp: bảng kê mua vào / bán ra (tổng hợp, chi tiết), thuyết minh
+    dossier = {'xml_files': [], 'output_invoice_file': None, 'output_invoice_type': "Tổng hợp",
+               'input_invoice_files': [], 'financial_notes_file': None}
+    for file_name in sorted(os.listdir(dossier_dir)):
+        path = os.path.join(dossier_dir, file_name)
+        if not os.path.isfile(path):
+            continue
+        lower_name = file_name.lower()
+        normalized = _normalize_name(file_name)
+        if lower_name.endswith('.xml'):
+            dossier['xml_files'].append(path)
+        elif lower_name.endswith(INVOICE_EXTENSIONS):
+            if any(word in normalized for word in ('muavao', 'dauvao', 'input')):
+                dossier['input_invoice_files'].append(path)
+            elif dossier['output_invoice_file'] is None:
+                dossier['output_invoice_file'] = path
+                if any(word in normalized for word in ('chitiet', 'detail')):
+                    dossier['output_invoice_type'] = "Chi tiết"
+        elif lower_name.endswith(NOTES_EXTENSIONS) and dossier['financial_notes_file'] is None:
+            dossier['financial_notes_file'] = path
+    return dossier
+
+
+def write_frames_to_excel(dfs_dict, path):
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
+        sheet_written = False
+        for sheet_name, df in dfs_dict.items():
+            if df is not None and not df.empty:
+                df.to_excel(writer, index=False, sheet_name=sheet_name)
+                sheet_written = True
+        if not sheet_written:
+            pd.DataFrame({"Thông báo": ["Không có dữ liệu hợp lệ để kết xuất."]}) \
+                .to_excel(writer, index=False, sheet_name="Luu_y")
+
+
+def audit_taxpayer(dossier_dir, output_root, accounting_standard):
+    # Chạy toàn bộ quy trình cho một người nộp thuế; chạy trong tiến trình con của lô
+    mst = os.path.basename(os.path.normpath(dossier_dir))
+    started = time.perf_counter()
+    messages = []
+
+    def log(level, message):
+        messages.append((level, str(message)))
+
+    summary = {'mst': mst, 'so_to_khai': 0, 'so_canh_bao': 0, 'so_loi': 0, 'thoi_gian_s': 0.0, 'loi': '',
+               'chi_tieu': None, 'luong_hd': None, 'co_hd_ra': False, 'co_hd_vao': False}
+    try:
+        dossier = classify_dossier_files(dossier_dir)
+        if dossier['output_invoice_file']:
+            if dossier['output_invoice_type'] == "Chi tiết":
+                output_invoice_data = app.process_detailed_invoice_data(dossier['output_invoice_file'], log=log)
+            else:
+                output_invoice_data = app.process_summary_invoice_data(dossier['output_invoice_file'], log=log)
+        else:
+            output_invoice_data = None
+        input_invoice_data = app.process_input_invoice_data(dossier['input_invoice_files'], log=log, max_workers=1)
+        notes_content = app.process_financial_notes(dossier['financial_notes_file'], log=log)
+
+        # Song song theo người nộp thuế nên mỗi tiến trình con đọc bảng kê và XML tuần tự
+        results = app.run_analysis_pipeline(dossier['xml_files'], accounting_standard, output_invoice_data,
+                                            input_invoice_data, notes_content, parse_workers=1, log=log)
+
+        output_dir = os.path.join(output_root, mst)
+        os.makedirs(output_dir, exist_ok=True)
+        write_frames_to_excel(app.build_export_frames(results, output_invoice_data, input_invoice_data),
+                              os.path.join(output_dir, "ket_qua.xlsx"))
+        pd.DataFrame(results['all_checks']).to_csv(os.path.join(output_dir, "rui_ro.csv"), index=False,
+                                                   encoding='utf-8-sig')
+        summary['so_to_khai'] = len(results['declarations'])
+        summary['so_canh_bao'] = sum(1 for r in results['all_checks'] if r['Trạng thái'] == 'Cảnh báo')
+        # Dòng chỉ tiêu của người nộp thuế cho ma trận sàng lọc danh mục (chỉ gửi số liệu về tiến trình chính)
+        indicator_row = app.build_indicator_matrix({mst: {'declarations': results['declarations'],
+                                                          'output_invoice_data': output_invoice_data,
+                                                          'input_invoice_data': input_invoice_data}})
+        summary['chi_tieu'] = indicator_row.iloc[0].to_dict()
+        # Luồng hóa đơn đã cộng theo (người bán, người mua, tháng) để đối chiếu chéo giữa các hồ sơ
+        summary['luong_hd'] = app.counterparty_flows(mst, output_invoice_data, input_invoice_data)
+        summary['co_hd_ra'], summary['co_hd_vao'] = bool(output_invoice_data), bool(input_invoice_data)
+    except Exception as e:
+        summary['loi'] = str(e)
+        messages.append(('error', f"Lỗi khi rà soát hồ sơ {mst}: {e}"))
+
+    summary['so_loi'] = sum(1 for level, _ in messages if level == 'error')
+    summary['thoi_gian_s'] = round(time.perf_counter() - started, 3)
+    output_dir = os.path.join(output_root, mst)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "nhat_ky.txt"), 'w', encoding='utf-8') as f:
+        for level, message in messages:
+            f.write(f"[{level.upper()}] {message}\n")
+    return summary
+
+
+def run_batch(dossier_root, output_root, accounting_standard, workers=None):
+    dossiers = sorted(os.path.join(dossier_root, name) for name in os.listdir(dossier_root)
+                      if os.path.isdir(os.path.join(dossier_root, name)))
+    os.makedirs(output_root, exist_ok=True)
+    logger.info("Rà soát %d hồ sơ với %s tiến trình", len(dossiers), workers or os.cpu_count())
+
+    summaries = []
+    if workers == 1:
+        outcomes = (audit_taxpayer(d, output_root, accounting_standard) for d in dossiers)
+        for summary in outcomes:
+            logger.info("%s: %d cảnh báo (%.2fs)", summary['mst'], summary['so_canh_bao'], summary['thoi_gian_s'])
+            summaries.append(summary)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            outcomes = executor.map(audit_taxpayer, dossiers, [output_root] * len(dossiers),
+                                    [accounting_standard] * len(dossiers))
+            for summary in outcomes:
+                logger.info("%s: %d cảnh báo (%.2fs)", summary['mst'], summary['so_canh_bao'],
+                            summary['thoi_gian_s'])
+                summaries.append(summary)
+
+    summary_df = pd.DataFrame(summaries, columns=['mst', 'so_to_khai', 'so_canh_bao', 'so_loi', 'thoi_gian_s', 'loi'])
+    summary_df.to_csv(os.path.join(output_root, "tong_hop.csv"), index=False, encoding='utf-8-sig')
+
+    rows = {s['mst']: s['chi_tieu'] for s in summaries if s['chi_tieu'] is not None}
+    if rows:
+        matrix = pd.DataFrame.from_dict(rows, orient='index')
+        matrix.index.name = 'mst'
+        screening = app.screen_portfolio(matrix, accounting_standard)
+        screening.to_csv(os.path.join(output_root, "sang_loc_rui_ro.csv"), encoding='utf-8-sig')
+        peers, _ = app.benchmark_peers(matrix)
+        peers.to_csv(os.path.join(output_root, "so_sanh_nhom.csv"), encoding='utf-8-sig')
+
+    flows = [s['luong_hd'] for s in summaries if s['luong_hd'] is not None]
+    if flows:
+        index = app.CounterpartyIndex(pd.concat(flows, ignore_index=True),
+                                      sellers=[s['mst'] for s in summaries if s['co_hd_ra']],
+                                      buyers=[s['mst'] for s in summaries if s['co_hd_vao']])
+        cycles = index.cycles()
+        cycles.to_csv(os.path.join(output_root, "doi_tac_vong_tron.csv"), index=False, encoding='utf-8-sig')
+        index.unmatched().to_csv(os.path.join(output_root, "doi_tac_khong_khop.csv"), index=False,
+                                 encoding='utf-8-sig')
+        if not cycles.empty:
+            logger.warning("Phát hiện %d nhóm người nộp thuế mua bán vòng tròn", len(cycles))
+    return summary_df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rà soát hàng loạt hồ sơ khai thuế (không cần Streamlit).")
+    parser.add_argument("dossier_dir", help="Thư mục chứa các thư mục hồ sơ, mỗi thư mục con là một MST")
+    parser.add_argument("output_dir", help="Thư mục ghi kết quả")
+    parser.add_argument("--standard", choices=sorted(ACCOUNTING_STANDARDS), default='none',
+                        help="Chế độ kế toán áp dụng cho BCTC")
+    parser.add_argument("--workers", type=int, default=None, help="Số tiến trình song song (mặc định: số lõi CPU)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    summary_df = run_batch(args.dossier_dir, args.output_dir, ACCOUNTING_STANDARDS[args.standard], args.workers)
+    logger.info("Hoàn tất %d hồ sơ, %d hồ sơ có lỗi", len(summary_df), int((summary_df['loi'] != '').sum()))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
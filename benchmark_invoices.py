@@ -0,0 +1,76 @@
+"""Đo tốc độ chuẩn hóa bảng kê hóa đơn: cách cũ (DataFrame.apply theo từng dòng) và cách vector hóa hiện tại.
+
+Sinh ngẫu nhiên một bảng kê tổng hợp N dòng (10% ngoại tệ, đủ các trạng thái hóa đơn), chạy cả hai cách,
+kiểm tra tổng tiền trùng khớp và in thời gian.
+
+    python benchmark_invoices.py --rows 500000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import streamlit_app as app
+
+MONEY_COLS = ['TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan']
+STATUSES = app.VALID_INVOICE_STATUSES + ['Hóa đơn đã bị thay thế', 'Hóa đơn đã bị xóa bỏ/hủy bỏ']
+
+
+def make_summary_invoices(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    pre_tax = rng.integers(1, 10 ** 8, rows).astype(float)
+    currency = rng.choice(['VND', 'USD'], rows, p=[0.9, 0.1])
+    return pd.DataFrame({
+        'TongTienChuaThue': pre_tax.astype(str),
+        'TongTienThue': pre_tax * 0.1,
+        'TongTienChietKhau': 0,
+        'TongTienThanhToan': pre_tax * 1.1,
+        'DonViTienTe': currency,
+        'TyGia': np.where(currency == 'USD', 25000, 1),
+        'TrangThaiHoaDon': rng.choice(STATUSES, rows),
+    })
+
+
+def normalize_rowwise(df):
+    # Cách xử lý trước đây của process_summary_invoice_data
+    for col in MONEY_COLS + ['TyGia']:
+        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    invoices = df[df['TrangThaiHoaDon'].isin(app.VALID_INVOICE_STATUSES)].copy()
+    for col in MONEY_COLS:
+        invoices.loc[:, col] = invoices.apply(
+            lambda row: row[col] * row['TyGia'] if row['DonViTienTe'] != 'VND' else row[col], axis=1)
+    return app.invoice_totals(invoices, *MONEY_COLS)
+
+
+def normalize_vectorized(df):
+    invoices = app.normalize_invoices(df, MONEY_COLS + ['TyGia'], MONEY_COLS)
+    return app.invoice_totals(invoices, *MONEY_COLS)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="So sánh tốc độ chuẩn hóa bảng kê hóa đơn.")
+    parser.add_argument("--rows", type=int, default=100000, help="Số dòng hóa đơn sinh ngẫu nhiên")
+    parser.add_argument("--skip-rowwise", action="store_true", help="Chỉ đo cách vector hóa")
+    args = parser.parse_args(argv)
+
+    df = make_summary_invoices(args.rows)
+    started = time.perf_counter()
+    vectorized = normalize_vectorized(df.copy())
+    vectorized_s = time.perf_counter() - started
+    print(f"Vector hóa: {vectorized_s:.3f}s cho {args.rows:,} dòng")
+
+    if not args.skip_rowwise:
+        started = time.perf_counter()
+        rowwise = normalize_rowwise(df.copy())
+        rowwise_s = time.perf_counter() - started
+        print(f"Theo dòng:  {rowwise_s:.3f}s (nhanh hơn {rowwise_s / vectorized_s:,.0f} lần)")
+        for key, value in rowwise.items():
+            if not np.isclose(value, vectorized[key], rtol=1e-12):
+                raise SystemExit(f"Tổng {key} không khớp: {value} != {vectorized[key]}")
+        print("Tổng tiền hai cách trùng khớp.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
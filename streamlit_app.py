@@ -1,9 +1,11 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import time
 import os
 import io
+import math
 import xml.etree.ElementTree as ET
 from docx import Document
 from selenium import webdriver
@@ -17,6 +19,32 @@ from selenium.common.exceptions import WebDriverException, TimeoutException, NoS
 import json
 import httpx
 import asyncio
+import hashlib
+import pickle
+import zlib
+import functools
+import csv
+import re
+import unicodedata
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # Không có lxml: dùng lại bộ đọc ElementTree
+    lxml_etree = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Không có pyarrow: không ghi được tệp Parquet, đọc bảng kê toàn bộ vào bộ nhớ
+    pa = pq = None
+
+try:
+    import openpyxl
+except ImportError:  # Không có openpyxl: đọc bảng kê Excel qua pandas
+    openpyxl = None
 
 # --- CẤU HÌNH CÁC CHỈ TIÊU XML ---
 XML_TAG_MAP = {
@@ -54,6 +82,288 @@ XML_TAG_MAP = {
         'pl_thue_da_khau_tru': 'ct22'
     }
 }
+# Bố cục các bảng chi tiết (mở rộng XML_TAG_MAP): mỗi dòng là (mã chỉ tiêu, tên chỉ tiêu, thẻ XML).
+# 'value_columns' ánh xạ tên cột số liệu -> tiền tố khóa đã bóc tách; 'ma_tk' giới hạn bố cục cho một phiên bản
+# tờ khai (danh sách mã tờ khai), None là bố cục mặc định. Thêm phiên bản mẫu biểu mới chỉ cần thêm dữ liệu ở đây.
+FORM_LAYOUTS = {
+    'gtgt_detailed': [{
+        'form': '01/GTGT', 'ma_tk': None,
+        'index_columns': [('Mã chỉ tiêu', 'code'), ('Chỉ tiêu', 'label')],
+        'value_columns': {'Số tiền': ''},
+        'rows': [
+            ('[21]', 'Thuế GTGT còn được khấu trừ kỳ trước chưa hết', 'ct21'),
+            ('[22]', 'Thuế GTGT còn được khấu trừ kỳ trước chuyển sang', 'ct22'),
+            ('[23]', 'Giá trị của hàng hóa, dịch vụ mua vào', 'ct23'),
+            ('[24]', 'Thuế GTGT của HHDV mua vào', 'ct24'),
+            ('[25]', 'Thuế GTGT của HHDV mua vào được khấu trừ kỳ này', 'ct25'),
+            ('[26]', 'HHDV bán ra không chịu thuế GTGT', 'ct26'),
+            ('[29]', 'HHDV bán ra chịu thuế suất 0%', 'ct29'),
+            ('[30]', 'Doanh thu HHDV bán ra chịu thuế suất 5%', 'ct30'),
+            ('[31]', 'Thuế GTGT HHDV bán ra chịu thuế suất 5%', 'ct31'),
+            ('[32]', 'Doanh thu HHDV bán ra chịu thuế suất 10%', 'ct32'),
+            ('[33]', 'Thuế GTGT HHDV bán ra chịu thuế suất 10%', 'ct33'),
+            ('[32a]', 'HHDV bán ra không phải kê khai, nộp thuế GTGT', 'ct32a'),
+            ('[34]', 'Tổng doanh thu HHDV bán ra', 'ct34'),
+            ('[35]', 'Tổng thuế GTGT của HHDV bán ra', 'ct35'),
+            ('[36]', 'Thuế GTGT phát sinh trong kỳ', 'ct36'),
+            ('[37]', 'Điều chỉnh giảm thuế GTGT phải nộp', 'ct37'),
+            ('[38]', 'Điều chỉnh tăng thuế GTGT phải nộp', 'ct38'),
+            ('[39a]', 'Thuế GTGT của dự án đầu tư được bù trừ', 'ct39a'),
+            ('[40a]', 'Thuế GTGT phải nộp của HĐKD', 'ct40a'),
+            ('[40b]', 'Thuế GTGT mua vào của dự án đầu tư cùng tỉnh', 'ct40b'),
+            ('[40]', 'Thuế GTGT còn phải nộp trong kỳ', 'ct40'),
+            ('[41]', 'Thuế GTGT chưa khấu trừ hết kỳ này', 'ct41'),
+            ('[42]', 'Thuế GTGT đề nghị hoàn', 'ct42'),
+            ('[43]', 'Thuế GTGT còn được khấu trừ chuyển kỳ sau', 'ct43'),
+        ],
+    }],
+    'tndn_main': [{
+        'form': '03/TNDN', 'ma_tk': None,
+        'index_columns': [('Mã chỉ tiêu', 'code'), ('Chỉ tiêu', 'label')],
+        'value_columns': {'Số tiền': ''},
+        'rows': [
+            ('A1', 'A1 - Tổng lợi nhuận kế toán trước thuế TNDN', 'ctA1'),
+            ('B1', 'B1 - Các khoản điều chỉnh tăng tổng lợi nhuận trước thuế', 'ctB1'),
+            ('B2', 'B2 - Các khoản chi không được trừ', 'ctB2'),
+            ('B3', 'B3 - Thuế TNDN đã nộp cho phần thu nhập nhận được ở nước ngoài', 'ctB3'),
+            ('B4', 'B4 - Điều chỉnh tăng doanh thu', 'ctB4'),
+            ('B7', 'B7 - Các khoản điều chỉnh làm tăng lợi nhuận trước thuế khác', 'ctB7'),
+            ('B8', 'B8 - Các khoản điều chỉnh giảm tổng lợi nhuận trước thuế', 'ctB8'),
+            ('B9', 'B9 - Giảm trừ các khoản doanh thu đã điều chỉnh tăng', 'ctB9'),
+            ('B10', 'B10 - Chi phí của phần doanh thu điều chỉnh giảm', 'ctB10'),
+            ('B11', 'B11 - Các khoản điều chỉnh làm giảm lợi nhuận trước thuế khác', 'ctB11'),
+            ('B12', 'B12 - Lợi nhuận từ hoạt động BĐS', 'ctB12'),
+            ('B13', 'B13 - Tổng Thu nhập chịu thuế (TNCT)', 'ctB13'),
+            ('B14', 'B14 - TNCT từ hoạt động sản xuất, kinh doanh', 'ctB14'),
+            ('C1', 'C1 - Thu nhập chịu thuế', 'ctC1'),
+            ('C2', 'C2 - Thu nhập chịu thuế từ HĐSXKD', 'ctC2'),
+            ('C3', 'C3 - Thu nhập được miễn thuế', 'ctC3'),
+            ('C4', 'C4 - Chuyển lỗ và bù trừ lãi, lỗ', 'ctC4'),
+            ('C6', 'C6 - Tổng thu nhập tính thuế (TNTT)', 'ctC6'),
+            ('C7', 'C7 - TNTT từ HĐSXKD', 'ctC7'),
+            ('C8', 'C8 - Thuế TNDN từ HĐSXKD theo thuế suất 20%', 'ctC8'),
+            ('C9', 'C9 - Thuế TNDN phải nộp từ HĐSXKD', 'ctC9'),
+            ('C10', 'C10 - Thuế TNDN của hoạt động BĐS phải nộp', 'ctC10'),
+            ('C11', 'C11 - Thuế TNDN đã nộp ở nước ngoài được trừ trong kỳ tính thuế', 'ctC11'),
+            ('C12', 'C12 - Thuế TNDN đã tạm nộp', 'ctC12'),
+            ('C13', 'C13 - Chênh lệch giữa số thuế TNDN phải nộp và đã tạm nộp', 'ctC13'),
+            ('C14', 'C14 - Thuế TNDN còn phải nộp', 'ctC14'),
+            ('C15', 'C15 - Thuế TNDN nộp thừa', 'ctC15'),
+            ('C16', 'C16 - Tổng số thuế TNDN bù trừ cho các nghĩa vụ khác', 'ctC16'),
+        ],
+    }],
+    'tndn_appendix_03_1a': [{
+        'form': '03/TNDN', 'ma_tk': None,
+        'index_columns': [('Mã chỉ tiêu', 'code'), ('Chỉ tiêu', 'label')],
+        'value_columns': {'Số tiền': ''},
+        'rows': [
+            ('[04]', 'Tổng doanh thu bán hàng hóa, dịch vụ', 'ct04'),
+            ('[05]', 'Doanh thu bán hàng hóa, dịch vụ xuất khẩu', 'ct05'),
+            ('[06]', 'Các khoản giảm trừ doanh thu', 'ct06'),
+            ('[08]', 'Doanh thu hoạt động tài chính', 'ct08'),
+            ('[09]', 'Chi phí tài chính', 'ct09'),
+            ('[11]', 'Chi phí sản xuất, kinh doanh hàng hóa, dịch vụ', 'ct11'),
+            ('[12]', 'Giá vốn hàng bán', 'ct12'),
+            ('[13]', 'Chi phí bán hàng', 'ct13'),
+            ('[14]', 'Chi phí quản lý doanh nghiệp', 'ct14'),
+            ('[15]', 'Lợi nhuận thuần từ hoạt động kinh doanh', 'ct15'),
+            ('[16]', 'Thu nhập khác', 'ct16'),
+            ('[17]', 'Chi phí khác', 'ct17'),
+            ('[18]', 'Lợi nhuận khác', 'ct18'),
+            ('[19]', 'Lợi nhuận từ HĐSXKD', 'ct19'),
+            ('[20]', 'Lợi nhuận từ hoạt động chuyển nhượng BĐS', 'ct20'),
+            ('[21]', 'Tổng lợi nhuận kế toán trước thuế TNDN', 'ct21'),
+            ('[22]', 'Trích lập quỹ KH&CN (nếu có)', 'ct22'),
+        ],
+    }],
+    'balance_sheet': [{
+        'form': 'BCTC', 'ma_tk': None,
+        'index_columns': [('Chỉ tiêu', 'label'), ('Mã số', 'code')],
+        'value_columns': {'Số cuối năm': 'scn_', 'Số đầu năm': 'sdn_'},
+        'rows': [
+            ('100', 'A - TÀI SẢN NGẮN HẠN', 'ct100'),
+            ('110', 'I. Tiền và các khoản tương đương tiền', 'ct110'),
+            ('120', 'II. Đầu tư tài chính ngắn hạn', 'ct120'),
+            ('130', 'III. Các khoản phải thu ngắn hạn', 'ct130'),
+            ('140', 'IV. Hàng tồn kho', 'ct140'),
+            ('150', 'V. Tài sản ngắn hạn khác', 'ct150'),
+            ('200', 'B - TÀI SẢN DÀI HẠN', 'ct200'),
+            ('210', 'I. Các khoản phải thu dài hạn', 'ct210'),
+            ('220', 'II. Tài sản cố định', 'ct220'),
+            ('230', 'III. Bất động sản đầu tư', 'ct230'),
+            ('240', 'IV. Tài sản dở dang dài hạn', 'ct240'),
+            ('250', 'V. Đầu tư tài chính dài hạn', 'ct250'),
+            ('260', 'VI. Tài sản dài hạn khác', 'ct260'),
+            ('270', 'TỔNG CỘNG TÀI SẢN', 'ct270'),
+            ('300', 'C - NỢ PHẢI TRẢ', 'ct300'),
+            ('310', 'I. Nợ ngắn hạn', 'ct310'),
+            ('330', 'II. Nợ dài hạn', 'ct330'),
+            ('400', 'D - VỐN CHỦ SỞ HỮU', 'ct400'),
+            ('410', 'I. Vốn chủ sở hữu', 'ct410'),
+            ('440', 'TỔNG CỘNG NGUỒN VỐN', 'ct440'),
+        ],
+    }],
+    'income_statement': [{
+        'form': 'BCTC', 'ma_tk': None,
+        'index_columns': [('Chỉ tiêu', 'label'), ('Mã số', 'code')],
+        'value_columns': {'Năm nay': 'kqkd_nn_', 'Năm trước': 'kqkd_nt_'},
+        'rows': [
+            ('01', '1. Doanh thu bán hàng và cung cấp dịch vụ', 'ct01'),
+            ('02', '2. Các khoản giảm trừ doanh thu', 'ct02'),
+            ('10', '3. Doanh thu thuần về bán hàng và cung cấp dịch vụ', 'ct10'),
+            ('11', '4. Giá vốn hàng bán', 'ct11'),
+            ('20', '5. Lợi nhuận gộp về bán hàng và cung cấp dịch vụ', 'ct20'),
+            ('21', '6. Doanh thu hoạt động tài chính', 'ct21'),
+            ('22', '7. Chi phí tài chính', 'ct22'),
+            ('23', 'Trong đó: Chi phí lãi vay', 'ct23'),
+            ('25', '8. Chi phí bán hàng', 'ct25'),
+            ('26', '9. Chi phí quản lý doanh nghiệp', 'ct26'),
+            ('30', '10. Lợi nhuận thuần từ hoạt động kinh doanh', 'ct30'),
+            ('31', '11. Thu nhập khác', 'ct31'),
+            ('32', '12. Chi phí khác', 'ct32'),
+            ('40', '13. Lợi nhuận khác', 'ct40'),
+            ('50', '14. Tổng lợi nhuận kế toán trước thuế', 'ct50'),
+            ('51', '15. Chi phí thuế TNDN hiện hành', 'ct51'),
+            ('52', '16. Chi phí thuế TNDN hoãn lại', 'ct52'),
+            ('60', '17. Lợi nhuận sau thuế thu nhập doanh nghiệp', 'ct60'),
+        ],
+    }],
+}
+
+# Các thẻ định danh chỉ lấy giá trị xuất hiện đầu tiên
+SINGLE_VALUE_TAGS = ['maTKhai', 'kyKKhai', 'mst', 'tenNNT', 'dchiNNT', 'tenHuyenNNT', 'tenTinhNNT', 'loaiTKhai',
+                     'soLan']
+# Bộ đọc XML mặc định: 'lxml' (đọc luồng iterparse) hoặc 'etree' (ElementTree, dự phòng)
+XML_PARSER_BACKEND = 'lxml' if lxml_etree is not None else 'etree'
+# Số tiến trình bóc tách XML song song (None = theo số lõi CPU)
+PARSE_MAX_WORKERS = None
+# Phiên bản bộ bóc tách: tăng lên mỗi khi đổi cấu trúc dữ liệu trả về để bộ đệm cũ tự mất hiệu lực
+PARSER_VERSION = '2'
+
+
+def _default_cache_root():
+    # Thư mục bộ đệm theo người dùng, không phụ thuộc thư mục làm việc của tiến trình (bộ đệm XML được unpickle
+    # nên không đọc từ thư mục dùng chung): HSKT_CACHE_DIR nếu đặt, ngược lại %LOCALAPPDATA% (Windows)
+    # hoặc $XDG_CACHE_HOME, mặc định ~/.cache
+    root = os.environ.get('HSKT_CACHE_DIR')
+    if root:
+        return os.path.abspath(os.path.expanduser(root))
+    base = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else None
+    base = base or os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cache_hskt')
+
+
+CACHE_ROOT = _default_cache_root()
+PARSE_CACHE_DIR = os.path.join(CACHE_ROOT, "xml")
+PARSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+XML_PARSE_ERRORS = (ET.ParseError, FileNotFoundError) + (
+    (lxml_etree.XMLSyntaxError,) if lxml_etree is not None else ())
+# Lỗi của riêng một tệp khi bóc tách trong tiến trình con (không đọc được, sai mã hóa, nội dung hỏng):
+# ghi nhận cho tệp đó thay vì để lỗi lan ra và bị hiểu nhầm là lỗi của process pool
+XML_FILE_ERRORS = XML_PARSE_ERRORS + (OSError, UnicodeDecodeError, ValueError)
+
+# Các loại tờ khai GTGT được tổng hợp theo kỳ
+GTGT_FORMS = ('01/GTGT', '02/GTGT')
+# Trạng thái hóa đơn được cộng vào tổng hợp bảng kê
+VALID_INVOICE_STATUSES = ['Hóa đơn mới', 'Hóa đơn thay thế', 'Hóa đơn điều chỉnh', 'Hóa đơn đã bị điều chỉnh']
+# Chuỗi hóa đơn (bảng kê chi tiết): hóa đơn thay thế/điều chỉnh trỏ về hóa đơn gốc qua cột HD_LienQuan
+REPLACEMENT_STATUS = 'Hóa đơn thay thế'
+ADJUSTMENT_STATUS = 'Hóa đơn điều chỉnh'
+REPLACED_STATUS = 'Hóa đơn đã bị thay thế'
+CANCELLED_STATUS = 'Hóa đơn đã bị xóa bỏ/hủy bỏ'
+# Ký hiệu hóa đơn theo TT78 (vd. 1C24TAA); so khớp theo 6 ký tự cuối vì bảng kê có nơi bỏ ký hiệu mẫu số
+INVOICE_SERIES_PATTERN = r'\d?[A-Z]\d{2}[A-Z]{3}'
+# Mẫu bảng kê hóa đơn, nhận diện bằng dòng tiêu đề trong INVOICE_SNIFF_ROWS dòng đầu tệp.
+# 'columns': tên cột theo vị trí, None = cột không đọc (địa chỉ, CCCD, cột trống); tệp phải có ít nhất ngần ấy cột.
+# 'signature': vị trí cột -> các cụm từ; tiêu đề (bỏ dấu, viết liền, chữ thường) chứa một cụm là khớp.
+INVOICE_SNIFF_ROWS = 10
+INVOICE_TEMPLATES = {
+    'summary': {
+        'label': "bảng kê hóa đơn tổng hợp",
+        'columns': ['STT', 'KyHieuMauSo', 'KyHieuHoaDon', 'SoHoaDon', 'NgayLap', 'MSTNguoiBan', 'TenNguoiBan',
+                    'MSTNguoiMua', 'TenNguoiMua', None, 'MaSoThueToChucCungCap', 'MaSoThueToChucTruyenNhan',
+                    'TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienPhi', 'TongTienThanhToan',
+                    'DonViTienTe', 'TyGia', 'TrangThaiHoaDon', 'KetQuaKiemTra'],
+        'signature': {3: ('sohoadon',), 12: ('chuathue',), 17: ('tiente',), 19: ('trangthai',)},
+    },
+    'detailed': {
+        'label': "bảng kê hóa đơn chi tiết",
+        'columns': ['KyHieu', 'SoHoaDon', 'NgayLap', 'TenNguoiMua', 'MSTNguoiMua', 'TinhChat',
+                    'TenHangHoa', 'DonViTinh', 'SoLuong', 'DonGia', 'TienChietKhau', None,
+                    'ThanhTien', 'ThueSuat', 'DonViTienTe', 'TyGia', 'TrangThaiHoaDon',
+                    'HD_LienQuan', 'Ngay_HD_LienQuan', 'DonViCungCap'],
+        'signature': {1: ('sohoadon',), 6: ('hanghoa',), 8: ('soluong',), 12: ('thanhtien',), 13: ('thuesuat',)},
+    },
+    'input_data1': {
+        'label': "mẫu đầu vào loại 1 (data-1)",
+        'columns': ['STT', 'KyHieuMauSo', 'KyHieuHoaDon', 'SoHoaDon', 'NgayLap', 'MSTNguoiBan', 'TenNguoiBan', None,
+                    'MSTNguoiMua', 'TenNguoiMua', None, 'MaSothueCCGiaiPhap', 'MaSoThueTruyenNhan',
+                    'TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan',
+                    'TrangThaiHoaDon', 'KetQuaKiemTra', None, None],
+        'signature': {3: ('sohd', 'sohoadon'), 13: ('chuathue',), 17: ('trangthai',)},
+    },
+    'input_mtt1': {
+        'label': "mẫu đầu vào loại 2 (mtt1)",
+        'columns': ['STT', 'KyHieuMauSo', 'KyHieuHoaDon', 'SoHoaDon', 'NgayLap', 'MSTNguoiBan', 'TenNguoiBan', None,
+                    'MSTNguoiMua', 'TenNguoiMua', None, 'MaSothueCCGiaiPhap', 'MaSoThueTruyenNhan',
+                    'TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan',
+                    'TrangThaiHoaDon', 'KetQuaKiemTra'],
+        'signature': {3: ('sohd', 'sohoadon'), 13: ('chuathue',), 17: ('trangthai',)},
+    },
+}
+INPUT_INVOICE_TEMPLATES = ('input_data1', 'input_mtt1')
+# Cột đọc dưới dạng chuỗi (giữ số 0 đầu của MST, ký hiệu, số hóa đơn); cột còn lại để bộ đọc tự suy kiểu
+INVOICE_TEXT_COLUMNS = {
+    'KyHieuMauSo', 'KyHieuHoaDon', 'KyHieu', 'SoHoaDon', 'HD_LienQuan', 'MSTNguoiBan', 'TenNguoiBan', 'MSTNguoiMua',
+    'TenNguoiMua', 'MaSoThueToChucCungCap', 'MaSoThueToChucTruyenNhan', 'MaSothueCCGiaiPhap', 'MaSoThueTruyenNhan',
+    'TinhChat', 'TenHangHoa', 'DonViTinh', 'DonViTienTe', 'TrangThaiHoaDon', 'KetQuaKiemTra', 'DonViCungCap',
+}
+# Thu gọn kiểu dữ liệu bảng kê giữ trong session: cột chữ có tỉ lệ giá trị khác nhau không quá ngưỡng -> category,
+# cột mã hóa đơn -> chuỗi Arrow, cột tiền nguyên đồng -> int64
+INVOICE_COMPACT_DTYPES = True
+INVOICE_CATEGORY_MAX_RATIO = 0.5
+INVOICE_ID_COLUMNS = {'SoHoaDon', 'HD_LienQuan'}
+INVOICE_MONEY_COLUMNS = {
+    'TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienPhi', 'TongTienThanhToan',
+    'TienChietKhau', 'DonGia', 'ThanhTien', 'ThanhTien_TinhToan',
+}
+# Bộ đọc bảng kê Excel: 'openpyxl' (duyệt dòng read_only, chuyển thẳng từng cột thành mảng) hoặc 'pandas' (read_excel)
+INVOICE_SHEET_READER = 'openpyxl' if openpyxl is not None else 'pandas'
+# Số tiến trình đọc song song các tệp bảng kê đầu vào (None = theo số lõi CPU)
+INVOICE_READ_WORKERS = None
+# Đọc bảng kê CSV theo khối khi tệp lớn hơn ngưỡng: bộ nhớ chỉ giữ một khối, các dòng đã chuẩn hóa ghi ra Parquet
+INVOICE_STREAM_MIN_BYTES = 64 * 1024 * 1024
+INVOICE_STREAM_CHUNK_ROWS = 50000
+INVOICE_SPILL_DIR = os.path.join(CACHE_ROOT, "invoices")
+# Số dòng giữ lại để hiển thị/kết xuất khi đọc theo khối
+INVOICE_PREVIEW_ROWS = 5000
+# Bộ đệm Parquet cho bảng kê Excel đã đọc; tăng phiên bản khi đổi cách đặt tên cột/nhận diện mẫu
+INVOICE_CACHE_DIR = os.path.join(CACHE_ROOT, "xlsx")
+INVOICE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+INVOICE_CACHE_VERSION = '2'
+
+# Nguồn chỉ tiêu cho ma trận người nộp thuế x chỉ tiêu ('nguon:khoa'): tiền tố -> (các loại tờ khai, cách lấy)
+# 'latest' = kỳ gần nhất, 'sum' = cộng các kỳ (mỗi kỳ lấy loại tờ khai đầu tiên có trong danh sách).
+INDICATOR_SOURCES = {
+    'bctc': (('BCTC',), 'latest'),
+    'tndn': (('03/TNDN',), 'latest'),
+    'tncn_qtt': (('05/QTT-TNCN',), 'latest'),
+    'tncn_kk': (('05/KK-TNCN',), 'sum'),
+    'gtgt': (GTGT_FORMS, 'sum'),
+    'gtgt01': (('01/GTGT',), 'sum'),
+    'gtgt01_cuoi': (('01/GTGT',), 'latest'),
+}
+# Chỉ tiêu lấy từ kết quả xử lý bảng kê hóa đơn: nguồn -> (bảng kê, khóa bảng tổng hợp trong kết quả)
+INVOICE_INDICATOR_SOURCES = {
+    'hd_ra': ('output_invoice_data', 'valid_summary'),
+    'hd_vao': ('input_invoice_data', 'valid_summary'),
+    'hd_ra_bt': ('output_invoice_data', 'anomaly_summary'),
+    'hd_vao_bt': ('input_invoice_data', 'anomaly_summary'),
+}
+# Chỉ tiêu dẫn xuất = tổng các chỉ tiêu thành phần
+DERIVED_INDICATORS = {
+    'gtgt:dt': ['gtgt:ct26', 'gtgt:ct29', 'gtgt:ct30', 'gtgt:ct32'],
+}
 # Ánh xạ mã tờ khai sang loại để xử lý
 MA_TK_MAP = {
     '842': '01/GTGT', '844': '02/GTGT', '950': '03/TNDN', '892': '03/TNDN',
@@ -64,6 +374,18 @@ MA_TK_MAP = {
 }
 
 
+
+# --- NHẬT KÝ TIẾN TRÌNH ---
+# Các bước xử lý nhận hàm `log(level, message)` thay vì gọi st.* trực tiếp, để chạy được cả ngoài Streamlit.
+# level là một trong: 'write', 'info', 'success', 'warning', 'error'.
+def streamlit_log(level, message):
+    getattr(st, level)(message)
+
+
+def _file_name(uploaded_file):
+    # Tệp tải lên (UploadedFile) hoặc đường dẫn trên đĩa
+    return os.path.basename(getattr(uploaded_file, 'name', None) or os.fspath(uploaded_file))
+
 # --- MODULE 4: GIAO DIỆN NGƯỜI DÙNG (USER INTERFACE) ---
 def setup_ui():
     st.set_page_config(page_title="Ứng dụng Hỗ trợ Rà soát HSKT", layout="wide")
@@ -105,6 +427,10 @@ def setup_ui():
         ["Chưa chọn", "Thông tư 133", "Thông tư 200"],
         help="Chọn chế độ kế toán áp dụng cho Báo cáo tài chính để bật các quy tắc đối chiếu phù hợp."
     )
+    params["parse_workers"] = st.sidebar.number_input(
+        "Số tiến trình đọc XML song song:", min_value=0, max_value=64, value=0,
+        help="0 = tự động theo số lõi CPU."
+    )
 
     st.sidebar.subheader("Hóa đơn Đầu ra")
     params["output_invoice_type"] = st.sidebar.selectbox(
@@ -261,384 +587,2183 @@ class WebScraper:
         if hasattr(self, 'driver') and self.driver: self.driver.quit()
 
 
-def process_summary_invoice_data(uploaded_file):
-    if not uploaded_file:
-        return None
+# --- CHUẨN HÓA BẢNG KÊ HÓA ĐƠN (DÙNG CHUNG) ---
+def coerce_numeric(df, columns):
+    # Ép kiểu số cho các cột tiền/số lượng; giá trị không đọc được nhận 0
+    for col in columns:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    return df
+
+
+def filter_invoice_status(df, statuses=VALID_INVOICE_STATUSES):
+    if statuses is None or 'TrangThaiHoaDon' not in df.columns:
+        return df.copy()
+    return df[df['TrangThaiHoaDon'].isin(statuses)].copy()
+
+
+def convert_to_vnd(df, columns, currency_col='DonViTienTe', rate_col='TyGia'):
+    # Quy đổi ngoại tệ sang VND bằng mặt nạ NumPy: dòng có đơn vị tiền tệ khác 'VND' nhân với tỷ giá.
+    # Bảng kê không có cột tiền tệ/tỷ giá được coi là VND; ô tiền tệ trống (NaN, hoặc pd.NA trên cột kiểu 'string')
+    # được coi là ngoại tệ.
+    if currency_col not in df.columns or rate_col not in df.columns:
+        return df
+    foreign = df[currency_col].ne('VND').fillna(True).to_numpy(dtype=bool)
+    if not foreign.any():
+        return df
+    rates = pd.to_numeric(df[rate_col], errors='coerce').fillna(0).to_numpy(dtype=np.float64)[foreign]
+    for col in columns:
+        values = df[col].to_numpy(dtype=np.float64, copy=True)
+        values[foreign] *= rates
+        df[col] = values
+    return df
+
+
+def invoice_totals(df, pre_tax, tax, discount, payment=None):
+    totals = {
+        'total_pre_tax': df[pre_tax].sum(),
+        'total_tax': df[tax].sum(),
+        'total_discount': df[discount].sum(),
+    }
+    totals['total_payment'] = df[payment].sum() if payment else totals['total_pre_tax'] + totals['total_tax']
+    return totals
+
+
+def normalize_invoices(df, numeric_cols, money_cols, statuses=VALID_INVOICE_STATUSES):
+    # Ép kiểu số trên bảng gốc, trả về bản sao chỉ gồm hóa đơn hợp lệ đã quy đổi VND
+    coerce_numeric(df, numeric_cols)
+    return convert_to_vnd(filter_invoice_status(df, statuses), money_cols)
+
+
+def _compact_column(name, series):
+    if pd.api.types.is_float_dtype(series):
+        values = series.to_numpy()
+        if np.isfinite(values).all() and (np.abs(values) < 2 ** 53).all() and (values == np.round(values)).all():
+            series = series.astype(np.int64)
+        else:
+            return series
+    if pd.api.types.is_integer_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        # Chỉ thu về int32 (không xuống int8/int16) để phép nhân/cộng về sau không bị tràn số
+        if name in INVOICE_MONEY_COLUMNS or series.empty or series.min() < -2 ** 31 or series.max() >= 2 ** 31:
+            return series
+        return series.astype(np.int32)
+    if series.dtype != object:
+        return series
     try:
-        st.write("Đang xử lý file Bảng kê hóa đơn tổng hợp...")
-        if uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_file, skiprows=5)
+        if name in INVOICE_ID_COLUMNS and pa is not None:
+            return series.astype('string[pyarrow]')
+        if series.nunique() <= len(series) * INVOICE_CATEGORY_MAX_RATIO:
+            return series.astype('category')
+        return series.astype('string[pyarrow]') if pa is not None else series
+    except (TypeError, ValueError):
+        return series  # Cột lẫn kiểu không đổi được: giữ nguyên
+
+
+def frame_memory(df, sample=10000):
+    # Số byte DataFrame chiếm; cột object được đo trên `sample` dòng đầu rồi nhân theo tỉ lệ
+    # (memory_usage(deep=True) đo từng chuỗi nên chậm ngang thời gian đọc tệp)
+    total = 0
+    for col in df.columns:
+        series = df[col]
+        if series.dtype == object and len(series) > sample:
+            total += series.iloc[:sample].memory_usage(deep=True, index=False) * len(series) / sample
         else:
-            df = pd.read_excel(uploaded_file, skiprows=5)
+            total += series.memory_usage(deep=True, index=False)
+    return int(total)
+
+
+def compact_invoice_frame(df, label="", log=None):
+    # Bảng kê sau khi đã tính tổng: thu gọn kiểu dữ liệu trước khi giữ trong st.session_state
+    if not INVOICE_COMPACT_DTYPES or df is None or df.empty:
+        return df
+    before = frame_memory(df) if log is not None else 0
+    df = pd.DataFrame({col: _compact_column(col, df[col]) for col in df.columns}, index=df.index)
+    if log is not None:
+        after = frame_memory(df)
+        log('info', f"Bảng kê {label}: {before / 2 ** 20:,.1f} MB -> {after / 2 ** 20:,.1f} MB sau khi thu gọn kiểu dữ liệu.")
+    return df
 
-        df.columns = [
-            'STT', 'KyHieuMauSo', 'KyHieuHoaDon', 'SoHoaDon', 'NgayLap', 'MSTNguoiBan', 'TenNguoiBan',
-            'MSTNguoiMua', 'TenNguoiMua', 'DiaChiNguoiMua', 'MaSoThueToChucCungCap', 'MaSoThueToChucTruyenNhan',
-            'TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienPhi', 'TongTienThanhToan',
-            'DonViTienTe', 'TyGia', 'TrangThaiHoaDon', 'KetQuaKiemTra'
-        ]
 
-        numeric_cols = ['TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan', 'TyGia']
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+def _prepare_summary_invoices(df):
+    return coerce_numeric(df, ['TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan', 'TyGia'])
 
-        statuses_to_sum = [
-            'Hóa đơn mới',
-            'Hóa đơn thay thế',
-            'Hóa đơn điều chỉnh',
-            'Hóa đơn đã bị điều chỉnh'
-        ]
-
-        invoices_for_summing = df[df['TrangThaiHoaDon'].isin(statuses_to_sum)].copy()
-
-        for col in ['TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan']:
-            invoices_for_summing.loc[:, col] = invoices_for_summing.apply(
-                lambda row: row[col] * row['TyGia'] if row['DonViTienTe'] != 'VND' else row[col],
-                axis=1
-            )
-
-        total_pre_tax = invoices_for_summing['TongTienChuaThue'].sum()
-        total_tax = invoices_for_summing['TongTienThue'].sum()
-        total_discount = invoices_for_summing['TongTienChietKhau'].sum()
-        total_payment = invoices_for_summing['TongTienThanhToan'].sum()
-
-        summary = {
-            'total_pre_tax': total_pre_tax,
-            'total_tax': total_tax,
-            'total_discount': total_discount,
-            'total_payment': total_payment
-        }
 
-        st.success("Xử lý Bảng kê hóa đơn tổng hợp hoàn tất!")
+def _summary_invoice_amounts(df):
+    money_cols = ['TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan']
+    return convert_to_vnd(df[['NgayLap', 'TrangThaiHoaDon', 'DonViTienTe', 'TyGia'] + money_cols].copy(), money_cols)
+
+
+def _prepare_detailed_invoices(df):
+    coerce_numeric(df, ['SoLuong', 'DonGia', 'TienChietKhau', 'ThanhTien', 'ThueSuat', 'TyGia'])
+    df['NgayLap'] = pd.to_datetime(df['NgayLap'], errors='coerce')
+    df['ThanhTien_TinhToan'] = df['SoLuong'] * df['DonGia']
+    return df
+
+
+def _detailed_invoice_mismatches(df):
+    mismatched_invoices = df[abs(df['ThanhTien'] - df['ThanhTien_TinhToan']) > 0.01].copy()
+    return mismatched_invoices[
+        ['SoHoaDon', 'NgayLap', 'TenHangHoa', 'SoLuong', 'DonGia', 'ThanhTien', 'ThanhTien_TinhToan']]
+
+
+def _detailed_invoice_amounts(df):
+    # Tiền chưa thuế/thuế/chiết khấu của từng dòng hàng, đã quy đổi VND
+    amounts = df[['NgayLap', 'TrangThaiHoaDon', 'DonViTienTe', 'TyGia', 'TienChietKhau']].copy()
+    amounts['TienChuaThue'] = df['ThanhTien'] - df['TienChietKhau']
+    amounts['TienThue'] = amounts['TienChuaThue'] * df['ThueSuat']
+    return convert_to_vnd(amounts, ['TienChuaThue', 'TienThue', 'TienChietKhau'])
+
+
+# Cách đọc theo khối cho từng loại bảng kê: chuẩn hóa khối, tiền VND từng dòng, cột tổng hợp
+INVOICE_STREAM_KINDS = {
+    'summary': {'prepare': _prepare_summary_invoices,
+                'amounts': _summary_invoice_amounts,
+                'totals': ('TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan'),
+                'label': "tổng hợp"},
+    'detailed': {'prepare': _prepare_detailed_invoices, 'amounts': _detailed_invoice_amounts,
+                 'mismatches': _detailed_invoice_mismatches,
+                 'totals': ('TienChuaThue', 'TienThue', 'TienChietKhau', None), 'label': "chi tiết"},
+}
+
+
+def _file_size(uploaded_file):
+    if hasattr(uploaded_file, 'size'):
+        return uploaded_file.size
+    try:
+        return os.path.getsize(uploaded_file)
+    except (OSError, TypeError):
+        return 0
+
+
+def _should_stream(uploaded_file, stream=None):
+    # stream=None: tự động đọc theo khối với tệp CSV lớn
+    if not _file_name(uploaded_file).lower().endswith('.csv'):
+        return False
+    if stream is not None:
+        return stream
+    return _file_size(uploaded_file) >= INVOICE_STREAM_MIN_BYTES
+
+
+def invoice_dates(values):
+    return values if pd.api.types.is_datetime64_any_dtype(values) else pd.to_datetime(
+        values, errors='coerce', dayfirst=True)
+
+
+def invoice_period_codes(dates):
+    # Mã tháng năm*100+tháng theo ngày lập hóa đơn; 0 = ngày không đọc được
+    dates = invoice_dates(dates)
+    return (dates.dt.year * 100 + dates.dt.month).fillna(0).astype(np.int64)
+
+
+def invoice_period(dates):
+    # Kỳ 'MM/YYYY' theo ngày lập hóa đơn; định dạng qua bảng tra mã năm*100+tháng thay vì strftime từng dòng
+    codes = invoice_period_codes(dates)
+    labels = {code: f"{code % 100:02d}/{code // 100}" for code in np.unique(codes) if code}
+    labels[0] = "Không xác định"
+    return codes.map(labels)
+
+
+def _spill_frame(df):
+    # Kiểu cột ổn định giữa các khối để nối vào cùng một tệp Parquet: số -> float64, ngày giữ nguyên, còn lại -> chuỗi
+    out = {}
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            out[col] = series
+        elif pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            out[col] = series.astype(np.float64)
+        else:
+            out[col] = series.astype('string')
+    return pd.DataFrame(out)
+
+
+def _unspill_frame(df):
+    # Cột chữ ghi dạng 'string' (giữ lược đồ cố định giữa các khối) đọc lại thành object với ô trống là NaN như
+    # khi đọc thẳng CSV, để các hàm dùng chung không gặp ngữ nghĩa pd.NA
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.StringDtype):
+            df[col] = df[col].to_numpy(dtype=object, na_value=np.nan)
+    return df
+
+
+def spill_batches(spill_path, columns):
+    # Đọc lại tệp Parquet tạm theo từng nhóm dòng (mỗi khối đã ghi là một nhóm), chỉ các cột cần
+    spill = pq.ParquetFile(spill_path)
+    for i in range(spill.num_row_groups):
+        yield _unspill_frame(spill.read_row_group(i, columns=columns).to_pandas())
+
+
+def stream_invoice_csv(uploaded_file, kind, log=streamlit_log, chunksize=None, spill_dir=INVOICE_SPILL_DIR,
+                       consumers=()):
+    # Đọc bảng kê CSV lớn theo khối với bộ nhớ giới hạn: mỗi khối được chuẩn hóa, cộng dồn tổng hợp
+    # (tổng hợp lệ + theo trạng thái/tiền tệ/kỳ) rồi ghi nối vào tệp Parquet; chỉ giữ lại vài nghìn dòng để xem.
+    # consumers: các hàm nhận từng khối đã chuẩn hóa để cộng dồn phân tích riêng (vd. InvoiceAccumulator.add).
+    spec = INVOICE_STREAM_KINDS[kind]
+    pre_tax, tax, discount, payment = spec['totals']
+    money_cols = [col for col in spec['totals'] if col]
+    log('write', f"Tệp lớn: đọc Bảng kê hóa đơn {spec['label']} theo khối {chunksize or INVOICE_STREAM_CHUNK_ROWS:,} dòng...")
+
+    spill_path = writer = schema = None
+    if pq is not None:
+        os.makedirs(spill_dir, exist_ok=True)
+        spill_path = os.path.join(spill_dir, f"{file_digest(uploaded_file)}_{kind}.parquet")
+    tmp_path = f"{spill_path}.{os.getpid()}.tmp" if spill_path else None
+
+    totals = dict.fromkeys(money_cols, 0.0)
+    aggregates = None
+    preview, mismatches = [], []
+    preview_rows = mismatch_rows = row_count = 0
+    template, header_row = detect_invoice_template(uploaded_file, (kind,))
+    if template is None:
+        raise ValueError(invoice_template_error(uploaded_file, kind))
+    try:
+        for chunk in read_invoice_template(uploaded_file, kind, header_row,
+                                           chunksize=chunksize or INVOICE_STREAM_CHUNK_ROWS):
+            chunk = spec['prepare'](chunk)
+            row_count += len(chunk)
+            for consume in consumers:
+                consume(chunk)
+
+            amounts = spec['amounts'](chunk)
+            valid = amounts['TrangThaiHoaDon'].isin(VALID_INVOICE_STATUSES).to_numpy()
+            for col in money_cols:
+                totals[col] += amounts[col].to_numpy(dtype=np.float64)[valid].sum()
+            amounts['Ky'] = invoice_period(amounts['NgayLap'])
+            amounts['SoDong'] = 1
+            part = amounts.groupby(['TrangThaiHoaDon', 'DonViTienTe', 'Ky'], dropna=False)[
+                money_cols + ['SoDong']].sum()
+            aggregates = part if aggregates is None else aggregates.add(part, fill_value=0)
+
+            if 'mismatches' in spec and mismatch_rows < INVOICE_PREVIEW_ROWS:
+                found = spec['mismatches'](chunk).head(INVOICE_PREVIEW_ROWS - mismatch_rows)
+                mismatches.append(found)
+                mismatch_rows += len(found)
+            if preview_rows < INVOICE_PREVIEW_ROWS:
+                preview.append(chunk.head(INVOICE_PREVIEW_ROWS - preview_rows))
+                preview_rows += len(preview[-1])
+
+            if tmp_path:
+                table = pa.Table.from_pandas(_spill_frame(chunk), schema=schema, preserve_index=False)
+                if writer is None:
+                    schema = table.schema
+                    writer = pq.ParquetWriter(tmp_path, schema)
+                writer.write_table(table)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            os.remove(tmp_path)
+        raise
+    if writer is not None:
+        writer.close()
+        os.replace(tmp_path, spill_path)
+    else:
+        spill_path = None
+
+    summary = {'total_pre_tax': totals[pre_tax], 'total_tax': totals[tax], 'total_discount': totals[discount]}
+    summary['total_payment'] = totals[payment] if payment else summary['total_pre_tax'] + summary['total_tax']
+    if preview_rows < row_count:
+        log('info', f"Đã đọc {row_count:,} dòng; chỉ hiển thị và kết xuất {preview_rows:,} dòng đầu. "
+                    f"Toàn bộ dữ liệu đã chuẩn hóa được lưu tại {spill_path or '(không có pyarrow)'}.")
+    log('success', f"Xử lý Bảng kê hóa đơn {spec['label']} hoàn tất!")
+    result = {
+        "valid_summary": summary,
+        "full_df": compact_invoice_frame(pd.concat(preview, ignore_index=True) if preview else pd.DataFrame()),
+        "aggregates_df": aggregates.reset_index() if aggregates is not None else pd.DataFrame(),
+        "spill_path": spill_path,
+        "row_count": row_count,
+    }
+    if 'mismatches' in spec:
+        result["mismatch_df"] = pd.concat(mismatches, ignore_index=True) if mismatches else pd.DataFrame()
+    return result
+
+
+def _is_excel(uploaded_file):
+    return _file_name(uploaded_file).lower().endswith(('.xlsx', '.xls'))
+
+
+def _text_value(value):
+    # Giá trị ô -> chuỗi; số nguyên lưu dạng số thực (1.0) viết lại thành '1' như read_excel(dtype=str)
+    if value is None or value == '':
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _typed_column(values, dtype=None):
+    # Cột giá trị thô -> mảng có kiểu (int64/float64/datetime64); cột chữ số dạng văn bản được đổi sang số như read_excel
+    if dtype is str:
+        return pd.Series([_text_value(value) for value in values], dtype=object)
+    series = pd.Series(values)
+    if series.dtype == object:
+        try:
+            return pd.to_numeric(series)
+        except (ValueError, TypeError):
+            series[series.isna()] = np.nan  # ô trống là NaN như read_excel
+    return series
+
+
+def _sheet_rows(sheet, min_row=1, max_row=None):
+    # Kích thước ghi trong tệp không đáng tin (read_excel luôn tính lại): bỏ đi để iter_rows đọc đến ô cuối
+    # thực có của từng dòng, chỉ một lượt duyệt
+    sheet.reset_dimensions()
+    return sheet.iter_rows(min_row=min_row, max_row=max_row, values_only=True)
+
+
+def _read_excel_openpyxl(uploaded_file, skiprows=0, header=0, usecols=None, dtype=None):
+    # Sheet đầu tiên, openpyxl read_only, chỉ lấy giá trị. Mỗi dòng chỉ chép các ô thuộc `usecols` vào danh sách
+    # của cột đó ngay khi duyệt (không giữ bản sao các dòng). Dòng trống như read_excel: dòng trống giữa dữ liệu
+    # được giữ (giá trị NaN), các dòng trống ở cuối sheet bị bỏ; dòng có dữ liệu ở cột ngoài `usecols` không trống.
+    workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True, keep_links=False)
+    names, columns = None, {}
+    if usecols is not None:
+        columns = {i: [] for i in usecols}
+    count = filled = 0
+    try:
+        for row in _sheet_rows(workbook.worksheets[0], skiprows + 1):
+            if names is None and header is not None:
+                names = row
+                if usecols is None:
+                    columns = {i: [] for i in range(len(row))}
+                continue
+            if usecols is None and len(row) > len(columns):
+                last = max((i for i, value in enumerate(row) if value is not None and value != ''), default=-1)
+                columns.update({i: [None] * count for i in range(len(columns), last + 1)})
+            for i, values in columns.items():
+                values.append(row[i] if i < len(row) else None)
+            count += 1
+            if any(value is not None and value != '' for value in row):
+                filled = count
+    finally:
+        workbook.close()
+    names = names or ()
+    names = [names[i] if i < len(names) and names[i] is not None else
+             (i if header is None else f"Unnamed: {i}") for i in columns]
+    dtype = dtype or {}
+    return pd.DataFrame({i: _typed_column(values[:filled], dtype.get(name))
+                         for (i, values), name in zip(columns.items(), names)}).set_axis(names, axis=1)
+
+
+def _read_excel_pandas(uploaded_file, skiprows=0, header=0, usecols=None, dtype=None):
+    return pd.read_excel(uploaded_file, skiprows=skiprows, header=header, usecols=usecols, dtype=dtype)
+
+
+INVOICE_SHEET_READERS = {
+    'openpyxl': _read_excel_openpyxl,
+    'pandas': _read_excel_pandas,
+}
+
+
+def _sheet_reader(uploaded_file, reader=None):
+    if not _file_name(uploaded_file).lower().endswith('.xlsx'):
+        return 'pandas'  # .xls: openpyxl không đọc được
+    return reader or INVOICE_SHEET_READER
+
+
+def _read_spreadsheet(uploaded_file, skiprows=0, header=0, usecols=None, dtype=None, reader=None):
+    if _file_name(uploaded_file).endswith('.csv'):
+        return pd.read_csv(uploaded_file, skiprows=skiprows, header=header, usecols=usecols, dtype=dtype)
+    return INVOICE_SHEET_READERS[_sheet_reader(uploaded_file, reader)](
+        uploaded_file, skiprows=skiprows, header=header, usecols=usecols, dtype=dtype)
+
+
+def _normalize_header(value):
+    text = unicodedata.normalize('NFD', str(value or '').lower()).replace('đ', 'd')
+    return re.sub(r'[^a-z0-9]', '', ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn'))
+
+
+def sniff_invoice_rows(uploaded_file, rows=INVOICE_SNIFF_ROWS, reader=None):
+    # Giá trị thô của vài dòng đầu tệp, không đọc phần còn lại
+    if hasattr(uploaded_file, 'seek'):
+        uploaded_file.seek(0)
+    try:
+        if _file_name(uploaded_file).endswith('.csv'):
+            if hasattr(uploaded_file, 'getvalue'):
+                head = uploaded_file.getvalue()[:1 << 16]
+            else:
+                with open(uploaded_file, 'rb') as f:
+                    head = f.read(1 << 16)
+            return list(csv.reader(head.decode('utf-8-sig', errors='replace').splitlines()[:rows]))
+        if _sheet_reader(uploaded_file, reader) == 'openpyxl':
+            workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True, keep_links=False)
+            try:
+                return [list(row) for row in _sheet_rows(workbook.worksheets[0], max_row=rows)]
+            finally:
+                workbook.close()
+        return pd.read_excel(uploaded_file, header=None, nrows=rows).astype(object).where(
+            lambda df: df.notna(), None).values.tolist()
+    finally:
+        if hasattr(uploaded_file, 'seek'):
+            uploaded_file.seek(0)
+
+
+def detect_invoice_template(uploaded_file, templates, rows=None):
+    # (mẫu, chỉ số dòng tiêu đề) của mẫu khớp đầu tiên trong `templates`; (None, None) nếu không khớp mẫu nào
+    rows = sniff_invoice_rows(uploaded_file) if rows is None else rows
+    width = max((max((i + 1 for i, value in enumerate(row) if value not in (None, '')), default=0) for row in rows),
+                default=0)
+    headers = [[_normalize_header(value) for value in row] for row in rows]
+    for template in templates:
+        spec = INVOICE_TEMPLATES[template]
+        if width < len(spec['columns']):
+            continue
+        for i, row in enumerate(headers):
+            if all(pos < len(row) and any(word in row[pos] for word in words)
+                   for pos, words in spec['signature'].items()):
+                return template, i
+    return None, None
+
+
+def invoice_template_error(uploaded_file, template):
+    return (f"Tệp '{_file_name(uploaded_file)}' không đúng mẫu {INVOICE_TEMPLATES[template]['label']}: "
+            f"không tìm thấy dòng tiêu đề phù hợp trong {INVOICE_SNIFF_ROWS} dòng đầu.")
+
+
+def read_invoice_template(uploaded_file, template, header_row, reader=None, chunksize=None):
+    # Chỉ đọc các cột mẫu cần (usecols), cột chữ đọc dạng chuỗi (dtype); trả về DataFrame đã đặt tên cột
+    # hoặc bộ lặp theo khối khi có `chunksize` (chỉ với CSV)
+    columns = INVOICE_TEMPLATES[template]['columns']
+    usecols = [i for i, name in enumerate(columns) if name]
+    dtype = {i: str for i in usecols if columns[i] in INVOICE_TEXT_COLUMNS}
+    names = [columns[i] for i in usecols]
+    if hasattr(uploaded_file, 'seek'):
+        uploaded_file.seek(0)
+    if chunksize:
+        return (chunk.set_axis(names, axis=1) for chunk in pd.read_csv(
+            uploaded_file, skiprows=header_row + 1, header=None, usecols=usecols, dtype=dtype, chunksize=chunksize))
+    df = _read_spreadsheet(uploaded_file, skiprows=header_row + 1, header=None, usecols=usecols, dtype=dtype,
+                           reader=reader)
+    return df.set_axis(names, axis=1)
+
+
+def read_invoice_sheet(uploaded_file, templates, cache=None, digest=None):
+    # Nhận diện mẫu rồi đọc bảng kê qua bộ đệm Parquet: tệp Excel đã gặp (cùng nội dung, cùng mẫu) được đọc lại
+    # từ Parquet thay vì phân tích lại xlsx. Trả về (mẫu, DataFrame); (None, None) nếu tệp không khớp mẫu nào.
+    # digest: SHA-256 của tệp nếu nơi gọi đã tính (không băm lại)
+    if cache is None and _is_excel(uploaded_file):
+        cache = get_invoice_sheet_cache()
+    if cache is None:
+        digest = None  # CSV: không qua bộ đệm
+    elif digest is None:
+        digest = file_digest(uploaded_file)
+    if digest:
+        for template in templates:
+            df = cache.load(cache.key_for(digest, template))
+            if df is not None:
+                return template, df
+    template, header_row = detect_invoice_template(uploaded_file, templates)
+    if template is None:
+        return None, None
+    df = read_invoice_template(uploaded_file, template, header_row)
+    if digest:
+        cache.store(cache.key_for(digest, template), df)
+    return template, df
+
+
+def _invoice_sheet_cached(uploaded_file, templates, digest):
+    cache = get_invoice_sheet_cache() if _is_excel(uploaded_file) else None
+    return cache is not None and bool(digest) and any(
+        os.path.exists(cache.path_for(cache.key_for(digest, t))) for t in templates)
+
+
+# --- CHUỖI HÓA ĐƠN THAY THẾ / ĐIỀU CHỈNH ---
+def _invoice_numbers(values):
+    # Số hóa đơn ('0000123', '123.0', 123, 'HD-123') -> số nguyên (float, NaN nếu không đọc được);
+    # chỉ giá trị không phải số thuần mới phải qua biểu thức chính quy
+    values = pd.Series(values).reset_index(drop=True)
+    numbers = pd.to_numeric(values, errors='coerce').astype(np.float64)
+    other = numbers.isna() & values.notna()
+    if other.any():
+        numbers[other] = pd.to_numeric(values[other].astype(str).str.extract(r'(\d+)(?:\.0+)?\D*$')[0],
+                                       errors='coerce')
+    return numbers.where((numbers >= 0) & (numbers == np.floor(numbers))).to_numpy()
+
+
+def _series_names(values):
+    # Ký hiệu hóa đơn chuẩn hóa (6 ký tự cuối, chữ hoa); chuẩn hóa trên các giá trị khác nhau rồi trải lại
+    codes, uniques = pd.factorize(pd.Series(values).reset_index(drop=True))
+    names = pd.Index(uniques).astype(str).str.strip().str.upper().str[-6:].to_numpy(dtype=object)
+    return np.where(codes >= 0, names[np.maximum(codes, 0)] if len(names) else None, None)
+
+
+def parse_related_invoice(values):
+    # HD_LienQuan ('1C24TAA-0000123', 'C24TAA 123', '123') -> (ký hiệu 6 ký tự hoặc None, số hóa đơn hoặc NaN)
+    text = pd.Series(values).reset_index(drop=True)
+    series = np.full(len(text), None, dtype=object)
+    numbers = np.full(len(text), np.nan)
+    present = text.notna().to_numpy() & text.astype(str).str.strip().ne('').to_numpy()
+    if present.any():
+        upper = text[present].astype(str).str.upper()
+        series[present] = upper.str.extract(f'({INVOICE_SERIES_PATTERN})')[0].str[-6:].to_numpy(dtype=object)
+        numbers[present] = _invoice_numbers(upper.str.replace(INVOICE_SERIES_PATTERN, ' ', regex=True).str.extract(
+            r'(\d+)(?:\.0+)?\D*$')[0])
+    series[pd.isna(series)] = None
+    return series, numbers
+
+
+def _invoice_key_codes(series, numbers, vocabulary):
+    # Khóa số nguyên (mã ký hiệu, số hóa đơn) để tra bằng chỉ mục băm int64; thiếu thành phần -> -1
+    codes = vocabulary.get_indexer(pd.Index(series, dtype=object))
+    valid = (codes >= 0) & ~np.isnan(numbers)
+    return np.where(valid, codes.astype(np.int64) * (1 << 40) + np.nan_to_num(numbers).astype(np.int64), -1)
+
+
+class InvoiceAccumulator:
+    # Cộng dồn dòng hàng thành hóa đơn (KyHieu, SoHoaDon) qua nhiều khối đọc mà không giữ lại dòng hàng: chỉ mục băm
+    # khóa -> vị trí hóa đơn được mở rộng dần theo từng khối, hóa đơn vắt qua ranh giới khối cộng tiếp vào đúng vị trí.
+    # Cột `first` lấy giá trị khác rỗng đầu tiên, cột `sums` được cộng dồn.
+    # prepare: hàm đổi khối dòng hàng thành khung có các cột khóa + first + sums (mặc định dùng nguyên khối).
+    def __init__(self, first, sums, keys=('KyHieu', 'SoHoaDon'), prepare=None):
+        self.keys, self.first, self.sums = list(keys), list(first), list(sums)
+        self.prepare = prepare
+        self.index = {}
+        self._firsts, self._slots, self._totals = [], [], []
+
+    def __len__(self):
+        return len(self.index)
+
+    def _keys(self, frame):
+        codes = _group_codes(*(frame[key] for key in self.keys))
+        first = _first_rows(codes)
+        key_values, lookup = [], []
+        for key in self.keys:
+            values = frame[key].to_numpy()[first]
+            key_values.append(values)
+            values = values.astype(object)
+            values[pd.isna(values)] = None  # NaN không bằng chính nó: đưa về None để tra khóa
+            lookup.append(values)
+        return codes, first, key_values, zip(*lookup)
+
+    def slots(self, frame):
+        # Vị trí của từng dòng theo chỉ mục đã có, không thêm khóa mới (-1 nếu chưa gặp)
+        codes, first, _, keys = self._keys(frame)
+        return np.fromiter((self.index.get(key, -1) for key in keys), dtype=np.int64, count=len(first))[codes]
+
+    def add(self, frame):
+        # Trả về vị trí hóa đơn của từng dòng trong khối
+        if self.prepare is not None:
+            frame = self.prepare(frame)
+        codes, first, key_values, keys = self._keys(frame)
+        slots = np.fromiter((self.index.setdefault(key, len(self.index)) for key in keys),
+                            dtype=np.int64, count=len(first))
+        firsts = frame[self.first].groupby(codes, sort=True).first().reset_index(drop=True)
+        for i, (key, values) in enumerate(zip(self.keys, key_values)):
+            firsts.insert(i, key, values)
+        self._firsts.append(firsts)
+        self._slots.append(slots)
+        self._totals.append(np.column_stack([
+            np.bincount(codes, frame[col].to_numpy(dtype=np.float64), minlength=len(first))
+            for col in self.sums]) if self.sums else np.empty((len(first), 0)))
+        return slots[codes]
+
+    def frame(self):
+        # Mỗi dòng một hóa đơn theo thứ tự gặp đầu tiên: cột khóa, cột first, cột sums
+        n = len(self.index)
+        if not n:
+            return pd.DataFrame(columns=self.keys + self.first + self.sums)
+        slots = np.concatenate(self._slots)
+        firsts = pd.concat(self._firsts, ignore_index=True)
+        invoices = firsts[self.keys].iloc[_first_rows(slots)].reset_index(drop=True)
+        if self.first:
+            invoices[self.first] = firsts[self.first].groupby(slots, sort=True).first().reset_index(drop=True)
+        totals = np.vstack(self._totals)
+        for i, col in enumerate(self.sums):
+            invoices[col] = np.bincount(slots, totals[:, i], minlength=n)
+        return invoices
+
+
+def _chain_lines(df):
+    amounts = _detailed_invoice_amounts(df)
+    return pd.DataFrame({
+        'KyHieu': df['KyHieu'], 'SoHoaDon': df['SoHoaDon'], 'NgayLap': df['NgayLap'],
+        'TrangThaiHoaDon': df['TrangThaiHoaDon'], 'HD_LienQuan': df['HD_LienQuan'],
+        'TienChuaThue': amounts['TienChuaThue'].fillna(0), 'TienThue': amounts['TienThue'].fillna(0),
+    })
+
+
+def invoice_chain_accumulator():
+    # Bộ cộng dồn hóa đơn cho resolve_invoice_chains, dùng được khi đọc bảng kê theo khối
+    return InvoiceAccumulator(['NgayLap', 'TrangThaiHoaDon', 'HD_LienQuan'], ['TienChuaThue', 'TienThue'],
+                              prepare=_chain_lines)
+
+
+def resolve_invoice_chains(df=None, invoices=None):
+    # Nối hóa đơn thay thế/điều chỉnh với hóa đơn gốc trên bảng kê chi tiết và tính số tiền hiệu lực cuối cùng
+    # của mỗi hóa đơn gốc. Dòng hàng được gộp theo (KyHieu, SoHoaDon); chỉ mục băm trên khóa này cho phép nối
+    # mọi liên kết một lượt, gốc của chuỗi tìm bằng nhảy con trỏ trên mảng NumPy.
+    # df: dòng hàng; hoặc invoices: hóa đơn đã gộp sẵn (invoice_chain_accumulator().frame() khi đọc theo khối).
+    # Trả về {'invoices': từng hóa đơn kèm gốc và cảnh báo, 'chains': số tiền hiệu lực theo gốc của các chuỗi,
+    #         'totals': tổng hiệu lực}.
+    if invoices is None:
+        accumulator = invoice_chain_accumulator()
+        accumulator.add(df)
+        invoices = accumulator.frame()
+    n = len(invoices)
+    series = _series_names(invoices['KyHieu'])
+    numbers = _invoice_numbers(invoices['SoHoaDon'])
+    ref_series, ref_numbers = parse_related_invoice(invoices['HD_LienQuan'])
+    vocabulary = pd.Index(pd.unique(series[pd.notna(series)]), dtype=object)
+    keys = _invoice_key_codes(series, numbers, vocabulary)
+
+    # Liên kết tới hóa đơn gốc: khóa đầy đủ (ký hiệu + số); HD_LienQuan chỉ có số thì chỉ nối khi số đó là duy nhất
+    index = pd.Index(np.where(keys >= 0, keys, -1 - np.arange(n)))  # khóa hỏng được thay bằng giá trị âm riêng
+    ref_keys = _invoice_key_codes(ref_series, ref_numbers, vocabulary)
+    parent = np.where(ref_keys >= 0, index.get_indexer(ref_keys), -1).astype(np.int64)
+    number_only = pd.isna(ref_series) & ~np.isnan(ref_numbers)
+    if number_only.any():
+        by_number = pd.Series(np.arange(n), index=numbers)
+        by_number = by_number[~by_number.index.duplicated(keep=False) & ~np.isnan(by_number.index)]
+        parent[number_only] = pd.Series(ref_numbers[number_only]).map(by_number).fillna(-1).to_numpy(np.int64)
+
+    status = invoices['TrangThaiHoaDon'].fillna('').to_numpy()
+    linked_status = np.isin(status, [REPLACEMENT_STATUS, ADJUSTMENT_STATUS])
+    has_ref = invoices['HD_LienQuan'].notna().to_numpy() & invoices['HD_LienQuan'].astype(str).str.strip().ne(
+        '').to_numpy()
+    self_link = parent == np.arange(n)
+    parent[self_link] = -1
+    broken = has_ref & (parent < 0) & ~self_link
+
+    # Gốc của chuỗi: nhảy con trỏ root = root[root] (mỗi lượt gấp đôi quãng đường, log2(n) lượt là đủ);
+    # nút mà con trỏ cuối cùng chưa dừng ở hóa đơn không liên kết là nằm trong/dẫn vào vòng lặp
+    root = np.where(parent < 0, np.arange(n), parent)
+    for _ in range(int(np.ceil(np.log2(max(n, 2)))) + 1):
+        jumped = root[root]
+        if np.array_equal(jumped, root):
+            break
+        root = jumped
+    circular = (parent[root] >= 0) | self_link
+    root[circular] = np.flatnonzero(circular)
+
+    # Hóa đơn bị thay thế không còn hiệu lực; hóa đơn điều chỉnh mang số chênh lệch nên được cộng vào gốc
+    replacing = (status == REPLACEMENT_STATUS) & (parent >= 0) & ~circular
+    replace_counts = np.bincount(parent[replacing], minlength=n)
+    replaced = replace_counts > 0
+    effective = ~replaced & (status != CANCELLED_STATUS) & (status != REPLACED_STATUS)
+    for col in ('TienChuaThue', 'TienThue'):
+        invoices[f'{col}_HieuLuc'] = np.where(effective, invoices[col].to_numpy(dtype=np.float64), 0.0)
+
+    issues = np.full(n, '', dtype=object)
+    for mask, message in (
+            (broken, "Không tìm thấy hóa đơn gốc trong bảng kê"),
+            (circular, "Chuỗi thay thế/điều chỉnh bị vòng lặp"),
+            (replace_counts > 1, "Hóa đơn bị thay thế nhiều lần"),
+            (replaced & np.isin(status, VALID_INVOICE_STATUSES),
+             "Đã có hóa đơn thay thế nhưng trạng thái chưa cập nhật (có thể bị cộng trùng)"),
+            ((status == REPLACED_STATUS) & ~replaced, "Trạng thái đã bị thay thế nhưng không có hóa đơn thay thế"),
+            (linked_status & ~has_ref, "Thiếu số hóa đơn liên quan")):
+        issues[mask] = np.where(issues[mask] == '', message, issues[mask] + '; ' + message)
+    invoices['HoaDonGoc'] = (invoices['KyHieu'].astype(str) + '-' + invoices['SoHoaDon'].astype(str)).to_numpy()[root]
+    invoices['CanhBao'] = issues
+
+    chain_size = np.bincount(root, minlength=n)
+    in_chain = chain_size[root] > 1
+    chains = invoices.loc[in_chain].groupby(root[in_chain], sort=False).agg(
+        SoHoaDonTrongChuoi=('SoHoaDon', 'size'), TienChuaThue_HieuLuc=('TienChuaThue_HieuLuc', 'sum'),
+        TienThue_HieuLuc=('TienThue_HieuLuc', 'sum'))
+    roots = invoices.iloc[chains.index][['KyHieu', 'SoHoaDon', 'NgayLap', 'TrangThaiHoaDon']]
+    chains = pd.concat([roots.reset_index(drop=True), chains.reset_index(drop=True)], axis=1)
+    totals = {'total_pre_tax': invoices['TienChuaThue_HieuLuc'].sum(), 'total_tax': invoices['TienThue_HieuLuc'].sum()}
+    return {'invoices': invoices, 'chains': chains, 'totals': totals}
+
+
+def invoice_chain_results(df, summary, log=streamlit_log, invoices=None):
+    # Nối chuỗi thay thế/điều chỉnh, cảnh báo chuỗi lỗi và chênh lệch với tổng theo trạng thái
+    chains = resolve_invoice_chains(df, invoices)
+    chain_issues = chains['invoices'][chains['invoices']['CanhBao'] != '']
+    if not chain_issues.empty:
+        log('warning', f"Có {len(chain_issues):,} hóa đơn thay thế/điều chỉnh cần kiểm tra (chuỗi đứt, vòng lặp "
+                       f"hoặc có thể bị cộng trùng).")
+    gap = summary['total_pre_tax'] - chains['totals']['total_pre_tax']
+    if abs(gap) > 1:
+        log('warning', f"Tổng tiền chưa thuế theo trạng thái hóa đơn chênh {gap:,.0f} đồng so với tổng hiệu lực "
+                       f"sau khi nối chuỗi thay thế/điều chỉnh.")
+    return {"chain_summary": chains['totals'], "chain_df": chains['chains'], "chain_issues_df": chain_issues}
+
+
+# --- PHÂN TÍCH DÒNG HÀNG (BẢNG KÊ CHI TIẾT) ---
+# Thuế suất GTGT hợp lệ trên hóa đơn (8%: mức giảm thuế theo nghị quyết của Quốc hội)
+VAT_RATES = (0.0, 0.05, 0.08, 0.1)
+# Đơn giá bất thường: nhóm (TenHangHoa, DonViTinh) đủ số dòng, đơn giá nằm ngoài hàng rào IQR và lệch trung vị
+PRICE_OUTLIER_MIN_LINES = 5
+PRICE_OUTLIER_IQR = 1.5
+PRICE_OUTLIER_LOW_RATIO = 0.5
+PRICE_OUTLIER_HIGH_RATIO = 2.0
+# Số nút tối đa của bảng đếm đơn giá mỗi nhóm khi cộng dồn theo khối (phân vị gần đúng khi vượt)
+PRICE_SKETCH_SIZE = 4096
+PRICE_OUTLIER_COLUMNS = ['KyHieu', 'SoHoaDon', 'NgayLap', 'TenNguoiMua', 'MSTNguoiMua', 'TenHangHoa', 'DonViTinh',
+                         'SoLuong']
+# Cột đọc lại từ tệp Parquet tạm cho lượt tìm đơn giá bất thường
+PRICE_OUTLIER_SPILL_COLUMNS = PRICE_OUTLIER_COLUMNS + ['DonGia', 'DonViTienTe', 'TyGia', 'TrangThaiHoaDon']
+
+
+def _group_codes(*columns):
+    # Mã nhóm 0..n-1 theo tổ hợp cột (theo thứ tự xuất hiện), ghép mã factorize của từng cột thành một số nguyên
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        codes, uniques = pd.factorize(column, use_na_sentinel=False)
+        key = key * (len(uniques) + 1) + codes
+    codes, _ = pd.factorize(key)
+    return codes
+
+
+def _first_rows(codes):
+    # Dòng đầu tiên của từng nhóm; mã factorize đánh theo thứ tự xuất hiện nên nhóm mới là nơi max lũy kế tăng
+    return np.flatnonzero(np.diff(np.maximum.accumulate(codes), prepend=-1) > 0)
+
+
+def _group_quantiles(codes, values, quantiles, weights=None):
+    # Phân vị theo nhóm (nội suy tuyến tính như np.quantile): sắp xếp một lần theo (nhóm, giá trị) rồi lấy theo chỉ số.
+    # weights: số lần lặp của mỗi giá trị (bảng đếm giá trị), phân vị tính như trên dãy đã khai triển
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    if weights is None:
+        sizes = np.bincount(codes)
+        cumulative = None
+    else:
+        sizes = np.bincount(codes, weights)
+        cumulative = np.cumsum(weights[order])
+    starts = np.cumsum(sizes) - sizes
+    result = np.empty((len(sizes), len(quantiles)))
+    for i, q in enumerate(quantiles):
+        position = starts + q * (sizes - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, (starts + sizes - 1).astype(np.int64))
+        if cumulative is not None:
+            lower_value = sorted_values[np.searchsorted(cumulative, lower, side='right')]
+            upper_value = sorted_values[np.searchsorted(cumulative, upper, side='right')]
+        else:
+            lower_value, upper_value = sorted_values[lower], sorted_values[upper]
+        result[:, i] = lower_value + (upper_value - lower_value) * (position - lower)
+    return result
+
+
+def _value_counts(codes, values, weights=None):
+    # Bảng đếm (nhóm, giá trị) -> số lần, sắp theo nhóm rồi giá trị
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+    weights = np.ones(len(order)) if weights is None else weights[order]
+    if not len(order):
+        return codes, values, weights
+    starts = np.flatnonzero(np.r_[True, (np.diff(codes) != 0) | (np.diff(values) != 0)])
+    return codes[starts], values[starts], np.add.reduceat(weights, starts)
+
+
+def _compact_value_counts(codes, values, weights, size):
+    # Nén bảng đếm (đã sắp theo nhóm, giá trị) của nhóm có hơn `size` giá trị phân biệt thành `size` nút bình quân
+    # gia quyền theo dải khối lượng tích lũy, giữ riêng giá trị nhỏ nhất/lớn nhất; nhóm nhỏ giữ nguyên
+    distinct = np.bincount(codes)
+    if not len(distinct) or distinct.max() <= size:
+        return codes, values, weights
+    position = np.arange(len(codes)) - (np.cumsum(distinct) - distinct)[codes]
+    total = np.bincount(codes, weights)
+    before = np.cumsum(weights) - weights - (np.cumsum(total) - total)[codes]
+    large = distinct[codes] > size
+    bucket = np.where(large, 1 + np.floor(before / total[codes] * (size - 2)), position)
+    bucket[large & (position == 0)] = 0
+    bucket[large & (position == distinct[codes] - 1)] = size - 1
+    group = _group_codes(codes, bucket)
+    merged = np.bincount(group, weights)
+    return codes[_first_rows(group)], np.bincount(group, values * weights) / merged, merged
+
+
+def _invoice_line_frame(df):
+    # Cột dòng hàng cần cho cộng hóa đơn và kiểm tra thuế suất/thành tiền
+    lines = _detailed_invoice_amounts(df)
+    quantity = df['SoLuong'].to_numpy(dtype=np.float64)
+    tax_rate = np.round(df['ThueSuat'].to_numpy(dtype=np.float64), 4)
+    return pd.DataFrame({
+        'KyHieu': df['KyHieu'].to_numpy(), 'SoHoaDon': df['SoHoaDon'].to_numpy(), 'NgayLap': df['NgayLap'].to_numpy(),
+        'MSTNguoiMua': df['MSTNguoiMua'].to_numpy(), 'TrangThaiHoaDon': df['TrangThaiHoaDon'].to_numpy(),
+        'SoDong': 1, 'TienChuaThue': lines['TienChuaThue'].to_numpy(dtype=np.float64),
+        'TienThue': lines['TienThue'].to_numpy(dtype=np.float64), 'ThueSuat': tax_rate,
+        'DongSaiThanhTien': np.abs(df['ThanhTien'].to_numpy(dtype=np.float64) - quantity * df['DonGia'].to_numpy(
+            dtype=np.float64)) > 0.01,
+        'DongSaiThueSuat': ~np.isin(tax_rate, VAT_RATES),
+    })
+
+
+def _unit_prices(df):
+    # Đơn giá quy VND và dòng dùng cho phân phối đơn giá (hóa đơn hợp lệ, đơn giá dương); ô tiền tệ trống
+    # (NaN hoặc pd.NA khi đọc lại từ tệp Parquet) coi là ngoại tệ như khi so sánh != 'VND' trên cột object
+    foreign = df['DonViTienTe'].ne('VND').fillna(True).to_numpy(dtype=bool)
+    rates = np.where(foreign, pd.to_numeric(df['TyGia'], errors='coerce').fillna(0).to_numpy(dtype=np.float64), 1.0)
+    unit_price = df['DonGia'].to_numpy(dtype=np.float64) * rates
+    priced = df['TrangThaiHoaDon'].isin(VALID_INVOICE_STATUSES).to_numpy() & (unit_price > 0)
+    return unit_price, priced
+
+
+class InvoiceLineAccumulator:
+    # Phân tích dòng hàng bảng kê chi tiết cộng dồn theo khối: hóa đơn (InvoiceAccumulator), thuế theo thuế suất và
+    # thống kê đơn giá theo (TenHangHoa, DonViTinh) chỉ giữ tổng/đếm từng phần và bảng đếm đơn giá của mỗi nhóm.
+    # Bảng đếm đơn giá được nén (PRICE_SKETCH_SIZE nút/nhóm) khi gộp khối mới nên phân vị chính xác khi chỉ có một
+    # khối hoặc nhóm ít mức giá, gần đúng với nhóm rất nhiều mức giá. Dòng đơn giá bất thường cần lượt đọc thứ hai.
+    def __init__(self):
+        self.invoices = InvoiceAccumulator(['NgayLap', 'MSTNguoiMua', 'TrangThaiHoaDon'],
+                                           ['SoDong', 'TienChuaThue', 'TienThue', 'DongSaiThanhTien',
+                                            'DongSaiThueSuat'])
+        self.products = InvoiceAccumulator([], ['SoDong', 'TongSoLuong', 'GiaTri'], keys=('TenHangHoa', 'DonViTinh'))
+        self._rate_pairs, self._rates = [], []
+        self._prices = None
+        self._stats = None
+
+    def add(self, df):
+        lines = _invoice_line_frame(df)
+        invoice = self.invoices.add(lines)
+        valid = lines['TrangThaiHoaDon'].isin(VALID_INVOICE_STATUSES).to_numpy()
+        tax_rate = lines['ThueSuat'].to_numpy()
+
+        # Cặp (hóa đơn, thuế suất) phân biệt: đếm số thuế suất mỗi hóa đơn và số hóa đơn mỗi thuế suất
+        first = _first_rows(_group_codes(invoice, tax_rate, valid))
+        self._rate_pairs.append(pd.DataFrame({'HoaDon': invoice[first], 'ThueSuat': tax_rate[first],
+                                              'HopLe': valid[first]}))
+        self._rates.append(lines.loc[valid, ['ThueSuat', 'SoDong', 'TienChuaThue', 'TienThue']].groupby(
+            'ThueSuat', dropna=False).sum())
+
+        unit_price, priced = _unit_prices(df)
+        quantity = df['SoLuong'].to_numpy(dtype=np.float64)[priced]
+        prices = unit_price[priced]
+        product = self.products.add(pd.DataFrame({
+            'TenHangHoa': df['TenHangHoa'].to_numpy()[priced], 'DonViTinh': df['DonViTinh'].to_numpy()[priced],
+            'SoDong': 1, 'TongSoLuong': quantity, 'GiaTri': prices * quantity}))
+        counts = _value_counts(product, prices)
+        if self._prices is None:
+            self._prices = counts
+        else:
+            merged = _value_counts(*(np.concatenate(parts) for parts in zip(self._prices, counts)))
+            self._prices = _compact_value_counts(*merged, PRICE_SKETCH_SIZE)
+        self._stats = None
+
+    def invoice_rollup(self):
+        invoices = self.invoices.frame()
+        for col in ('SoDong', 'DongSaiThanhTien', 'DongSaiThueSuat'):
+            invoices[col] = invoices[col].astype(np.int64)
+        pairs = pd.concat(self._rate_pairs, ignore_index=True) if self._rate_pairs else pd.DataFrame(
+            columns=['HoaDon', 'ThueSuat', 'HopLe'])
+        invoice = pairs['HoaDon'].to_numpy(dtype=np.int64)
+        distinct = _first_rows(_group_codes(invoice, pairs['ThueSuat'].to_numpy(dtype=np.float64)))
+        invoices.insert(invoices.columns.get_loc('TienThue') + 1, 'TongThanhToan',
+                        invoices['TienChuaThue'] + invoices['TienThue'])
+        invoices.insert(invoices.columns.get_loc('TongThanhToan') + 1, 'SoThueSuat',
+                        np.bincount(invoice[distinct], minlength=len(invoices)))
+        return invoices
+
+    def tax_rates(self):
+        # Thuế theo thuế suất: chỉ hóa đơn hợp lệ; thuế suất > 1 thường là ghi dạng phần trăm (10 thay vì 0.1)
+        columns = ['SoDong', 'TienChuaThue', 'TienThue']
+        by_rate = (pd.concat(self._rates).groupby(level=0, dropna=False).sum() if self._rates
+                   else pd.DataFrame(columns=columns, index=pd.Index([], name='ThueSuat', dtype=np.float64)))
+        pairs = pd.concat(self._rate_pairs, ignore_index=True) if self._rate_pairs else pd.DataFrame(
+            columns=['HoaDon', 'ThueSuat', 'HopLe'])
+        pairs = pairs[pairs['HopLe'].astype(bool)]
+        by_rate.insert(1, 'SoHoaDon', pairs.groupby('ThueSuat', dropna=False)['HoaDon'].nunique().reindex(
+            by_rate.index).fillna(0).astype(np.int64))
+        by_rate['SoDong'] = by_rate['SoDong'].astype(np.int64)
+        by_rate = by_rate.reset_index()
+        by_rate['KiemTra'] = np.select(
+            [by_rate['ThueSuat'].isin(VAT_RATES), by_rate['ThueSuat'] > 1],
+            ["Hợp lệ", "Thuế suất ghi dạng phần trăm"], "Thuế suất không hợp lệ")
+        return by_rate
+
+    def price_stats(self):
+        # Phân phối đơn giá VND theo (TenHangHoa, DonViTinh) trên dòng hợp lệ có đơn giá dương
+        if self._stats is not None:
+            return self._stats
+        stats = self.products.frame()
+        n_products = len(stats)
+        product, values, weights = self._prices if self._prices is not None else (np.zeros(0, np.int64),) * 3
+        q = _group_quantiles(product, values, (0.0, 0.25, 0.5, 0.75, 1.0), weights) if n_products else np.empty(
+            (0, 5))
+        stats['SoDong'] = stats['SoDong'].astype(np.int64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats['DonGiaBinhQuan'] = stats.pop('GiaTri').to_numpy() / stats['TongSoLuong'].to_numpy()
+        for i, name in enumerate(['DonGiaThapNhat', 'DonGiaQ1', 'DonGiaTrungVi', 'DonGiaQ3', 'DonGiaCaoNhat']):
+            stats[name] = q[:, i]
+        self._stats = stats
+        return stats
+
+    def price_outliers(self, frames):
+        # Lượt thứ hai trên dòng hàng (cả bảng hoặc từng nhóm dòng của tệp Parquet): đơn giá ngoài hàng rào IQR
+        # và lệch trung vị của nhóm đủ số dòng
+        stats = self.price_stats()
+        q1, median, q3 = (stats[name].to_numpy() for name in ('DonGiaQ1', 'DonGiaTrungVi', 'DonGiaQ3'))
+        iqr = q3 - q1
+        low_fence = np.minimum(q1 - PRICE_OUTLIER_IQR * iqr, median * PRICE_OUTLIER_LOW_RATIO)
+        high_fence = np.maximum(q3 + PRICE_OUTLIER_IQR * iqr, median * PRICE_OUTLIER_HIGH_RATIO)
+        enough = stats['SoDong'].to_numpy() >= PRICE_OUTLIER_MIN_LINES
+        found = []
+        for df in frames if enough.any() else ():
+            unit_price, priced = _unit_prices(df)
+            product = self.products.slots(df.loc[priced, ['TenHangHoa', 'DonViTinh']])
+            prices = unit_price[priced]
+            flagged = (product >= 0) & enough[product]
+            low, high = flagged & (prices < low_fence[product]), flagged & (prices > high_fence[product])
+            rows = np.flatnonzero(priced)[low | high]
+            outliers = df.iloc[rows][PRICE_OUTLIER_COLUMNS].reset_index(drop=True)
+            outliers['DonGiaVND'] = prices[low | high]
+            outliers['DonGiaTrungViNhom'] = median[product[low | high]]
+            outliers['CanhBao'] = np.where(low[low | high], "Đơn giá thấp bất thường", "Đơn giá cao bất thường")
+            found.append(outliers)
+        outliers = pd.concat(found, ignore_index=True) if found else pd.DataFrame(
+            columns=PRICE_OUTLIER_COLUMNS + ['DonGiaVND', 'DonGiaTrungViNhom', 'CanhBao'])
+        outliers.insert(len(outliers.columns) - 1, 'TyLeSoVoiTrungVi',
+                        outliers['DonGiaVND'] / outliers['DonGiaTrungViNhom'])
+        return outliers.sort_values('TyLeSoVoiTrungVi', kind='mergesort', ignore_index=True)
+
+    def results(self, frames=()):
+        return {'invoices': self.invoice_rollup(), 'tax_rates': self.tax_rates(), 'price_stats': self.price_stats(),
+                'price_outliers': self.price_outliers(frames)}
+
+
+def analyze_invoice_lines(df):
+    # Phân tích dòng hàng bảng kê chi tiết bằng groupby/bincount: cộng dòng thành hóa đơn, kiểm tra thuế suất,
+    # phân phối đơn giá theo (TenHangHoa, DonViTinh) và các dòng có đơn giá bất thường
+    analytics = InvoiceLineAccumulator()
+    analytics.add(df)
+    return analytics.results([df])
+
+
+def invoice_line_results(df, log=streamlit_log, analytics=None):
+    # analytics: kết quả InvoiceLineAccumulator.results() khi đã cộng dồn theo khối
+    analytics = analytics or analyze_invoice_lines(df)
+    bad_rates = analytics['tax_rates'].loc[analytics['tax_rates']['KiemTra'] != "Hợp lệ", 'SoDong'].sum()
+    if bad_rates:
+        log('warning', f"Có {bad_rates:,} dòng hàng ghi thuế suất không thuộc các mức "
+                       f"{', '.join(f'{rate:.0%}' for rate in VAT_RATES)}.")
+    if not analytics['price_outliers'].empty:
+        log('warning', f"Có {len(analytics['price_outliers']):,} dòng hàng có đơn giá bất thường so với "
+                       f"các lần bán cùng mặt hàng.")
+    return {"invoice_rollup_df": analytics['invoices'], "tax_rate_df": analytics['tax_rates'],
+            "price_stats_df": analytics['price_stats'], "price_outliers_df": analytics['price_outliers']}
+
+
+# --- DẤU HIỆU BẤT THƯỜNG THỐNG KÊ TRÊN SỐ TIỀN HÓA ĐƠN ---
+# Benford chữ số đầu: độ lệch tuyệt đối trung bình (MAD) > 0.015 là không phù hợp (ngưỡng của Nigrini)
+BENFORD_MIN_INVOICES = 300
+BENFORD_MAD_LIMIT = 0.015
+# Ngưỡng số tiền thanh toán (VND): từ 20 triệu đồng phải thanh toán không dùng tiền mặt mới được khấu trừ thuế.
+# So số hóa đơn trong dải [90%, 100%) ngưỡng với dải [100%, 110%) ngưỡng.
+INVOICE_REPORTING_THRESHOLDS = (20_000_000,)
+THRESHOLD_BAND = 0.1
+THRESHOLD_MIN_INVOICES = 20
+THRESHOLD_RATIO_LIMIT = 2.0
+# Dồn hóa đơn cuối kỳ: số hóa đơn trong PERIOD_END_DAYS ngày cuối tháng so với mức bình quân ngày của tháng
+PERIOD_END_DAYS = 3
+PERIOD_END_MIN_INVOICES = 20
+PERIOD_END_RATIO_LIMIT = 3.0
+# Số tròn: tỷ lệ hóa đơn (từ ROUND_AMOUNT_UNIT trở lên) có tiền chưa thuế chia hết cho ROUND_AMOUNT_UNIT
+ROUND_AMOUNT_UNIT = 1_000_000
+ROUND_AMOUNT_MIN_INVOICES = 50
+ROUND_AMOUNT_SHARE_LIMIT = 0.2
+BENFORD_EXPECTED = np.log10(1 + 1 / np.arange(1, 10))
+
+
+def _benford(digits):
+    # digits: số hóa đơn (từ 10 đồng) theo chữ số đầu 1..9
+    count = int(digits.sum())
+    if count < BENFORD_MIN_INVOICES:
+        return np.nan, np.nan, np.nan, count
+    observed = digits / count
+    deviation = observed - BENFORD_EXPECTED
+    digit = int(np.argmax(deviation))
+    return np.abs(deviation).mean(), digit + 1, observed[digit], count
+
+
+def _under_threshold(bands):
+    # bands: (dải dưới, dải trên) của từng ngưỡng -> (tỷ số dải dưới/dải trên lớn nhất qua các ngưỡng,
+    # số hóa đơn dải dưới tương ứng)
+    best_ratio, best_count = np.nan, 0
+    for below, above in bands:
+        if below + above < THRESHOLD_MIN_INVOICES:
+            continue
+        ratio = below / max(above, 1)
+        if np.isnan(best_ratio) or ratio > best_ratio:
+            best_ratio, best_count = ratio, below
+    return best_ratio, best_count
+
+
+def _period_end_bursts(daily_counts):
+    # Số hóa đơn theo ngày -> tổng trượt PERIOD_END_DAYS ngày; tại ngày cuối tháng so với mức kỳ vọng theo
+    # bình quân ngày của phần còn lại của tháng (không để chính đợt dồn kéo mức kỳ vọng lên). Trả về bảng theo tháng.
+    if daily_counts.empty:
+        return pd.DataFrame(columns=['Thang', 'SoHoaDon', 'CuoiThang', 'TyLe'])
+    days = daily_counts.index.to_numpy().astype('datetime64[D]')
+    start = days.min().astype('datetime64[M]').astype('datetime64[D]')
+    end = (days.max().astype('datetime64[M]') + 1).astype('datetime64[D]')
+    length = int((end - start).astype(np.int64))
+    daily = pd.Series(np.zeros(length, dtype=np.int64), index=pd.date_range(start, periods=length, freq='D'))
+    daily.iloc[(days - start).astype(np.int64)] = daily_counts.to_numpy()
+    window = daily.rolling(PERIOD_END_DAYS, min_periods=1).sum()
+    months = daily.groupby(daily.index.to_period('M'))
+    month_end = window[daily.index.is_month_end].to_numpy()
+    totals = months.sum().to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = month_end / ((totals - month_end) * PERIOD_END_DAYS / (months.size().to_numpy() - PERIOD_END_DAYS))
+    return pd.DataFrame({'Thang': months.sum().index.astype(str), 'SoHoaDon': totals, 'CuoiThang': month_end,
+                         'TyLe': ratio})
+
+
+def invoice_anomaly_counts(dates, pre_tax, payments):
+    # Bảng đếm cộng được qua các khối của bảng kê: chữ số đầu, dải quanh ngưỡng thanh toán, số hóa đơn theo ngày,
+    # số hóa đơn lớn/số tiền tròn
+    pre_tax = np.asarray(pre_tax, dtype=np.float64)
+    payments = np.asarray(payments, dtype=np.float64)
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    amounts = pre_tax[pre_tax >= 10]
+    first_digit = (amounts / 10 ** np.floor(np.log10(amounts))).astype(np.int64)
+    large = pre_tax[pre_tax >= ROUND_AMOUNT_UNIT]
+    return {
+        'so_hd': len(pre_tax),
+        'chu_so': np.bincount(np.clip(first_digit, 1, 9), minlength=10)[1:],
+        'dai_nguong': np.array([np.histogram(payments, bins=[threshold * (1 - THRESHOLD_BAND), threshold,
+                                                             threshold * (1 + THRESHOLD_BAND)])[0]
+                                for threshold in INVOICE_REPORTING_THRESHOLDS]).reshape(-1, 2),
+        'theo_ngay': pd.Series(dates[~np.isnat(dates)].astype('datetime64[D]')).value_counts(),
+        'so_lon': len(large),
+        'so_tron': int((np.mod(large, ROUND_AMOUNT_UNIT) == 0).sum()),
+    }
+
+
+def merge_anomaly_counts(parts):
+    parts = list(parts)
+    if not parts:
+        return invoice_anomaly_counts([], [], [])
+    merged = {key: sum(part[key] for part in parts) for key in ('so_hd', 'chu_so', 'dai_nguong', 'so_lon', 'so_tron')}
+    merged['theo_ngay'] = pd.concat([part['theo_ngay'] for part in parts]).groupby(level=0).sum()
+    return merged
+
+
+def invoice_anomalies(dates=None, pre_tax=None, payments=None, counts=None):
+    # Các chỉ số bất thường trên tập hóa đơn (mỗi dòng một hóa đơn, tiền VND) hoặc trên bảng đếm đã cộng dồn
+    # (counts): trả về (chỉ tiêu cho quy tắc rủi ro, bảng diễn giải)
+    if counts is None:
+        counts = invoice_anomaly_counts(dates, pre_tax, payments)
+    mad, digit, digit_share, benford_n = _benford(counts['chu_so'])
+    under_ratio, under_count = _under_threshold(counts['dai_nguong'])
+    bursts = _period_end_bursts(counts['theo_ngay'])
+    burst = (bursts['CuoiThang'] >= PERIOD_END_MIN_INVOICES) & (bursts['TyLe'] >= PERIOD_END_RATIO_LIMIT)
+    large = counts['so_lon']
+    round_share = counts['so_tron'] / large if large >= ROUND_AMOUNT_MIN_INVOICES else np.nan
+
+    summary = {
+        'so_hd': counts['so_hd'],
+        'benford_mad': mad, 'benford_chu_so': digit, 'benford_ty_le': digit_share,
+        'duoi_nguong_ty_le': under_ratio, 'duoi_nguong_so_hd': under_count,
+        'cuoi_ky_so_thang': int(burst.sum()),
+        'cuoi_ky_ty_le': bursts['TyLe'].where(bursts['CuoiThang'] >= PERIOD_END_MIN_INVOICES).max(),
+        'so_tron_ty_le': round_share,
+    }
+    table = pd.DataFrame([
+        {'Kiểm tra': "Phân phối chữ số đầu (Benford)", 'Chỉ số': mad, 'Ngưỡng': BENFORD_MAD_LIMIT,
+         'Cỡ mẫu': benford_n, 'Diễn giải': f"Chữ số {digit:.0f} chiếm {digit_share:.1%} (kỳ vọng "
+                                          f"{BENFORD_EXPECTED[int(digit) - 1]:.1%})" if not np.isnan(mad) else
+         f"Cần tối thiểu {BENFORD_MIN_INVOICES} hóa đơn"},
+        {'Kiểm tra': "Hóa đơn sát dưới ngưỡng thanh toán", 'Chỉ số': under_ratio, 'Ngưỡng': THRESHOLD_RATIO_LIMIT,
+         'Cỡ mẫu': under_count, 'Diễn giải': "Số hóa đơn dải dưới ngưỡng / dải trên ngưỡng "
+                                            f"({', '.join(f'{t:,.0f}' for t in INVOICE_REPORTING_THRESHOLDS)} đồng)"},
+        {'Kiểm tra': "Dồn hóa đơn cuối tháng", 'Chỉ số': summary['cuoi_ky_ty_le'], 'Ngưỡng': PERIOD_END_RATIO_LIMIT,
+         'Cỡ mẫu': int(burst.sum()), 'Diễn giải': "Tháng bất thường: " + (
+             ", ".join(bursts.loc[burst, 'Thang']) or "không có")},
+        {'Kiểm tra': "Số tiền tròn", 'Chỉ số': round_share, 'Ngưỡng': ROUND_AMOUNT_SHARE_LIMIT, 'Cỡ mẫu': large,
+         'Diễn giải': f"Tỷ lệ hóa đơn chia hết cho {ROUND_AMOUNT_UNIT:,.0f} đồng"},
+    ])
+    return summary, table
+
+
+def _invoice_anomaly_counts(invoices):
+    return invoice_anomaly_counts(invoices['NgayLap'].to_numpy(), invoices['ChuaThue'].to_numpy(),
+                                  invoices['ChuaThue'].to_numpy() + invoices['Thue'].to_numpy())
+
+
+def invoice_anomaly_results(invoices, label, log=streamlit_log, counts=None):
+    # invoices: mỗi dòng một hóa đơn hợp lệ với NgayLap, ChuaThue, Thue (VND); hoặc counts: bảng đếm đã cộng dồn
+    # theo khối (merge_anomaly_counts)
+    summary, table = invoice_anomalies(counts=_invoice_anomaly_counts(invoices) if counts is None else counts)
+    flagged = table.loc[table['Chỉ số'] > table['Ngưỡng'], 'Kiểm tra']
+    if not flagged.empty:
+        log('warning', f"Bảng kê {label} có dấu hiệu bất thường: {', '.join(flagged)}.")
+    return {"anomaly_summary": summary, "anomaly_df": table}
+
+
+def _rollup_anomaly_results(invoices, log=streamlit_log):
+    # Bảng kê chi tiết: xét bất thường trên hóa đơn đã cộng từ dòng hàng (chỉ hóa đơn hợp lệ)
+    invoices = invoices[invoices['TrangThaiHoaDon'].isin(VALID_INVOICE_STATUSES)]
+    return invoice_anomaly_results(pd.DataFrame({'NgayLap': invoices['NgayLap'], 'ChuaThue': invoices['TienChuaThue'],
+                                                 'Thue': invoices['TienThue']}), "hóa đơn bán ra", log)
+
+
+def process_summary_invoice_data(uploaded_file, log=streamlit_log, stream=None):
+    if not uploaded_file:
+        return None
+    try:
+        log('write', "Đang xử lý file Bảng kê hóa đơn tổng hợp...")
+        if _should_stream(uploaded_file, stream):
+            # Bất thường cộng dồn bảng đếm theo từng khối đọc
+            counts = []
+            result = stream_invoice_csv(uploaded_file, 'summary', log=log, consumers=[
+                lambda chunk: counts.append(_invoice_anomaly_counts(invoice_amount_frame(chunk)))])
+            result.update(invoice_anomaly_results(None, "hóa đơn bán ra", log, counts=merge_anomaly_counts(counts)))
+            return result
+        template, df = read_invoice_sheet(uploaded_file, ('summary',))
+        if template is None:
+            raise ValueError(invoice_template_error(uploaded_file, 'summary'))
+
+        money_cols = ['TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan']
+        invoices_for_summing = normalize_invoices(df, money_cols + ['TyGia'], money_cols)
+        summary = invoice_totals(invoices_for_summing, 'TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau',
+                                 'TongTienThanhToan')
+        anomalies = invoice_anomaly_results(invoice_amounts({'full_df': df}), "hóa đơn bán ra", log)
+
+        df = compact_invoice_frame(df, "hóa đơn tổng hợp", log)
+        log('success', "Xử lý Bảng kê hóa đơn tổng hợp hoàn tất!")
         return {
             "valid_summary": summary,
-            "full_df": df
+            "full_df": df,
+            **anomalies
         }
     except Exception as e:
-        st.error(f"Lỗi khi xử lý file hóa đơn tổng hợp: {e}")
+        log('error', f"Lỗi khi xử lý file hóa đơn tổng hợp: {e}")
         return None
 
 
-def process_detailed_invoice_data(uploaded_file):
+def process_detailed_invoice_data(uploaded_file, log=streamlit_log, stream=None):
     if not uploaded_file:
         return None
     try:
-        st.write("Đang xử lý file Bảng kê hóa đơn chi tiết...")
-        if uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_file)
-        else:
-            df = pd.read_excel(uploaded_file)
-
-        df.columns = [
-            'KyHieu', 'SoHoaDon', 'NgayLap', 'TenNguoiMua', 'MSTNguoiMua', 'TinhChat',
-            'TenHangHoa', 'DonViTinh', 'SoLuong', 'DonGia', 'TienChietKhau', 'EmptyCol',
-            'ThanhTien', 'ThueSuat', 'DonViTienTe', 'TyGia', 'TrangThaiHoaDon',
-            'HD_LienQuan', 'Ngay_HD_LienQuan', 'DonViCungCap'
-        ]
-        df = df.drop(columns=['EmptyCol'])
-
-        numeric_cols = ['SoLuong', 'DonGia', 'TienChietKhau', 'ThanhTien', 'ThueSuat', 'TyGia']
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-        df['NgayLap'] = pd.to_datetime(df['NgayLap'], errors='coerce')
-
-        df['ThanhTien_TinhToan'] = df['SoLuong'] * df['DonGia']
-        mismatched_invoices = df[abs(df['ThanhTien'] - df['ThanhTien_TinhToan']) > 0.01].copy()
-        mismatched_invoices = mismatched_invoices[
-            ['SoHoaDon', 'NgayLap', 'TenHangHoa', 'SoLuong', 'DonGia', 'ThanhTien', 'ThanhTien_TinhToan']]
-
-        statuses_to_sum = ['Hóa đơn mới', 'Hóa đơn thay thế', 'Hóa đơn điều chỉnh', 'Hóa đơn đã bị điều chỉnh']
-        invoices_for_summing = df[df['TrangThaiHoaDon'].isin(statuses_to_sum)].copy()
-
-        invoices_for_summing['TienChuaThue'] = invoices_for_summing['ThanhTien'] - invoices_for_summing['TienChietKhau']
-        invoices_for_summing['TienThue'] = invoices_for_summing['TienChuaThue'] * invoices_for_summing['ThueSuat']
-
-        for col in ['TienChuaThue', 'TienThue', 'TienChietKhau']:
-            invoices_for_summing.loc[:, col] = invoices_for_summing.apply(
-                lambda row: row[col] * row['TyGia'] if row['DonViTienTe'] != 'VND' else row[col],
-                axis=1
-            )
-
-        total_pre_tax = invoices_for_summing['TienChuaThue'].sum()
-        total_tax = invoices_for_summing['TienThue'].sum()
-        total_discount = invoices_for_summing['TienChietKhau'].sum()
-        total_payment = total_pre_tax + total_tax
-
-        summary = {
-            'total_pre_tax': total_pre_tax,
-            'total_tax': total_tax,
-            'total_discount': total_discount,
-            'total_payment': total_payment
-        }
-
-        st.success("Xử lý Bảng kê hóa đơn chi tiết hoàn tất!")
+        log('write', "Đang xử lý file Bảng kê hóa đơn chi tiết...")
+        if _should_stream(uploaded_file, stream):
+            # Chuỗi thay thế và hóa đơn nhiều dòng có thể vắt qua các khối: cộng dồn theo hóa đơn khi đọc từng khối
+            chains, lines = invoice_chain_accumulator(), InvoiceLineAccumulator()
+            result = stream_invoice_csv(uploaded_file, 'detailed', log=log, consumers=[chains.add, lines.add])
+            result.update(invoice_chain_results(None, result['valid_summary'], log, invoices=chains.frame()))
+            # Đơn giá bất thường so với phân phối cả kỳ: lượt thứ hai đọc tệp Parquet theo từng nhóm dòng
+            spill = spill_batches(result['spill_path'], PRICE_OUTLIER_SPILL_COLUMNS) if result['spill_path'] else ()
+            result.update(invoice_line_results(None, log, analytics=lines.results(spill)))
+            result.update(_rollup_anomaly_results(result['invoice_rollup_df'], log))
+            return result
+        template, df = read_invoice_sheet(uploaded_file, ('detailed',))
+        if template is None:
+            raise ValueError(invoice_template_error(uploaded_file, 'detailed'))
+
+        df = _prepare_detailed_invoices(df)
+        mismatched_invoices = _detailed_invoice_mismatches(df)
+        invoices_for_summing = filter_invoice_status(_detailed_invoice_amounts(df))
+        summary = invoice_totals(invoices_for_summing, 'TienChuaThue', 'TienThue', 'TienChietKhau')
+
+        chain_results = invoice_chain_results(df, summary, log)
+        line_results = invoice_line_results(df, log)
+        anomalies = _rollup_anomaly_results(line_results['invoice_rollup_df'], log)
+        df = compact_invoice_frame(df, "hóa đơn chi tiết", log)
+        log('success', "Xử lý Bảng kê hóa đơn chi tiết hoàn tất!")
         return {
             "valid_summary": summary,
             "mismatch_df": mismatched_invoices,
-            "full_df": df
+            "full_df": df,
+            **chain_results,
+            **line_results,
+            **anomalies
         }
     except Exception as e:
-        st.error(f"Lỗi khi xử lý file hóa đơn chi tiết: {e}")
+        log('error', f"Lỗi khi xử lý file hóa đơn chi tiết: {e}")
         return None
 
 
-def process_input_invoice_data(uploaded_files):
+INPUT_INVOICE_MONEY_COLS = ['TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan']
+
+
+def _input_invoice_source(uploaded_file):
+    # Tệp tải lên không gửi được sang tiến trình con: gửi (tên, nội dung); đường dẫn gửi nguyên
+    if hasattr(uploaded_file, 'getvalue'):
+        return _file_name(uploaded_file), uploaded_file.getvalue()
+    return uploaded_file
+
+
+def _read_input_invoice_task(source, digest=None):
+    # Chạy trong tiến trình con: đọc, nhận diện mẫu và ép kiểu một tệp bảng kê đầu vào
+    started = time.perf_counter()
+    if isinstance(source, tuple):
+        uploaded_file = io.BytesIO(source[1])
+        uploaded_file.name = source[0]
+    else:
+        uploaded_file = source
+    template, df = read_invoice_sheet(uploaded_file, INPUT_INVOICE_TEMPLATES, digest=digest)
+    if template is not None:
+        coerce_numeric(df, INPUT_INVOICE_MONEY_COLS + ['TyGia'])
+        if 'NgayLap' in df.columns:
+            df['NgayLap'] = pd.to_datetime(df['NgayLap'], errors='coerce', dayfirst=True)
+    return template, df, time.perf_counter() - started
+
+
+def read_input_invoice_files(uploaded_files, max_workers=None, digests=None):
+    # Đọc nhiều tệp bảng kê đầu vào song song bằng process pool; trả về [(mẫu, DataFrame, số giây)] theo thứ tự tệp
+    # Tệp đã có trong bộ đệm Parquet đọc ngay tại tiến trình chính, chỉ tệp còn lại mới cần process pool.
+    # Mỗi tệp chỉ băm một lần (digests: SHA-256 đã tính sẵn theo thứ tự tệp), mã băm được chuyển xuống nơi đọc.
+    if digests is None:
+        digests = [file_digest(f) if _is_excel(f) else None for f in uploaded_files]
+    outcomes = [_read_input_invoice_task(f, digest) if _invoice_sheet_cached(f, INPUT_INVOICE_TEMPLATES, digest)
+                else None for f, digest in zip(uploaded_files, digests)]
+    pending = [i for i, outcome in enumerate(outcomes) if outcome is None]
+    sources = [_input_invoice_source(uploaded_files[i]) for i in pending]
+    pending_digests = [digests[i] for i in pending]
+    max_workers = max_workers or INVOICE_READ_WORKERS or os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(pending)))
+
+    parsed = None
+    if max_workers > 1:
+        parsed = map_in_processes(_read_input_invoice_task, sources, pending_digests, max_workers=max_workers)
+    if parsed is None:  # Môi trường không cho tạo tiến trình con: đọc tuần tự
+        parsed = [_read_input_invoice_task(source, digest) for source, digest in zip(sources, pending_digests)]
+    for i, outcome in zip(pending, parsed):
+        outcomes[i] = outcome
+    return outcomes
+
+
+def process_input_invoice_data(uploaded_files, log=streamlit_log, max_workers=None, digests=None):
     if not uploaded_files:
         return None
 
     all_dfs = []
+    file_stats = []
     try:
-        st.write(f"Đang xử lý {len(uploaded_files)} file Bảng kê hóa đơn đầu vào...")
-        for uploaded_file in uploaded_files:
-            if uploaded_file.name.endswith('.csv'):
-                df = pd.read_csv(uploaded_file, skiprows=5, header=None)
-            else:
-                df = pd.read_excel(uploaded_file, skiprows=5, header=None)
-
-            if len(df.columns) >= 21:
-                st.info(f"Đã nhận diện file '{uploaded_file.name}' là mẫu đầu vào loại 1 (data-1).")
-                df.columns = [
-                                 'STT', 'KyHieuMauSo', 'KyHieuHoaDon', 'SoHoaDon', 'NgayLap', 'MSTNguoiBan',
-                                 'TenNguoiBan', 'DiaChiNguoiBan',
-                                 'MSTNguoiMua', 'TenNguoiMua', 'CCCD', 'MaSothueCCGiaiPhap', 'MaSoThueTruyenNhan',
-                                 'TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan',
-                                 'TrangThaiHoaDon', 'KetQuaKiemTra', 'Col1', 'Col2'
-                             ][:len(df.columns)]
-                df = df.drop(columns=['Col1', 'Col2', 'CCCD'], errors='ignore')
-            elif len(df.columns) >= 19:
-                st.info(f"Đã nhận diện file '{uploaded_file.name}' là mẫu đầu vào loại 2 (mtt1).")
-                df.columns = [
-                                 'STT', 'KyHieuMauSo', 'KyHieuHoaDon', 'SoHoaDon', 'NgayLap', 'MSTNguoiBan',
-                                 'TenNguoiBan', 'DiaChiNguoiBan',
-                                 'MSTNguoiMua', 'TenNguoiMua', 'CCCD', 'MaSothueCCGiaiPhap', 'MaSoThueTruyenNhan',
-                                 'TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan',
-                                 'TrangThaiHoaDon', 'KetQuaKiemTra'
-                             ][:len(df.columns)]
-                df = df.drop(columns=['CCCD'], errors='ignore')
-            else:
-                st.warning(f"Không thể nhận diện mẫu cho file '{uploaded_file.name}'. Bỏ qua file này.")
+        log('write', f"Đang xử lý {len(uploaded_files)} file Bảng kê hóa đơn đầu vào...")
+        outcomes = read_input_invoice_files(uploaded_files, max_workers, digests)
+        for uploaded_file, (template, df, seconds) in zip(uploaded_files, outcomes):
+            if template is None:
+                log('warning', f"Không thể nhận diện mẫu cho file '{_file_name(uploaded_file)}'. Bỏ qua file này.")
                 continue
-
+            label = INVOICE_TEMPLATES[template]['label']
+            log('info', f"Đã nhận diện file '{_file_name(uploaded_file)}' là {label} "
+                        f"({len(df):,} dòng, {seconds:.2f}s).")
+            file_stats.append({'Tệp': _file_name(uploaded_file), 'Mẫu': label, 'Số dòng': len(df),
+                               'Thời gian đọc (s)': round(seconds, 3)})
             all_dfs.append(df)
 
         if not all_dfs:
-            st.error("Không có file hóa đơn đầu vào hợp lệ nào được xử lý.")
+            log('error', "Không có file hóa đơn đầu vào hợp lệ nào được xử lý.")
             return None
 
+        # Nối một lần: pandas cấp phát sẵn mỗi cột đủ tổng số dòng rồi chép từng tệp vào
         final_df = pd.concat(all_dfs, ignore_index=True)
 
-        numeric_cols = ['TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau', 'TongTienThanhToan']
-        for col in numeric_cols:
-            if col in final_df.columns:
-                final_df[col] = pd.to_numeric(final_df[col], errors='coerce').fillna(0)
-
-        if 'NgayLap' in final_df.columns:
-            final_df['NgayLap'] = pd.to_datetime(final_df['NgayLap'], errors='coerce', dayfirst=True)
+        money_cols = INPUT_INVOICE_MONEY_COLS
+        # Bảng kê đầu vào trước nay cộng mọi dòng; chỉ quy đổi ngoại tệ khi mẫu có cột DonViTienTe/TyGia
+        invoices_for_summing = normalize_invoices(final_df, money_cols + ['TyGia'], money_cols, statuses=None)
 
-        total_pre_tax = final_df['TongTienChuaThue'].sum()
-        total_tax = final_df['TongTienThue'].sum()
-        total_discount = final_df['TongTienChietKhau'].sum()
-        total_payment = final_df['TongTienThanhToan'].sum()
+        summary = invoice_totals(invoices_for_summing, 'TongTienChuaThue', 'TongTienThue', 'TongTienChietKhau',
+                                 'TongTienThanhToan')
+        anomalies = invoice_anomaly_results(invoice_amounts({'full_df': final_df}, statuses=None), "hóa đơn mua vào",
+                                            log)
 
-        summary = {
-            'total_pre_tax': total_pre_tax,
-            'total_tax': total_tax,
-            'total_discount': total_discount,
-            'total_payment': total_payment
-        }
-
-        st.success("Xử lý Bảng kê hóa đơn đầu vào hoàn tất!")
+        final_df = compact_invoice_frame(final_df, "hóa đơn đầu vào", log)
+        log('success', "Xử lý Bảng kê hóa đơn đầu vào hoàn tất!")
         return {
             "valid_summary": summary,
-            "full_df": final_df
+            "full_df": final_df,
+            "file_stats": pd.DataFrame(file_stats),
+            **anomalies
         }
     except Exception as e:
-        st.error(f"Lỗi khi xử lý file hóa đơn đầu vào: {e}")
+        log('error', f"Lỗi khi xử lý file hóa đơn đầu vào: {e}")
         return None
 
 
-def process_financial_notes(uploaded_file):
+def process_financial_notes(uploaded_file, log=streamlit_log):
     if not uploaded_file:
         return None
-    st.write("Đang xử lý file Thuyết minh BCTC...")
+    log('write', "Đang xử lý file Thuyết minh BCTC...")
     content = ""
     try:
-        if uploaded_file.name.endswith('.docx'):
+        if _file_name(uploaded_file).endswith('.docx'):
             doc = Document(uploaded_file)
             for para in doc.paragraphs:
                 content += para.text + '\n'
-            st.success("Trích xuất nội dung từ file .docx thành công!")
-        elif uploaded_file.name.endswith('.pdf'):
+            log('success', "Trích xuất nội dung từ file .docx thành công!")
+        elif _file_name(uploaded_file).endswith('.pdf'):
             content = "Chức năng đọc file PDF sẽ được phát triển trong các phiên bản sau."
-            st.info(content)
-        elif uploaded_file.name.endswith(('.xlsx', '.xls')):
+            log('info', content)
+        elif _file_name(uploaded_file).endswith(('.xlsx', '.xls')):
             content = "Chức năng đọc file Excel cho Thuyết minh BCTC sẽ được phát triển trong các phiên bản sau."
-            st.info(content)
+            log('info', content)
         else:
             content = "Định dạng file này chưa được hỗ trợ để trích xuất nội dung."
-            st.warning(content)
+            log('warning', content)
         return content
     except Exception as e:
-        st.error(f"Lỗi khi xử lý file Thuyết minh BCTC: {e}")
+        log('error', f"Lỗi khi xử lý file Thuyết minh BCTC: {e}")
         return None
 
 
 # --- MODULE 2 & 3: PHÂN TÍCH DỮ LIỆU & RỦI RO ---
-def parse_and_analyze(files, accounting_standard, output_invoice_data, input_invoice_data, notes_content):
-    st.write("Đang xử lý, bóc tách và tổng hợp dữ liệu...")
-    all_declarations = []
-    st.session_state['tndn_main_df'] = pd.DataFrame()
-    st.session_state['tndn_appendix_df'] = pd.DataFrame()
-    st.session_state['gtgt_detailed_df'] = pd.DataFrame()
-
-    for file_path in files:
-        data = parse_xml_data(file_path)
-        # === GỠ LỖI: HIỂN THỊ DỮ LIỆU THÔ ĐÃ BÓC TÁCH ===
-        st.subheader(f"Dữ liệu thô từ file: {os.path.basename(file_path)}")
-        st.json(data)
-        # ===============================================
+def file_digest(file):
+    # SHA-256 nội dung tệp: nhận đường dẫn hoặc tệp tải lên của Streamlit
+    digest = hashlib.sha256()
+    if hasattr(file, 'getbuffer'):
+        digest.update(file.getbuffer())
+        return digest.hexdigest()
+    try:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def files_fingerprint(files):
+    if not files: return None
+    files = files if isinstance(files, (list, tuple)) else [files]
+    return tuple((_file_name(f), file_digest(f)) for f in files)
+
+
+class StageCache:
+    # Kết quả của từng bước trong quy trình kèm dấu vân tay đầu vào; bước có đầu vào không đổi được dùng lại.
+    # Lưu trong st.session_state nên tồn tại qua các lần bấm "Bắt đầu".
+    def __init__(self):
+        self._stages = {}
+
+    def fingerprint(self, stage):
+        entry = self._stages.get(stage)
+        return entry[0] if entry else None
+
+    def get(self, stage, default=None):
+        entry = self._stages.get(stage)
+        return entry[1] if entry else default
+
+    def run(self, stage, fingerprint, compute):
+        # Trả về (kết quả, đã_tính_lại)
+        entry = self._stages.get(stage)
+        if entry is not None and entry[0] == fingerprint:
+            return entry[1], False
+        value = compute()
+        self._stages[stage] = (fingerprint, value)
+        return value, True
+
+
+# Nguồn chỉ tiêu của bộ quy tắc rủi ro phụ thuộc vào từng đầu vào
+STAGE_INDICATOR_SOURCES = {
+    'xml': tuple(INDICATOR_SOURCES),
+    'output_invoice': ('hd_ra', 'hd_ra_bt'),
+    'input_invoice': ('hd_vao', 'hd_vao_bt'),
+}
+
+
+def _invoice_fingerprint(invoice_data):
+    # Quy tắc rủi ro chỉ dùng các bảng tổng hợp của bảng kê nên đó là dấu vân tay đủ dùng cho bước rà soát
+    if not invoice_data: return None
+    # (chỉ số bất thường có thể là NaN khi mẫu quá nhỏ: đổi thành None để so sánh bằng được)
+    return tuple((summary_key, key, None if pd.isna(value) else float(value))
+                 for summary_key in ('valid_summary', 'anomaly_summary')
+                 for key, value in sorted(invoice_data.get(summary_key, {}).items()))
+
+
+def _parse_declarations(files, parse_workers):
+    parsed_files, parse_errors = parse_xml_files(files, max_workers=parse_workers, cache=get_parse_cache())
+    registry = DeclarationRegistry()
+    for file_path, data in parsed_files:
         if not data: continue
-        ma_tk = data.get('maTKhai')
-        loai_tk_code = MA_TK_MAP.get(ma_tk)
-        ky = data.get('kyKKhai') or "Không xác định"
+        loai_tk_code = MA_TK_MAP.get(data.ma_tkhai)
+        ky = data.ky_kkhai or "Không xác định"
         if loai_tk_code:
-            all_declarations.append(
-                {'loai_tk': loai_tk_code, 'ky': ky, 'data': data, 'filename': os.path.basename(file_path)})
-            if loai_tk_code == '03/TNDN':
-                st.session_state['tndn_main_df'] = generate_tndn_main_form_df(data)
-                st.session_state['tndn_appendix_df'] = generate_tndn_appendix_03_1a_df(data)
-            elif loai_tk_code == '01/GTGT':
-                st.session_state['gtgt_detailed_df'] = generate_gtgt_detailed_df(all_declarations)
+            registry.add({'loai_tk': loai_tk_code, 'ky': ky, 'data': data, 'filename': os.path.basename(file_path)})
+    return {'declarations': registry, 'parsed_files': parsed_files, 'parse_errors': parse_errors}
+
+
+def _build_frames(all_declarations):
+    frames = {'tndn_main_df': pd.DataFrame(), 'tndn_appendix_df': pd.DataFrame()}
+    tndn_decl = all_declarations.latest('03/TNDN')
+    if tndn_decl:
+        tndn_frames = build_report_frames(tndn_decl['data'])
+        frames['tndn_main_df'] = tndn_frames['tndn_main']
+        frames['tndn_appendix_df'] = tndn_frames['tndn_appendix_03_1a']
+    bctc_decl = all_declarations.latest('BCTC')
+    bctc_frames = build_report_frames(bctc_decl['data']) if bctc_decl else {}
+
+    frames['gtgt_summary_df'] = generate_gtgt_summary(all_declarations)
+    frames['gtgt_detailed_df'] = generate_gtgt_detailed_df(all_declarations)
+    frames['balance_sheet_df'] = bctc_frames.get('balance_sheet', pd.DataFrame())
+    frames['income_statement_df'] = bctc_frames.get('income_statement', pd.DataFrame())
+    frames['trial_balance_df'] = generate_trial_balance_df(all_declarations)
+    frames['trial_balance_check_df'] = generate_trial_balance_check_df(all_declarations)
+    frames['tndn_summary_df'] = generate_tndn_summary(all_declarations)
+    frames['tncn_qtt_summary_df'], frames['tncn_details_df'] = generate_tncn_summary(all_declarations)
+    frames['tncn_kk_summary_df'] = generate_tncn_kk_summary(all_declarations)
+    frames['period_chain_df'] = generate_period_chain_df(all_declarations)
+    return frames
+
+
+def _invoice_stage_fingerprint(stages, stage, invoice_data):
+    # Dấu vân tay tệp bảng kê của bước đọc bảng kê; dữ liệu không qua bước đó thì không so được (luôn tính lại)
+    if not invoice_data:
+        return None
+    fingerprint = stages.fingerprint(stage)
+    return fingerprint if fingerprint is not None else object()
+
+
+def _run_risk_stage(stages, all_declarations, accounting_standard, output_invoice_data, input_invoice_data):
+    # Rà soát rủi ro tăng dần: chỉ đánh giá lại các quy tắc phụ thuộc vào đầu vào/chế độ kế toán đã thay đổi
+    compiled = get_compiled_risk_rules()
+    inputs = {'xml': stages.fingerprint('xml'), 'output_invoice': _invoice_fingerprint(output_invoice_data),
+              'input_invoice': _invoice_fingerprint(input_invoice_data)}
+    previous = stages.get('risk')
+
+    def evaluate():
+        if previous is None:
+            values, present = compiled.fetch(risk_dossier(all_declarations, output_invoice_data, input_invoice_data))
+            return {'inputs': inputs, 'standard': accounting_standard, 'values': values, 'present': present,
+                    'outcomes': compiled.evaluate(values, present, accounting_standard)}
+        changed_sources = [source for stage, sources in STAGE_INDICATOR_SOURCES.items()
+                           if inputs[stage] != previous['inputs'][stage] for source in sources]
+        if changed_sources:
+            values, present = compiled.fetch(risk_dossier(all_declarations, output_invoice_data, input_invoice_data))
+        else:
+            values, present = previous['values'], previous['present']
+        only = set(compiled.affected_by(changed_sources, accounting_standard != previous['standard']))
+        return {'inputs': inputs, 'standard': accounting_standard, 'values': values, 'present': present,
+                'outcomes': compiled.evaluate(values, present, accounting_standard, only=only,
+                                              previous=previous['outcomes'])}
+
+    state, _ = stages.run('risk', (tuple(inputs.items()), accounting_standard), evaluate)
+    return compiled.results(state['outcomes'])
+
+
+def run_analysis_pipeline(files, accounting_standard, output_invoice_data, input_invoice_data, notes_content,
+                          parse_workers=None, log=streamlit_log, stages=None):
+    # Lõi phân tích không phụ thuộc Streamlit: bóc tách XML, dựng bảng tổng hợp và chạy rà soát rủi ro.
+    # stages (StageCache): dùng lại kết quả các bước có đầu vào không đổi so với lần chạy trước.
+    log('write', "Đang xử lý, bóc tách và tổng hợp dữ liệu...")
+    stages = stages if stages is not None else StageCache()
+    results = {
+        'declarations': DeclarationRegistry(), 'parsed_files': [], 'all_checks': [],
+        'gtgt_summary_df': pd.DataFrame(), 'gtgt_detailed_df': pd.DataFrame(),
+        'balance_sheet_df': pd.DataFrame(), 'income_statement_df': pd.DataFrame(),
+        'trial_balance_df': pd.DataFrame(), 'trial_balance_check_df': pd.DataFrame(),
+        'tndn_summary_df': pd.DataFrame(),
+        'tndn_main_df': pd.DataFrame(), 'tndn_appendix_df': pd.DataFrame(),
+        'tncn_qtt_summary_df': pd.DataFrame(), 'tncn_details_df': pd.DataFrame(),
+        'tncn_kk_summary_df': pd.DataFrame(), 'gtgt_reconciliation_df': pd.DataFrame(),
+        'period_chain_df': pd.DataFrame(),
+    }
+
+    xml_fingerprint = files_fingerprint(files)
+    parsed, reparsed = stages.run('xml', xml_fingerprint, lambda: _parse_declarations(files, parse_workers))
+    if not reparsed:
+        log('write', "Các tệp XML không thay đổi, dùng lại kết quả bóc tách lần trước.")
+    all_declarations = parsed['declarations']
+    results['declarations'] = all_declarations
+    results['parsed_files'] = parsed['parsed_files']
+    parse_errors = parsed['parse_errors']
+    if parse_errors:
+        log('error', f"Không đọc được {len(parse_errors)}/{len(parsed['parsed_files'])} tệp XML:\n\n" + "\n".join(
+            f"- {os.path.basename(file_path)}: {error}" for file_path, error in parse_errors))
+
+    if all_declarations.superseded:
+        log('info', "Đã bỏ qua các tờ khai bị thay thế bởi lần khai bổ sung mới hơn: " + ", ".join(
+            f"{d['filename']} ({d['loai_tk']} - {d['ky']})" for d in all_declarations.superseded))
 
     if not all_declarations and not output_invoice_data and not input_invoice_data and not notes_content:
-        st.warning("Không có dữ liệu nào được cung cấp để phân tích.")
-        return [], [], pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
-
-    gtgt_summary_df = generate_gtgt_summary(all_declarations)
-    gtgt_detailed_df = st.session_state.get('gtgt_detailed_df', pd.DataFrame())
-    balance_sheet_df = generate_balance_sheet_df(all_declarations)
-    income_statement_df = generate_income_statement_df(all_declarations)
-    trial_balance_df = generate_trial_balance_df(all_declarations)
-    tndn_summary_df = generate_tndn_summary(all_declarations)
-    tncn_qtt_summary_df, tncn_details_df = generate_tncn_summary(all_declarations)
-    tncn_kk_summary_df = generate_tncn_kk_summary(all_declarations)
+        log('warning', "Không có dữ liệu nào được cung cấp để phân tích.")
+        return results
+
+    frames, _ = stages.run('frames', xml_fingerprint, lambda: _build_frames(all_declarations))
+    results.update(frames)
+    trial_balance_check = results['trial_balance_check_df']
+    if not trial_balance_check.empty and (trial_balance_check['Trạng thái'] == "Lệch").any():
+        log('warning', f"Bảng cân đối tài khoản có {int((trial_balance_check['Trạng thái'] == 'Lệch').sum())} "
+                       "điểm lệch (Nợ/Có hoặc TK cha/TK con), xem bảng kiểm tra CĐTK.")
+    period_chain = results['period_chain_df']
+    if not period_chain.empty:
+        broken = period_chain[~period_chain['Trạng thái'].isin(["Khớp", "Kỳ đầu"])]
+        if not broken.empty:
+            log('warning', "Chuỗi kỳ kê khai bị đứt (thiếu/trùng kỳ hoặc lệch số chuyển kỳ) ở: " + ", ".join(
+                f"{row['Tờ khai']} {row['Kỳ']} ({row['Trạng thái']})" for _, row in broken.iterrows()))
+
+    # Bảng theo kỳ phụ thuộc cả phân bổ hóa đơn theo tháng chứ không chỉ tổng: lấy dấu vân tay tệp bảng kê
+    reconcile_fingerprint = (xml_fingerprint, _invoice_stage_fingerprint(stages, 'output_invoice', output_invoice_data),
+                             _invoice_stage_fingerprint(stages, 'input_invoice', input_invoice_data))
+    reconciliation, _ = stages.run('reconcile', reconcile_fingerprint, lambda: generate_gtgt_reconciliation_df(
+        all_declarations, output_invoice_data, input_invoice_data))
+    results['gtgt_reconciliation_df'] = reconciliation
+    if not reconciliation.empty:
+        flagged = reconciliation[reconciliation['Trạng thái'] != "Khớp"]
+        several = reconciliation['MST'].nunique() > 1
+        flagged = [f"{row['MST']} {row['Kỳ']}" if several else row['Kỳ'] for _, row in flagged.iterrows()]
+        if flagged:
+            log('warning', f"Bảng kê hóa đơn lệch với tờ khai 01/GTGT ở {len(flagged)} kỳ: {', '.join(flagged)}.")
+
+    log('write', "Đang phân tích rủi ro...")
+    results['all_checks'] = _run_risk_stage(stages, all_declarations, accounting_standard, output_invoice_data,
+                                            input_invoice_data)
+    log('success', "Phân tích hoàn tất!")
+    return results
+
+
+def parse_and_analyze(files, accounting_standard, output_invoice_data, input_invoice_data, notes_content,
+                      parse_workers=None, stages=None):
+    results = run_analysis_pipeline(files, accounting_standard, output_invoice_data, input_invoice_data,
+                                    notes_content, parse_workers=parse_workers, stages=stages)
+    st.session_state['tndn_main_df'] = results['tndn_main_df']
+    st.session_state['tndn_appendix_df'] = results['tndn_appendix_df']
+    st.session_state['gtgt_detailed_df'] = results['gtgt_detailed_df']
+    st.session_state['gtgt_reconciliation_df'] = results['gtgt_reconciliation_df']
+    st.session_state['trial_balance_check_df'] = results['trial_balance_check_df']
+    st.session_state['period_chain_df'] = results['period_chain_df']
+
+    # === GỠ LỖI: HIỂN THỊ DỮ LIỆU THÔ ĐÃ BÓC TÁCH ===
+    for file_path, data in results['parsed_files']:
+        st.subheader(f"Dữ liệu thô từ file: {os.path.basename(file_path)}")
+        st.json(data.to_dict())
+    # ===============================================
 
     # === GỠ LỖI: KIỂM TRA CÁC DATAFRAME TRƯỚC KHI TRẢ VỀ ===
     st.markdown("---")
     st.subheader("Trạng thái Dữ liệu (DEBUG)")
     data_status = {
-        "Tờ khai GTGT (Tổng hợp)": not gtgt_summary_df.empty,
-        "Tờ khai GTGT (Chi tiết)": not gtgt_detailed_df.empty,
-        "Bảng Cân đối Kế toán": not balance_sheet_df.empty,
-        "Báo cáo KQKD": not income_statement_df.empty,
-        "Bảng Cân đối Tài khoản": not trial_balance_df.empty,
-        "Tờ khai TNDN (Tổng hợp)": not tndn_summary_df.empty,
-        "Tờ khai TNCN QTT (Tổng hợp)": not tncn_qtt_summary_df.empty,
-        "Tờ khai TNCN QTT (Chi tiết)": not tncn_details_df.empty,
-        "Tờ khai TNCN KK (Tổng hợp)": not tncn_kk_summary_df.empty,
+        "Tờ khai GTGT (Tổng hợp)": not results['gtgt_summary_df'].empty,
+        "Tờ khai GTGT (Chi tiết)": not results['gtgt_detailed_df'].empty,
+        "Bảng Cân đối Kế toán": not results['balance_sheet_df'].empty,
+        "Báo cáo KQKD": not results['income_statement_df'].empty,
+        "Bảng Cân đối Tài khoản": not results['trial_balance_df'].empty,
+        "Tờ khai TNDN (Tổng hợp)": not results['tndn_summary_df'].empty,
+        "Tờ khai TNCN QTT (Tổng hợp)": not results['tncn_qtt_summary_df'].empty,
+        "Tờ khai TNCN QTT (Chi tiết)": not results['tncn_details_df'].empty,
+        "Tờ khai TNCN KK (Tổng hợp)": not results['tncn_kk_summary_df'].empty,
     }
     st.write(data_status)
     st.markdown("---")
     # =========================================================
 
-    st.write("Đang phân tích rủi ro...")
-    output_invoice_pre_tax_total = output_invoice_data.get('valid_summary', {}).get('total_pre_tax',
-                                                                                    None) if output_invoice_data else None
-    all_checks = run_risk_checks(all_declarations, gtgt_summary_df, tncn_kk_summary_df, accounting_standard,
-                                 output_invoice_pre_tax_total, input_invoice_data)
-    st.success("Phân tích hoàn tất!")
-    return all_declarations, all_checks, gtgt_summary_df, gtgt_detailed_df, balance_sheet_df, income_statement_df, trial_balance_df, tndn_summary_df, tncn_qtt_summary_df, tncn_details_df, tncn_kk_summary_df
+    return results['declarations'], results['all_checks'], results['gtgt_summary_df'], results['gtgt_detailed_df'], \
+        results['balance_sheet_df'], results['income_statement_df'], results['trial_balance_df'], \
+        results['tndn_summary_df'], results['tncn_qtt_summary_df'], results['tncn_details_df'], \
+        results['tncn_kk_summary_df']
+
+
+def _local_tag(tag):
+    return tag.split('}', 1)[-1]
+
+
+def _resolve_xml_key(tag, parent_tag, grandparent_tag):
+    # Đặt tiền tố cho chỉ tiêu theo khối cha/ông (BCTC: CĐKT, KQKD, CĐTK)
+    if parent_tag is None:
+        return tag
+    if parent_tag == 'NamNay' and tag.startswith('ct'):
+        return f"kqkd_nn_{tag}"
+    elif parent_tag == 'NamTruoc' and tag.startswith('ct'):
+        return f"kqkd_nt_{tag}"
+    elif parent_tag == 'SoCuoiNam' and tag.startswith('ct'):
+        return f"scn_{tag}"
+    elif parent_tag == 'SoDauNam' and tag.startswith('ct'):
+        return f"sdn_{tag}"
+    if grandparent_tag is not None and parent_tag in ('No', 'Co'):
+        side = 'no' if parent_tag == 'No' else 'co'
+        if grandparent_tag == 'SoPhatSinhTrongKy':
+            return f"ps_{side}_{tag}"
+        elif grandparent_tag == 'SoDuDauKy':
+            return f"sddk_{side}_{tag}"
+        elif grandparent_tag == 'SoDuCuoiKy':
+            return f"sdck_{side}_{tag}"
+    return tag
+
+
+def _store_xml_value(data, tag, key, value):
+    if tag in SINGLE_VALUE_TAGS:
+        if tag not in data: data[tag] = value
+    else:
+        if key in data:
+            if not isinstance(data[key], list): data[key] = [data[key]]
+            data[key].append(value)
+        else:
+            data[key] = value
+
+
+def _parse_xml_etree(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        xml_content = f.read()
+    tree = ET.fromstring(xml_content)
+    data = {}
+
+    parent_map = {c: p for p in tree.iter() for c in p}
+    for elem in tree.iter():
+        if not (elem.text and elem.text.strip()):
+            continue
+
+        tag = _local_tag(elem.tag)
+        parent = parent_map.get(elem)
+        parent_tag = _local_tag(parent.tag) if parent is not None else None
+        grandparent = parent_map.get(parent) if parent is not None else None
+        grandparent_tag = _local_tag(grandparent.tag) if grandparent is not None else None
+        _store_xml_value(data, tag, _resolve_xml_key(tag, parent_tag, grandparent_tag), elem.text.strip())
+    return data
+
+
+def _parse_xml_lxml(file_path):
+    # Đọc luồng bằng iterparse: tự giữ ngăn xếp thẻ tổ tiên thay cho parent_map,
+    # giải phóng từng phần tử ngay sau khi đã bóc tách.
+    # Tệp do người nộp thuế gửi: không nạp DTD, không thay thực thể (XXE), không truy cập mạng.
+    data = {}
+    ancestors = []
+    for event, elem in lxml_etree.iterparse(file_path, events=('start', 'end'), remove_comments=True,
+                                            remove_pis=True, huge_tree=True, resolve_entities=False,
+                                            load_dtd=False, no_network=True):
+        if event == 'start':
+            ancestors.append(_local_tag(elem.tag))
+            continue
+
+        tag = ancestors.pop()
+        text = elem.text
+        if text and text.strip():
+            parent_tag = ancestors[-1] if ancestors else None
+            grandparent_tag = ancestors[-2] if len(ancestors) > 1 else None
+            _store_xml_value(data, tag, _resolve_xml_key(tag, parent_tag, grandparent_tag), text.strip())
+
+        elem.clear(keep_tail=True)
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+    return data
+
+
+def _read_xml_file(file_path, backend=None):
+    backend = backend or XML_PARSER_BACKEND
+    if backend == 'lxml' and lxml_etree is not None:
+        return _parse_xml_lxml(file_path)
+    return _parse_xml_etree(file_path)
+
+
+def parse_xml_data(file_path, backend=None, log=streamlit_log):
+    try:
+        return _read_xml_file(file_path, backend)
+    except XML_PARSE_ERRORS as e:
+        log('error', f"Lỗi khi đọc tệp {os.path.basename(file_path)}: {e}")
+        return {}
+
+
+def _parse_xml_task(file_path, backend=None):
+    # Chạy trong tiến trình con: không gọi st.*, trả lỗi về cho tiến trình chính tổng hợp
+    try:
+        return Declaration.from_parsed(_read_xml_file(file_path, backend)), None
+    except XML_FILE_ERRORS as e:
+        return Declaration(), str(e)
 
 
-def parse_xml_data(file_path):
+def map_in_processes(func, *iterables, max_workers, chunksize=1):
+    # executor.map qua process pool; trả về None nếu không tạo được tiến trình con hoặc pool bị hỏng
+    # (gọi lại tuần tự). Lỗi do chính func ném ra vẫn lan ra ngoài như khi chạy tuần tự.
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            xml_content = f.read()
-        tree = ET.fromstring(xml_content)
-        data = {}
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    except (OSError, NotImplementedError):
+        return None
+    with executor:
+        try:
+            # map gửi mọi tác vụ ngay, tiến trình con được khởi động tại đây
+            results = executor.map(func, *iterables, chunksize=chunksize)
+        except OSError:
+            return None
+        try:
+            return list(results)
+        except BrokenProcessPool:
+            return None
+
+
+class DiskLRUCache:
+    # Bộ đệm trên đĩa theo địa chỉ nội dung: mỗi khóa là một tệp, thời điểm sửa tệp dùng làm mốc LRU.
+    def __init__(self, cache_dir, max_bytes, suffix=''):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir, exist_ok=True)
 
-        parent_map = {c: p for p in tree.iter() for c in p}
-        single_value_tags = ['maTKhai', 'kyKKhai', 'mst', 'tenNNT', 'dchiNNT', 'tenHuyenNNT', 'tenTinhNNT', 'loaiTKhai',
-                             'soLan']
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}{self.suffix}")
 
-        for elem in tree.iter():
-            if not (elem.text and elem.text.strip()):
+    def lookup(self, key):
+        path = self.path_for(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def write_bytes(self, key, payload):
+        path = self.path_for(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f: f.write(payload)
+        os.replace(tmp_path, path)
+        return path
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix) or name.endswith('.tmp'): continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
                 continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes: break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                total -= size
+            except OSError:
+                pass
+
+
+class ParsedDeclarationCache(DiskLRUCache):
+    # Lưu kết quả bóc tách XML dạng pickle nén zlib, khóa = SHA-256(phiên bản bộ bóc tách + nội dung tệp)
+    def __init__(self, cache_dir=PARSE_CACHE_DIR, max_bytes=PARSE_CACHE_MAX_BYTES):
+        super().__init__(cache_dir, max_bytes, suffix='.pkz')
+
+    def key_for_file(self, file_path):
+        digest = hashlib.sha256(PARSER_VERSION.encode())
+        try:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        return digest.hexdigest()
+
+    def load(self, key):
+        path = self.lookup(key)
+        if path is None: return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.loads(zlib.decompress(f.read()))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+
+    def store(self, key, data):
+        try:
+            self.write_bytes(key, zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+        except OSError:
+            pass
+
+
+_parse_cache = None
+
+
+def get_parse_cache():
+    global _parse_cache
+    if _parse_cache is None:
+        try:
+            _parse_cache = ParsedDeclarationCache()
+        except OSError:
+            return None
+    return _parse_cache
+
+
+class InvoiceSheetCache(DiskLRUCache):
+    # Bảng kê Excel đã đọc, lưu dạng Parquet; khóa = SHA-256 nội dung tệp + mẫu bảng kê + phiên bản.
+    # Đọc lại bằng memory map nên không phải phân tích lại xlsx bằng openpyxl.
+    def __init__(self, cache_dir=INVOICE_CACHE_DIR, max_bytes=INVOICE_CACHE_MAX_BYTES):
+        super().__init__(cache_dir, max_bytes, suffix='.parquet')
+
+    def key_for(self, digest, template):
+        return f"{digest}_{template}_v{INVOICE_CACHE_VERSION}"
+
+    def load(self, key):
+        path = self.lookup(key)
+        if path is None: return None
+        try:
+            return pq.read_table(path, memory_map=True).to_pandas()
+        except (OSError, pa.ArrowException):
+            return None
+
+    def store(self, key, df):
+        try:
+            table = _arrow_table(df)
+            if table.nbytes > self.max_bytes: return
+            buffer = pa.BufferOutputStream()
+            pq.write_table(table, buffer)
+            self.write_bytes(key, buffer.getvalue().to_pybytes())
+            self.evict()
+        except (OSError, pa.ArrowException):
+            pass
+
+
+def _arrow_table(df):
+    # Cột object lẫn kiểu (số và chữ trong cùng cột của bảng kê) không lưu được nguyên trạng -> lưu dạng chuỗi
+    columns = {}
+    for col in df.columns:
+        try:
+            columns[col] = pa.array(df[col], from_pandas=True)
+        except (pa.ArrowException, TypeError, ValueError):
+            columns[col] = pa.array(df[col].map(lambda v: None if pd.isna(v) else str(v)), type=pa.string())
+    return pa.table(columns)
+
+
+_invoice_sheet_cache = None
+
 
-            tag = elem.tag.split('}', 1)[-1]
-            key = tag
-            value = elem.text.strip()
-
-            parent = parent_map.get(elem)
-            if parent is not None:
-                parent_tag = parent.tag.split('}', 1)[-1]
-
-                if parent_tag == 'NamNay' and tag.startswith('ct'):
-                    key = f"kqkd_nn_{tag}"
-                elif parent_tag == 'NamTruoc' and tag.startswith('ct'):
-                    key = f"kqkd_nt_{tag}"
-                elif parent_tag == 'SoCuoiNam' and tag.startswith('ct'):
-                    key = f"scn_{tag}"
-                elif parent_tag == 'SoDauNam' and tag.startswith('ct'):
-                    key = f"sdn_{tag}"
-                else:
-                    grandparent = parent_map.get(parent)
-                    if grandparent is not None:
-                        grandparent_tag = grandparent.tag.split('}', 1)[-1]
-                        if grandparent_tag == 'SoPhatSinhTrongKy':
-                            if parent_tag == 'No':
-                                key = f"ps_no_{tag}"
-                            elif parent_tag == 'Co':
-                                key = f"ps_co_{tag}"
-                        elif grandparent_tag == 'SoDuDauKy':
-                            if parent_tag == 'No':
-                                key = f"sddk_no_{tag}"
-                            elif parent_tag == 'Co':
-                                key = f"sddk_co_{tag}"
-                        elif grandparent_tag == 'SoDuCuoiKy':
-                            if parent_tag == 'No':
-                                key = f"sdck_no_{tag}"
-                            elif parent_tag == 'Co':
-                                key = f"sdck_co_{tag}"
-
-            if tag in single_value_tags:
-                if tag not in data: data[tag] = value
+def get_invoice_sheet_cache():
+    global _invoice_sheet_cache
+    if pq is None: return None
+    if _invoice_sheet_cache is None:
+        try:
+            _invoice_sheet_cache = InvoiceSheetCache()
+        except OSError:
+            return None
+    return _invoice_sheet_cache
+
+
+# Bóc tách nhiều tệp XML song song bằng process pool.
+# Trả về (results, errors): results là [(file_path, data)] theo đúng thứ tự `files`, errors là [(file_path, lỗi)].
+def parse_xml_files(files, max_workers=None, backend=None, cache=None):
+    files = list(files)
+    if not files:
+        return [], []
+    outcomes = [None] * len(files)
+    keys = [cache.key_for_file(f) for f in files] if cache is not None else [None] * len(files)
+    for i, key in enumerate(keys):
+        if key is not None:
+            cached = cache.load(key)
+            if cached is not None:
+                outcomes[i] = (cached, None)
+    pending = [i for i, outcome in enumerate(outcomes) if outcome is None]
+
+    max_workers = max_workers or PARSE_MAX_WORKERS or os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(pending)))
+    pending_files = [files[i] for i in pending]
+    backends = [backend] * len(pending)
+
+    parsed = None
+    if max_workers > 1:
+        chunksize = max(1, len(pending) // (max_workers * 4))
+        parsed = map_in_processes(_parse_xml_task, pending_files, backends, max_workers=max_workers,
+                                  chunksize=chunksize)
+    if parsed is None:  # Môi trường không cho tạo tiến trình con: chạy tuần tự
+        parsed = [_parse_xml_task(f, b) for f, b in zip(pending_files, backends)]
+
+    for i, (data, error) in zip(pending, parsed):
+        outcomes[i] = (data, error)
+        if cache is not None and keys[i] is not None and not error:
+            cache.store(keys[i], data)
+    if cache is not None and pending:
+        cache.evict()
+
+    results, errors = [], []
+    for file_path, (data, error) in zip(files, outcomes):
+        if error:
+            errors.append((file_path, error))
+        results.append((file_path, data))
+    return results, errors
+
+
+def parse_number(value, default=None):
+    # Nơi duy nhất chuyển chuỗi số trong XML/Bảng kê thành float.
+    # Nhận cả dạng '1234.5', '1.234.567', '1.234.567,89' (kiểu Việt Nam), '1,234,567.89' và '(1.234)' (số âm, -1234).
+    # Chuỗi float() đọc được ('1.234', '0.125') giữ nghĩa thập phân như XML ghi; ở dạng định dạng (ngoặc, khoảng trắng)
+    # một dấu phân cách đứng trước đúng 3 chữ số là dấu nghìn: '(1.234)' -> -1234, '1,234' -> 1234, '1,5' -> 1.5.
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value) if math.isfinite(value) else default
+    text = str(value).strip()
+    if not text:
+        return default
+    try:
+        number = float(text)
+        return number if math.isfinite(number) else default
+    except ValueError:
+        pass
+
+    negative = text.startswith('(') and text.endswith(')')
+    if negative: text = text[1:-1]
+    text = text.replace(' ', '').replace('\xa0', '')
+    if ',' in text and '.' in text:
+        if text.rfind(',') > text.rfind('.'):
+            text = text.replace('.', '').replace(',', '.')
+        else:
+            text = text.replace(',', '')
+    elif ',' in text:
+        parts = text.split(',')
+        text = text.replace(',', '') if len(parts) > 2 or len(parts[-1]) == 3 else text.replace(',', '.')
+    elif '.' in text:
+        parts = text.split('.')
+        if len(parts) > 2 or len(parts[-1]) == 3:
+            text = text.replace('.', '')
+    try:
+        number = float(text)
+    except ValueError:
+        return default
+    if not math.isfinite(number):
+        return default
+    return -number if negative else number
+
+
+class Declaration:
+    # Tờ khai đã bóc tách, dạng có kiểu: các chỉ tiêu số được giải mã một lần vào mảng float64
+    # (tra cứu qua chỉ mục khóa -> vị trí), các trường định danh giữ thành thuộc tính.
+    __slots__ = ('ma_tkhai', 'ky_kkhai', 'mst', 'so_lan', 'loai_tkhai', '_index', '_values', '_text', '_lists')
+
+    def __init__(self, ma_tkhai='', ky_kkhai='', mst='', so_lan=0, loai_tkhai='', index=None, values=None,
+                 text=None, lists=None):
+        self.ma_tkhai = ma_tkhai
+        self.ky_kkhai = ky_kkhai
+        self.mst = mst
+        self.so_lan = so_lan
+        self.loai_tkhai = loai_tkhai
+        self._index = index or {}
+        self._values = values if values is not None else np.empty(0, dtype=np.float64)
+        self._text = text or {}
+        self._lists = lists or {}
+
+    @classmethod
+    def from_parsed(cls, data):
+        keys, numbers, text, lists = [], [], {}, {}
+        for key, value in data.items():
+            if isinstance(value, list):
+                lists[key] = value
+                first = value[0] if value else None
             else:
-                if key in data:
-                    if not isinstance(data[key], list): data[key] = [data[key]]
-                    data[key].append(value)
-                else:
-                    data[key] = value
-        return data
-    except (ET.ParseError, FileNotFoundError) as e:
-        st.error(f"Lỗi khi đọc tệp {os.path.basename(file_path)}: {e}")
-        return {}
+                first = value
+            number = parse_number(first)
+            if number is None:
+                if first is not None and not isinstance(value, list): text[key] = first
+                continue
+            keys.append(key)
+            numbers.append(number)
+            # Giữ nguyên chuỗi gốc của trường định danh hoặc khi chuyển sang số làm mất thông tin (số 0 ở đầu)
+            if not isinstance(value, list) and (
+                    key in SINGLE_VALUE_TAGS or (len(first) > 1 and first[0] == '0' and first[1] != '.')):
+                text[key] = first
+        so_lan = parse_number(data.get('soLan'), 0.0)
+        return cls(ma_tkhai=data.get('maTKhai', ''), ky_kkhai=data.get('kyKKhai', ''), mst=data.get('mst', ''),
+                   so_lan=int(so_lan), loai_tkhai=data.get('loaiTKhai', ''),
+                   index={key: slot for slot, key in enumerate(keys)},
+                   values=np.array(numbers, dtype=np.float64), text=text, lists=lists)
+
+    def __len__(self):
+        return len(self._index.keys() | self._text.keys() | self._lists.keys())
+
+    def __contains__(self, key):
+        return key in self._index or key in self._text or key in self._lists
+
+    def keys(self):
+        return self._index.keys() | self._text.keys() | self._lists.keys()
+
+    def value(self, key, default=0):
+        slot = self._index.get(key)
+        return float(self._values[slot]) if slot is not None else float(default)
+
+    def values(self, keys, default=0):
+        # Lấy nhiều chỉ tiêu một lượt (vector hóa), chỉ tiêu thiếu nhận giá trị mặc định
+        slots = np.fromiter((self._index.get(key, -1) for key in keys), dtype=np.intp, count=len(keys))
+        found = slots >= 0
+        out = np.full(len(keys), float(default), dtype=np.float64)
+        out[found] = self._values[slots[found]]
+        return out
+
+    def text(self, key, default=''):
+        if key in self._text:
+            return self._text[key]
+        if key in self._lists:
+            return str(self._lists[key][0]) if self._lists[key] else str(default)
+        slot = self._index.get(key)
+        if slot is not None:
+            number = self._values[slot]
+            return str(int(number)) if number.is_integer() else str(number)
+        return str(default)
+
+    def list(self, key):
+        if key in self._lists:
+            return list(self._lists[key])
+        if key in self._text or key in self._index:
+            return [self.text(key)]
+        return []
+
+    def numbers(self, key, default=0.0):
+        return np.array([parse_number(x, default) for x in self.list(key)], dtype=np.float64)
+
+    @property
+    def nbytes(self):
+        return self._values.nbytes
+
+    def to_dict(self):
+        data = {key: self.text(key) for key in self._index}
+        data.update(self._text)
+        data.update({key: list(value) for key, value in self._lists.items()})
+        data.update({'maTKhai': self.ma_tkhai, 'kyKKhai': self.ky_kkhai, 'mst': self.mst,
+                     'soLan': str(self.so_lan), 'loaiTKhai': self.loai_tkhai})
+        return {key: value for key, value in data.items() if value != ''}
 
 
 def get_single_value(data, key, default=0):
+    if isinstance(data, Declaration):
+        return data.value(key, default)
     value = data.get(key, default)
-    try:
-        if isinstance(value, list):
-            return float(value[0]) if value else float(default)
-        return float(value) if value is not None else float(default)
-    except (ValueError, TypeError):
-        return float(default)
+    if isinstance(value, list):
+        value = value[0] if value else default
+    number = parse_number(value)
+    return number if number is not None else float(default)
 
 
 def get_string_value(data, key, default=''):
+    if isinstance(data, Declaration):
+        return data.text(key, default)
     value = data.get(key, default)
     if isinstance(value, list):
         return str(value[0]) if value else str(default)
     return str(value) if value is not None else str(default)
 
 
+@functools.lru_cache(maxsize=4096)
+def period_sort_key(ky):
+    # Khóa sắp xếp kỳ tính thuế theo thời gian: '05/2024', 'Q2/2024', '2024'
+    text = str(ky or '').strip()
+    year_part = text.rsplit('/', 1)[-1]
+    if not year_part.isdigit():
+        return (9999, 99, text)
+    year = int(year_part)
+    if '/' not in text:
+        return (year, 13, text)
+    head = text.rsplit('/', 1)[0].strip().upper()
+    if head.startswith('Q') and head[1:].isdigit():
+        return (year, int(head[1:]) * 3, text)
+    if head.isdigit():
+        return (year, int(head), text)
+    return (year, 99, text)
+
+
+def _is_amendment(entry):
+    data = entry['data']
+    return str(data.loai_tkhai).strip().upper() in ('B', 'BỔ SUNG') or data.so_lan > 0
+
+
+def _supersedes(new_entry, current_entry):
+    # Cùng quy tắc với WebScraper.analyze_and_download: tờ khai bổ sung thay thế chính thức,
+    # trong các lần bổ sung giữ lần có số thứ tự lớn nhất; tờ chính thức chỉ giữ bản đầu tiên.
+    if _is_amendment(new_entry):
+        return not _is_amendment(current_entry) or new_entry['data'].so_lan > current_entry['data'].so_lan
+    return False
+
+
+class DeclarationRegistry:
+    # Sổ đăng ký tờ khai hiệu lực, chỉ mục theo (mst, loại tờ khai, kỳ); chỉ giữ lần bổ sung mới nhất.
+    def __init__(self, entries=None):
+        self._entries = {}
+        self._by_period = {}
+        self.superseded = []
+        for entry in entries or []:
+            self.add(entry)
+
+    def add(self, entry):
+        key = (entry['data'].mst, entry['loai_tk'], entry['ky'])
+        current = self._entries.get(key)
+        if current is not None and not _supersedes(entry, current):
+            self.superseded.append(entry)
+            return False
+        if current is not None:
+            self.superseded.append(current)
+        self._entries[key] = entry
+        self._by_period.setdefault((entry['loai_tk'], entry['ky']), {})[key[0]] = entry
+        return True
+
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        return bool(self._entries)
+
+    def msts(self):
+        return sorted({mst for mst, _, _ in self._entries})
+
+    def get(self, loai_tk, ky, mst=None):
+        by_mst = self._by_period.get((loai_tk, ky))
+        if not by_mst:
+            return None
+        if mst is not None:
+            return by_mst.get(mst)
+        return next(iter(by_mst.values()))
+
+    def select(self, *loai_tks, mst=None):
+        entries = [e for (e_mst, loai_tk, _), e in self._entries.items()
+                   if loai_tk in loai_tks and (mst is None or e_mst == mst)]
+        return sorted(entries, key=lambda e: period_sort_key(e['ky']))
+
+    def periods(self, *loai_tks, mst=None):
+        return sorted({e['ky'] for e in self.select(*loai_tks, mst=mst)}, key=period_sort_key)
+
+    def latest(self, *loai_tks, mst=None):
+        entries = self.select(*loai_tks, mst=mst)
+        return entries[-1] if entries else None
+
+
+def as_registry(declarations):
+    return declarations if isinstance(declarations, DeclarationRegistry) else DeclarationRegistry(declarations)
+
+
+_layout_keys_cache = {}
+
+
+def _select_layout(report, ma_tk):
+    layouts = FORM_LAYOUTS[report]
+    for position, layout in enumerate(layouts):
+        if layout['ma_tk'] and ma_tk in layout['ma_tk']:
+            return position, layout
+    return next((position, layout) for position, layout in enumerate(layouts) if not layout['ma_tk'])
+
+
+def _layout_keys(report, position, layout):
+    # Danh sách khóa phẳng: lần lượt từng cột số liệu, mỗi cột theo thứ tự dòng
+    keys = _layout_keys_cache.get((report, position))
+    if keys is None:
+        keys = [prefix + tag for prefix in layout['value_columns'].values() for _, _, tag in layout['rows']]
+        _layout_keys_cache[(report, position)] = keys
+    return keys
+
+
+def _frame_from_layout(layout, values):
+    n_rows = len(layout['rows'])
+    frame = {}
+    for column, role in layout['index_columns']:
+        position = 0 if role == 'code' else 1
+        frame[column] = [row[position] for row in layout['rows']]
+    for i, column in enumerate(layout['value_columns']):
+        frame[column] = values[i * n_rows:(i + 1) * n_rows]
+    return pd.DataFrame(frame)
+
+
+def build_report_frames(data, reports=None):
+    # Dựng mọi bảng chi tiết của một tờ khai trong một lượt lấy số liệu vector hóa
+    if not isinstance(data, Declaration):
+        data = Declaration.from_parsed(data)
+    if reports is None:
+        form = MA_TK_MAP.get(data.ma_tkhai)
+        reports = [report for report, layouts in FORM_LAYOUTS.items() if layouts[0]['form'] == form]
+    selected = [(report,) + _select_layout(report, data.ma_tkhai) for report in reports]
+    keys = [key for report, position, layout in selected for key in _layout_keys(report, position, layout)]
+    values = data.values(keys)
+
+    frames, offset = {}, 0
+    for report, position, layout in selected:
+        size = len(_layout_keys(report, position, layout))
+        frames[report] = _frame_from_layout(layout, values[offset:offset + size])
+        offset += size
+    return frames
+
+
+def extract_indicator_matrix(declarations, keys, default=0):
+    # Ma trận (số tờ khai x số chỉ tiêu) cho xử lý hàng loạt nhiều tờ khai/người nộp thuế
+    keys = list(keys)
+    if not declarations:
+        return np.empty((0, len(keys)), dtype=np.float64)
+    return np.vstack([data.values(keys, default) for data in declarations])
+
+
 def generate_gtgt_summary(declarations):
-    gtgt_decls = [d for d in declarations if 'GTGT' in d['loai_tk']]
-    if not gtgt_decls: return pd.DataFrame()
-    periods = sorted(list(set(d['ky'] for d in gtgt_decls)))
+    registry = as_registry(declarations)
+    periods = registry.periods(*GTGT_FORMS)
+    if not periods: return pd.DataFrame()
     summary_data = {'Chỉ tiêu': ['Doanh thu chịu thuế GTGT', 'Thuế GTGT được khấu trừ', 'Thuế GTGT phải nộp']}
     for period in periods:
-        p_data = next((d['data'] for d in gtgt_decls if d['ky'] == period), {})
+        p_decl = next(filter(None, (registry.get(form, period) for form in GTGT_FORMS)), None)
+        p_data = p_decl['data'] if p_decl else {}
         dt_total = sum(get_single_value(p_data, tag, 0) for tag in
                        [XML_TAG_MAP['01/GTGT']['doanh_thu_kct'], XML_TAG_MAP['01/GTGT']['doanh_thu_0'],
                         XML_TAG_MAP['01/GTGT']['doanh_thu_5'], XML_TAG_MAP['01/GTGT']['doanh_thu_10']])
@@ -650,292 +2775,336 @@ def generate_gtgt_summary(declarations):
     return df
 
 
+def declaration_period_months(ky):
+    # Các mã tháng (năm*100+tháng) thuộc kỳ kyKKhai: '05/2024' -> 1 tháng, 'Q2/2024' -> 3 tháng, '2024' -> 12 tháng
+    text = str(ky or '').strip().upper()
+    year_part = text.rsplit('/', 1)[-1]
+    if not year_part.isdigit():
+        return []
+    year = int(year_part) * 100
+    if '/' not in text:
+        return [year + month for month in range(1, 13)]
+    head = text.rsplit('/', 1)[0].strip()
+    if head.startswith('Q') and head[1:].isdigit() and 1 <= int(head[1:]) <= 4:
+        quarter = int(head[1:])
+        return [year + month for month in range(quarter * 3 - 2, quarter * 3 + 1)]
+    if head.isdigit() and 1 <= int(head) <= 12:
+        return [year + int(head)]
+    return []
+
+
+def _month_label(code, quarterly=False):
+    if not code:
+        return "Không xác định"
+    year, month = divmod(int(code), 100)
+    return f"Q{(month + 2) // 3}/{year}" if quarterly else f"{month:02d}/{year}"
+
+
+# Cột của bảng kê cần để tính tiền VND theo tháng lập (bảng kê chi tiết/tổng hợp/đầu vào)
+INVOICE_AMOUNT_SOURCE_COLUMNS = ['NgayLap', 'TrangThaiHoaDon', 'DonViTienTe', 'TyGia', 'ThanhTien', 'TienChietKhau',
+                                 'ThueSuat', 'TongTienChuaThue', 'TongTienThue']
+
+
+def invoice_amount_frame(df, statuses=VALID_INVOICE_STATUSES, columns=()):
+    # Ngày lập, mã tháng lập ('Thang') và tiền chưa thuế/thuế VND ('ChuaThue', 'Thue') của từng dòng hóa đơn hợp lệ,
+    # kèm các cột `columns` có trong bảng kê
+    if 'ThanhTien' in df.columns:
+        amounts, pre_tax, tax = _detailed_invoice_amounts(df), 'TienChuaThue', 'TienThue'
+    else:
+        pre_tax, tax = 'TongTienChuaThue', 'TongTienThue'
+        amounts = convert_to_vnd(df[[col for col in ('NgayLap', 'TrangThaiHoaDon', 'DonViTienTe', 'TyGia', pre_tax, tax)
+                                     if col in df.columns]].copy(), [pre_tax, tax])
+    dates = invoice_dates(amounts['NgayLap'])
+    frame = pd.DataFrame({'NgayLap': dates.to_numpy(), 'Thang': invoice_period_codes(dates).to_numpy(),
+                          'ChuaThue': amounts[pre_tax].to_numpy(dtype=np.float64),
+                          'Thue': amounts[tax].to_numpy(dtype=np.float64)})
+    for col in columns:
+        if col in df.columns and col not in frame.columns:
+            frame[col] = df[col].to_numpy()
+    if statuses is not None and 'TrangThaiHoaDon' in amounts.columns:
+        frame = frame[amounts['TrangThaiHoaDon'].isin(statuses).to_numpy()]
+    return frame
+
+
+def invoice_amount_batches(invoice_data, statuses=VALID_INVOICE_STATUSES, columns=()):
+    # invoice_amount_frame theo từng phần: bảng kê đọc theo khối (full_df chỉ là phần xem trước) đọc lại từng nhóm
+    # dòng của tệp Parquet, chỉ các cột cần, để nơi gọi cộng dồn mà không nạp cả bảng kê
+    if not invoice_data.get('spill_path'):
+        yield invoice_amount_frame(invoice_data['full_df'], statuses, columns)
+        return
+    wanted = set(INVOICE_AMOUNT_SOURCE_COLUMNS) | set(columns)
+    names = [name for name in pq.read_schema(invoice_data['spill_path']).names if name in wanted]
+    for df in spill_batches(invoice_data['spill_path'], names):
+        yield invoice_amount_frame(df, statuses, columns)
+
+
+def invoice_amounts(invoice_data, statuses=VALID_INVOICE_STATUSES, columns=()):
+    # invoice_amount_frame trên cả bảng kê; với bảng kê đọc theo khối nên cộng dồn qua invoice_amount_batches
+    if not invoice_data.get('spill_path'):
+        return invoice_amount_frame(invoice_data['full_df'], statuses, columns)
+    return pd.concat(list(invoice_amount_batches(invoice_data, statuses, columns)), ignore_index=True)
+
+
+def invoice_monthly_totals(invoice_data, statuses=VALID_INVOICE_STATUSES):
+    # Tiền chưa thuế/thuế (VND) của hóa đơn hợp lệ cộng theo mã tháng trong một lượt groupby trên toàn bảng kê
+    columns = ['ChuaThue', 'Thue']
+    if not invoice_data:
+        return pd.DataFrame(columns=columns, dtype=np.float64)
+    if 'aggregates_df' not in invoice_data:
+        amounts = invoice_amounts(invoice_data, statuses)
+        return amounts.groupby(amounts['Thang'].to_numpy())[columns].sum()
+    # Bảng kê đọc theo khối: dùng luôn bảng cộng dồn theo trạng thái/tiền tệ/kỳ 'MM/YYYY' (đã quy đổi VND)
+    amounts = invoice_data['aggregates_df']
+    if amounts.empty:
+        return pd.DataFrame(columns=columns, dtype=np.float64)
+    pre_tax, tax = ('TienChuaThue', 'TienThue') if 'TienChuaThue' in amounts.columns else (
+        'TongTienChuaThue', 'TongTienThue')
+    labels = amounts['Ky'].astype(str)
+    label_codes = {label: int(label[3:]) * 100 + int(label[:2]) for label in labels.unique()
+                   if re.fullmatch(r'\d{2}/\d{4}', label)}
+    codes = labels.map(label_codes).fillna(0).astype(np.int64)
+    frame = pd.DataFrame({'ChuaThue': amounts[pre_tax].to_numpy(dtype=np.float64),
+                          'Thue': amounts[tax].to_numpy(dtype=np.float64)})
+    if statuses is not None:
+        valid = amounts['TrangThaiHoaDon'].isin(statuses).to_numpy()
+        frame, codes = frame[valid], codes[valid]
+    return frame.groupby(np.asarray(codes)).sum()
+
+
+# Cột đối chiếu theo kỳ: (tên cột bảng kê, chỉ tiêu tờ khai 01/GTGT, nhãn chỉ tiêu)
+GTGT_RECONCILIATION_COLUMNS = [
+    ('HĐ bán ra: Tiền chưa thuế', 'ct34', '[34] Tổng doanh thu HHDV bán ra'),
+    ('HĐ mua vào: Tiền chưa thuế', 'ct23', '[23] Giá trị HHDV mua vào'),
+    ('HĐ mua vào: Tiền thuế', 'ct24', '[24] Thuế GTGT mua vào'),
+    ('HĐ mua vào: Tiền thuế', 'ct25', '[25] Thuế GTGT được khấu trừ'),
+]
+
+
+def generate_gtgt_reconciliation_df(declarations, output_invoice_data=None, input_invoice_data=None, tolerance=1):
+    # Đối chiếu từng kỳ kê khai 01/GTGT với bảng kê hóa đơn: hóa đơn gom theo tháng lập một lượt, rồi dồn vào
+    # đúng kỳ của tờ khai (tháng hoặc quý); tháng có hóa đơn mà không có tờ khai được tách thành kỳ riêng.
+    # Sổ đăng ký có tờ khai của nhiều MST: đối chiếu riêng từng MST (cùng một kỳ có thể xuất hiện ở nhiều MST).
+    registry = as_registry(declarations)
+    invoice_months = pd.concat({'ra': invoice_monthly_totals(output_invoice_data),
+                                'vao': invoice_monthly_totals(input_invoice_data, statuses=None)}, axis=1).fillna(0)
+    msts = [mst for mst in registry.msts() if registry.select('01/GTGT', mst=mst)]
+    if not msts and invoice_months.empty:
+        return pd.DataFrame()
+    frames = [_reconcile_gtgt_periods(mst, registry.select('01/GTGT', mst=mst) if mst else [], invoice_months,
+                                      output_invoice_data, input_invoice_data, tolerance) for mst in msts or ['']]
+    return pd.concat(frames, ignore_index=True)
+
+
+def _reconcile_gtgt_periods(mst, entries, invoice_months, output_invoice_data, input_invoice_data, tolerance):
+    month_period = {}
+    for entry in entries:
+        for code in declaration_period_months(entry['ky']):
+            month_period.setdefault(code, entry['ky'])
+    quarterly = bool(entries) and all(str(e['ky']).strip().upper().startswith('Q') for e in entries)
+    buckets = [month_period.get(code) or _month_label(code, quarterly) for code in invoice_months.index]
+    invoices = invoice_months.groupby(buckets, sort=False).sum()
+
+    keys = sorted({key for _, key, _ in GTGT_RECONCILIATION_COLUMNS})
+    declared = pd.DataFrame(extract_indicator_matrix([e['data'] for e in entries], keys),
+                            index=[e['ky'] for e in entries], columns=keys)
+    periods = sorted(set(declared.index) | set(invoices.index), key=period_sort_key)
+    declared = declared.reindex(periods)
+    invoices = invoices.reindex(periods).fillna(0)
+
+    sides = {'HĐ bán ra: Tiền chưa thuế': (output_invoice_data, ('ra', 'ChuaThue')),
+             'HĐ mua vào: Tiền chưa thuế': (input_invoice_data, ('vao', 'ChuaThue')),
+             'HĐ mua vào: Tiền thuế': (input_invoice_data, ('vao', 'Thue'))}
+    result = {'MST': [mst] * len(periods), 'Kỳ': periods}
+    gaps = []
+    for invoice_col, key, label in GTGT_RECONCILIATION_COLUMNS:
+        invoice_data, column = sides[invoice_col]
+        # Không tải bảng kê tương ứng: để trống thay vì coi như 0 đồng
+        invoice_values = invoices[column].to_numpy() if invoice_data and column in invoices else np.full(
+            len(periods), np.nan)
+        result.setdefault(invoice_col, invoice_values)
+        result[label] = declared[key].to_numpy()
+        result[f"Chênh lệch {label.split(' ', 1)[0]}"] = result[label] - invoice_values
+        gaps.append(result[f"Chênh lệch {label.split(' ', 1)[0]}"])
+
+    df = pd.DataFrame(result)
+    gaps = np.abs(np.vstack(gaps))
+    has_declaration = declared.notna().any(axis=1).to_numpy()
+    flagged = (np.nan_to_num(gaps, nan=0.0) > tolerance).any(axis=0)
+    df['Trạng thái'] = np.select([df['Kỳ'].eq("Không xác định").to_numpy(), ~has_declaration, flagged],
+                                 ["Không rõ ngày lập", "Thiếu tờ khai", "Cảnh báo"], "Khớp")
+    return df
+
+
 def generate_gtgt_detailed_df(declarations):
-    gtgt_decl = next((d for d in reversed(declarations) if '01/GTGT' in d['loai_tk']), None)
+    gtgt_decl = as_registry(declarations).latest('01/GTGT')
     if not gtgt_decl: return pd.DataFrame()
-    data = gtgt_decl['data']
-
-    detailed_data = {
-        'Mã chỉ tiêu': [
-            '[21]', '[22]', '[23]', '[24]', '[25]', '[26]', '[29]', '[30]', '[31]',
-            '[32]', '[33]', '[32a]', '[34]', '[35]', '[36]', '[37]', '[38]', '[39a]',
-            '[40a]', '[40b]', '[40]', '[41]', '[42]', '[43]'
-        ],
-        'Chỉ tiêu': [
-            'Thuế GTGT còn được khấu trừ kỳ trước chưa hết',
-            'Thuế GTGT còn được khấu trừ kỳ trước chuyển sang',
-            'Giá trị của hàng hóa, dịch vụ mua vào',
-            'Thuế GTGT của HHDV mua vào',
-            'Thuế GTGT của HHDV mua vào được khấu trừ kỳ này',
-            'HHDV bán ra không chịu thuế GTGT',
-            'HHDV bán ra chịu thuế suất 0%',
-            'Doanh thu HHDV bán ra chịu thuế suất 5%',
-            'Thuế GTGT HHDV bán ra chịu thuế suất 5%',
-            'Doanh thu HHDV bán ra chịu thuế suất 10%',
-            'Thuế GTGT HHDV bán ra chịu thuế suất 10%',
-            'HHDV bán ra không phải kê khai, nộp thuế GTGT',
-            'Tổng doanh thu HHDV bán ra',
-            'Tổng thuế GTGT của HHDV bán ra',
-            'Thuế GTGT phát sinh trong kỳ',
-            'Điều chỉnh giảm thuế GTGT phải nộp',
-            'Điều chỉnh tăng thuế GTGT phải nộp',
-            'Thuế GTGT của dự án đầu tư được bù trừ',
-            'Thuế GTGT phải nộp của HĐKD',
-            'Thuế GTGT mua vào của dự án đầu tư cùng tỉnh',
-            'Thuế GTGT còn phải nộp trong kỳ',
-            'Thuế GTGT chưa khấu trừ hết kỳ này',
-            'Thuế GTGT đề nghị hoàn',
-            'Thuế GTGT còn được khấu trừ chuyển kỳ sau',
-        ],
-        'Số tiền': [
-            get_single_value(data, 'ct21'), get_single_value(data, 'ct22'), get_single_value(data, 'ct23'),
-            get_single_value(data, 'ct24'), get_single_value(data, 'ct25'), get_single_value(data, 'ct26'),
-            get_single_value(data, 'ct29'), get_single_value(data, 'ct30'), get_single_value(data, 'ct31'),
-            get_single_value(data, 'ct32'), get_single_value(data, 'ct33'), get_single_value(data, 'ct32a'),
-            get_single_value(data, 'ct34'), get_single_value(data, 'ct35'), get_single_value(data, 'ct36'),
-            get_single_value(data, 'ct37'), get_single_value(data, 'ct38'), get_single_value(data, 'ct39a'),
-            get_single_value(data, 'ct40a'), get_single_value(data, 'ct40b'), get_single_value(data, 'ct40'),
-            get_single_value(data, 'ct41'), get_single_value(data, 'ct42'), get_single_value(data, 'ct43'),
-        ]
-    }
-    return pd.DataFrame(detailed_data)
+    return build_report_frames(gtgt_decl['data'], ['gtgt_detailed'])['gtgt_detailed']
 
 
 def generate_tndn_main_form_df(data):
     if not data: return pd.DataFrame()
-
-    tndn_main_data = {
-        'Mã chỉ tiêu': ['A1', 'B1', 'B2', 'B3', 'B4', 'B7', 'B8', 'B9', 'B10', 'B11', 'B12', 'B13', 'B14', 'C1', 'C2',
-                        'C3', 'C4', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12', 'C13', 'C14', 'C15', 'C16'],
-        'Chỉ tiêu': [
-            'A1 - Tổng lợi nhuận kế toán trước thuế TNDN',
-            'B1 - Các khoản điều chỉnh tăng tổng lợi nhuận trước thuế',
-            'B2 - Các khoản chi không được trừ',
-            'B3 - Thuế TNDN đã nộp cho phần thu nhập nhận được ở nước ngoài',
-            'B4 - Điều chỉnh tăng doanh thu',
-            'B7 - Các khoản điều chỉnh làm tăng lợi nhuận trước thuế khác',
-            'B8 - Các khoản điều chỉnh giảm tổng lợi nhuận trước thuế',
-            'B9 - Giảm trừ các khoản doanh thu đã điều chỉnh tăng',
-            'B10 - Chi phí của phần doanh thu điều chỉnh giảm',
-            'B11 - Các khoản điều chỉnh làm giảm lợi nhuận trước thuế khác',
-            'B12 - Lợi nhuận từ hoạt động BĐS',
-            'B13 - Tổng Thu nhập chịu thuế (TNCT)',
-            'B14 - TNCT từ hoạt động sản xuất, kinh doanh',
-            'C1 - Thu nhập chịu thuế',
-            'C2 - Thu nhập chịu thuế từ HĐSXKD',
-            'C3 - Thu nhập được miễn thuế',
-            'C4 - Chuyển lỗ và bù trừ lãi, lỗ',
-            'C6 - Tổng thu nhập tính thuế (TNTT)',
-            'C7 - TNTT từ HĐSXKD',
-            'C8 - Thuế TNDN từ HĐSXKD theo thuế suất 20%',
-            'C9 - Thuế TNDN phải nộp từ HĐSXKD',
-            'C10 - Thuế TNDN của hoạt động BĐS phải nộp',
-            'C11 - Thuế TNDN đã nộp ở nước ngoài được trừ trong kỳ tính thuế',
-            'C12 - Thuế TNDN đã tạm nộp',
-            'C13 - Chênh lệch giữa số thuế TNDN phải nộp và đã tạm nộp',
-            'C14 - Thuế TNDN còn phải nộp',
-            'C15 - Thuế TNDN nộp thừa',
-            'C16 - Tổng số thuế TNDN bù trừ cho các nghĩa vụ khác',
-        ],
-        'Số tiền': [
-            get_single_value(data, 'ctA1'), get_single_value(data, 'ctB1'), get_single_value(data, 'ctB2'),
-            get_single_value(data, 'ctB3'), get_single_value(data, 'ctB4'), get_single_value(data, 'ctB7'),
-            get_single_value(data, 'ctB8'), get_single_value(data, 'ctB9'), get_single_value(data, 'ctB10'),
-            get_single_value(data, 'ctB11'), get_single_value(data, 'ctB12'), get_single_value(data, 'ctB13'),
-            get_single_value(data, 'ctB14'), get_single_value(data, 'ctC1'), get_single_value(data, 'ctC2'),
-            get_single_value(data, 'ctC3'), get_single_value(data, 'ctC4'), get_single_value(data, 'ctC6'),
-            get_single_value(data, 'ctC7'), get_single_value(data, 'ctC8'), get_single_value(data, 'ctC9'),
-            get_single_value(data, 'ctC10'), get_single_value(data, 'ctC11'), get_single_value(data, 'ctC12'),
-            get_single_value(data, 'ctC13'), get_single_value(data, 'ctC14'), get_single_value(data, 'ctC15'),
-            get_single_value(data, 'ctC16'),
-        ]
-    }
-    return pd.DataFrame(tndn_main_data)
+    return build_report_frames(data, ['tndn_main'])['tndn_main']
 
 
 def generate_tndn_appendix_03_1a_df(data):
     if not data: return pd.DataFrame()
-
-    appendix_data = {
-        'Mã chỉ tiêu': ['[04]', '[05]', '[06]', '[08]', '[09]', '[11]', '[12]', '[13]', '[14]', '[15]', '[16]', '[17]',
-                        '[18]', '[19]', '[20]', '[21]', '[22]'],
-        'Chỉ tiêu': [
-            'Tổng doanh thu bán hàng hóa, dịch vụ',
-            'Doanh thu bán hàng hóa, dịch vụ xuất khẩu',
-            'Các khoản giảm trừ doanh thu',
-            'Doanh thu hoạt động tài chính',
-            'Chi phí tài chính',
-            'Chi phí sản xuất, kinh doanh hàng hóa, dịch vụ',
-            'Giá vốn hàng bán',
-            'Chi phí bán hàng',
-            'Chi phí quản lý doanh nghiệp',
-            'Lợi nhuận thuần từ hoạt động kinh doanh',
-            'Thu nhập khác',
-            'Chi phí khác',
-            'Lợi nhuận khác',
-            'Lợi nhuận từ HĐSXKD',
-            'Lợi nhuận từ hoạt động chuyển nhượng BĐS',
-            'Tổng lợi nhuận kế toán trước thuế TNDN',
-            'Trích lập quỹ KH&CN (nếu có)'
-        ],
-        'Số tiền': [
-            get_single_value(data, 'ct04'), get_single_value(data, 'ct05'), get_single_value(data, 'ct06'),
-            get_single_value(data, 'ct08'), get_single_value(data, 'ct09'), get_single_value(data, 'ct11'),
-            get_single_value(data, 'ct12'), get_single_value(data, 'ct13'), get_single_value(data, 'ct14'),
-            get_single_value(data, 'ct15'), get_single_value(data, 'ct16'), get_single_value(data, 'ct17'),
-            get_single_value(data, 'ct18'), get_single_value(data, 'ct19'), get_single_value(data, 'ct20'),
-            get_single_value(data, 'ct21'), get_single_value(data, 'ct22'),
-        ]
-    }
-    return pd.DataFrame(appendix_data)
+    return build_report_frames(data, ['tndn_appendix_03_1a'])['tndn_appendix_03_1a']
 
 
 def generate_balance_sheet_df(declarations):
-    bctc_decl = next((d for d in declarations if 'BCTC' in d['loai_tk']), None)
+    bctc_decl = as_registry(declarations).latest('BCTC')
     if not bctc_decl: return pd.DataFrame()
-    data = bctc_decl['data']
-
-    balance_sheet_data = {
-        'Chỉ tiêu': [
-            'A - TÀI SẢN NGẮN HẠN', 'I. Tiền và các khoản tương đương tiền', 'II. Đầu tư tài chính ngắn hạn',
-            'III. Các khoản phải thu ngắn hạn',
-            'IV. Hàng tồn kho', 'V. Tài sản ngắn hạn khác', 'B - TÀI SẢN DÀI HẠN', 'I. Các khoản phải thu dài hạn',
-            'II. Tài sản cố định', 'III. Bất động sản đầu tư', 'IV. Tài sản dở dang dài hạn',
-            'V. Đầu tư tài chính dài hạn',
-            'VI. Tài sản dài hạn khác', 'TỔNG CỘNG TÀI SẢN', 'C - NỢ PHẢI TRẢ', 'I. Nợ ngắn hạn', 'II. Nợ dài hạn',
-            'D - VỐN CHỦ SỞ HỮU', 'I. Vốn chủ sở hữu', 'TỔNG CỘNG NGUỒN VỐN'
-        ],
-        'Mã số': [
-            '100', '110', '120', '130', '140', '150', '200', '210', '220', '230', '240', '250', '260', '270',
-            '300', '310', '330', '400', '410', '440'
-        ],
-        'Số cuối năm': [
-            get_single_value(data, 'scn_ct100'), get_single_value(data, 'scn_ct110'),
-            get_single_value(data, 'scn_ct120'), get_single_value(data, 'scn_ct130'),
-            get_single_value(data, 'scn_ct140'), get_single_value(data, 'scn_ct150'),
-            get_single_value(data, 'scn_ct200'), get_single_value(data, 'scn_ct210'),
-            get_single_value(data, 'scn_ct220'), get_single_value(data, 'scn_ct230'),
-            get_single_value(data, 'scn_ct240'), get_single_value(data, 'scn_ct250'),
-            get_single_value(data, 'scn_ct260'), get_single_value(data, 'scn_ct270'),
-            get_single_value(data, 'scn_ct300'), get_single_value(data, 'scn_ct310'),
-            get_single_value(data, 'scn_ct330'), get_single_value(data, 'scn_ct400'),
-            get_single_value(data, 'scn_ct410'), get_single_value(data, 'scn_ct440')
-        ],
-        'Số đầu năm': [
-            get_single_value(data, 'sdn_ct100'), get_single_value(data, 'sdn_ct110'),
-            get_single_value(data, 'sdn_ct120'), get_single_value(data, 'sdn_ct130'),
-            get_single_value(data, 'sdn_ct140'), get_single_value(data, 'sdn_ct150'),
-            get_single_value(data, 'sdn_ct200'), get_single_value(data, 'sdn_ct210'),
-            get_single_value(data, 'sdn_ct220'), get_single_value(data, 'sdn_ct230'),
-            get_single_value(data, 'sdn_ct240'), get_single_value(data, 'sdn_ct250'),
-            get_single_value(data, 'sdn_ct260'), get_single_value(data, 'sdn_ct270'),
-            get_single_value(data, 'sdn_ct300'), get_single_value(data, 'sdn_ct310'),
-            get_single_value(data, 'sdn_ct330'), get_single_value(data, 'sdn_ct400'),
-            get_single_value(data, 'sdn_ct410'), get_single_value(data, 'sdn_ct440')
-        ]
-    }
-    return pd.DataFrame(balance_sheet_data)
+    return build_report_frames(bctc_decl['data'], ['balance_sheet'])['balance_sheet']
 
 
 def generate_income_statement_df(declarations):
-    bctc_decl = next((d for d in declarations if 'BCTC' in d['loai_tk']), None)
+    bctc_decl = as_registry(declarations).latest('BCTC')
     if not bctc_decl: return pd.DataFrame()
-    data = bctc_decl['data']
-
-    income_statement_data = {
-        'Chỉ tiêu': [
-            '1. Doanh thu bán hàng và cung cấp dịch vụ', '2. Các khoản giảm trừ doanh thu',
-            '3. Doanh thu thuần về bán hàng và cung cấp dịch vụ',
-            '4. Giá vốn hàng bán', '5. Lợi nhuận gộp về bán hàng và cung cấp dịch vụ',
-            '6. Doanh thu hoạt động tài chính',
-            '7. Chi phí tài chính', 'Trong đó: Chi phí lãi vay', '8. Chi phí bán hàng',
-            '9. Chi phí quản lý doanh nghiệp',
-            '10. Lợi nhuận thuần từ hoạt động kinh doanh', '11. Thu nhập khác', '12. Chi phí khác',
-            '13. Lợi nhuận khác', '14. Tổng lợi nhuận kế toán trước thuế', '15. Chi phí thuế TNDN hiện hành',
-            '16. Chi phí thuế TNDN hoãn lại', '17. Lợi nhuận sau thuế thu nhập doanh nghiệp'
-        ],
-        'Mã số': [
-            '01', '02', '10', '11', '20', '21', '22', '23', '25', '26', '30', '31', '32', '40', '50', '51', '52', '60'
-        ],
-        'Năm nay': [
-            get_single_value(data, 'kqkd_nn_ct01'), get_single_value(data, 'kqkd_nn_ct02'),
-            get_single_value(data, 'kqkd_nn_ct10'),
-            get_single_value(data, 'kqkd_nn_ct11'), get_single_value(data, 'kqkd_nn_ct20'),
-            get_single_value(data, 'kqkd_nn_ct21'),
-            get_single_value(data, 'kqkd_nn_ct22'), get_single_value(data, 'kqkd_nn_ct23'),
-            get_single_value(data, 'kqkd_nn_ct25'),
-            get_single_value(data, 'kqkd_nn_ct26'), get_single_value(data, 'kqkd_nn_ct30'),
-            get_single_value(data, 'kqkd_nn_ct31'),
-            get_single_value(data, 'kqkd_nn_ct32'), get_single_value(data, 'kqkd_nn_ct40'),
-            get_single_value(data, 'kqkd_nn_ct50'),
-            get_single_value(data, 'kqkd_nn_ct51'), get_single_value(data, 'kqkd_nn_ct52'),
-            get_single_value(data, 'kqkd_nn_ct60')
-        ],
-        'Năm trước': [
-            get_single_value(data, 'kqkd_nt_ct01'), get_single_value(data, 'kqkd_nt_ct02'),
-            get_single_value(data, 'kqkd_nt_ct10'),
-            get_single_value(data, 'kqkd_nt_ct11'), get_single_value(data, 'kqkd_nt_ct20'),
-            get_single_value(data, 'kqkd_nt_ct21'),
-            get_single_value(data, 'kqkd_nt_ct22'), get_single_value(data, 'kqkd_nt_ct23'),
-            get_single_value(data, 'kqkd_nt_ct25'),
-            get_single_value(data, 'kqkd_nt_ct26'), get_single_value(data, 'kqkd_nt_ct30'),
-            get_single_value(data, 'kqkd_nt_ct31'),
-            get_single_value(data, 'kqkd_nt_ct32'), get_single_value(data, 'kqkd_nt_ct40'),
-            get_single_value(data, 'kqkd_nt_ct50'),
-            get_single_value(data, 'kqkd_nt_ct51'), get_single_value(data, 'kqkd_nt_ct52'),
-            get_single_value(data, 'kqkd_nt_ct60')
-        ]
-    }
-    return pd.DataFrame(income_statement_data)
+    return build_report_frames(bctc_decl['data'], ['income_statement'])['income_statement']
+
+
+# Tên tài khoản theo hệ thống tài khoản (TT133/TT200); tài khoản con không có tên lấy tên tài khoản cha gần nhất
+TRIAL_BALANCE_ACCOUNTS = {
+    "111": "Tiền mặt", "112": "Tiền gửi ngân hàng", "121": "Chứng khoán kinh doanh",
+    "128": "Đầu tư nắm giữ đến ngày đáo hạn", "131": "Phải thu của khách hàng", "133": "Thuế GTGT được khấu trừ",
+    "1331": "Thuế GTGT được khấu trừ của HHDV", "1332": "Thuế GTGT được khấu trừ của TSCĐ",
+    "136": "Phải thu nội bộ", "138": "Phải thu khác", "141": "Tạm ứng", "152": "Nguyên liệu, vật liệu",
+    "153": "Công cụ, dụng cụ", "154": "Chi phí SX, KD dở dang", "155": "Thành phẩm", "156": "Hàng hóa",
+    "157": "Hàng gửi đi bán", "211": "TSCĐ hữu hình", "214": "Hao mòn TSCĐ", "229": "Dự phòng tổn thất tài sản",
+    "2293": "Dự phòng phải thu khó đòi", "2294": "Dự phòng giảm giá hàng tồn kho", "242": "Chi phí trả trước",
+    "331": "Phải trả cho người bán", "333": "Thuế và các khoản phải nộp NN", "3331": "Thuế GTGT phải nộp",
+    "33311": "Thuế GTGT đầu ra", "3334": "Thuế thu nhập doanh nghiệp", "3335": "Thuế thu nhập cá nhân",
+    "334": "Phải trả người lao động", "335": "Chi phí phải trả", "337": "Thanh toán theo tiến độ HĐXD",
+    "338": "Phải trả, phải nộp khác", "3383": "Bảo hiểm xã hội", "3387": "Doanh thu chưa thực hiện",
+    "341": "Vay và nợ thuê tài chính", "352": "Dự phòng phải trả", "411": "Vốn đầu tư của chủ sở hữu",
+    "421": "Lợi nhuận sau thuế chưa phân phối", "511": "Doanh thu bán hàng và CCDV",
+    "515": "Doanh thu hoạt động tài chính", "621": "Chi phí nguyên liệu, vật liệu trực tiếp",
+    "622": "Chi phí nhân công trực tiếp", "627": "Chi phí sản xuất chung", "632": "Giá vốn hàng bán",
+    "635": "Chi phí tài chính", "641": "Chi phí bán hàng", "642": "Chi phí quản lý doanh nghiệp",
+    "711": "Thu nhập khác", "811": "Chi phí khác", "821": "Chi phí thuế TNDN", "911": "Xác định kết quả kinh doanh",
+}
+# Khóa CĐTK đã bóc tách theo thứ tự cột của bảng: dư đầu kỳ, phát sinh, dư cuối kỳ (Nợ/Có)
+TRIAL_BALANCE_SIDES = ('sddk_no', 'sddk_co', 'ps_no', 'ps_co', 'sdck_no', 'sdck_co')
+TRIAL_BALANCE_COLUMNS = ['Số dư đầu kỳ - Nợ', 'Số dư đầu kỳ - Có', 'Số phát sinh trong kỳ - Nợ',
+                         'Số phát sinh trong kỳ - Có', 'Số dư cuối kỳ - Nợ', 'Số dư cuối kỳ - Có']
+TRIAL_BALANCE_KEY_RE = re.compile(r'^(sddk_no|sddk_co|ps_no|ps_co|sdck_no|sdck_co)_ct(\d{3,})$')
+TRIAL_BALANCE_TOLERANCE = 1  # đồng
+
+
+def trial_balance_ledger(data):
+    # Quét một lượt các khóa sddk_/ps_/sdck_ của CĐTK: trả về (số hiệu TK đã sắp xếp, mảng n x 6 số dư/phát sinh)
+    keys, accounts, columns = [], [], []
+    for key in data.keys():
+        match = TRIAL_BALANCE_KEY_RE.match(key)
+        if match:
+            keys.append(key)
+            accounts.append(match.group(2))
+            columns.append(TRIAL_BALANCE_SIDES.index(match.group(1)))
+    if isinstance(data, Declaration):
+        numbers = data.values(keys)
+    else:
+        numbers = np.array([get_single_value(data, key, 0) for key in keys], dtype=np.float64)
+    codes, rows = np.unique(np.array(accounts, dtype=object), return_inverse=True)
+    values = np.zeros((len(codes), len(TRIAL_BALANCE_SIDES)))
+    values[rows, np.array(columns, dtype=np.intp)] = numbers
+    return [str(code) for code in codes], values
+
+
+def rollup_trial_balance(accounts, values):
+    # Cộng dồn tài khoản con lên tài khoản cha (bỏ chữ số cuối đến cấp 1 = 3 chữ số), tạo tài khoản cha còn thiếu.
+    # Trả về (số hiệu TK, cấp, số liệu: kê khai nếu có, ngược lại tổng TK con, tổng TK con, có kê khai)
+    codes = set(accounts)
+    for account in accounts:
+        codes.update(account[:length] for length in range(3, len(account)))
+    codes = sorted(codes)
+    index = pd.Index(codes)
+    levels = np.array([len(code) - 2 for code in codes])
+    reported = np.zeros(len(codes), dtype=bool)
+    reported[index.get_indexer(accounts)] = True
+    totals = np.zeros((len(codes), values.shape[1]))
+    totals[index.get_indexer(accounts)] = values
+    children = np.zeros_like(totals)
+    has_children = np.zeros(len(codes), dtype=bool)
+    # Cấp sâu nhất trước: số liệu của một cấp đã đầy đủ trước khi cộng lên cấp trên
+    for level in range(levels.max(initial=1), 1, -1):
+        rows = np.flatnonzero(levels == level)
+        parents = index.get_indexer([codes[row][:-1] for row in rows])
+        np.add.at(children, parents, totals[rows])
+        has_children[parents] = True
+        upper = np.flatnonzero((levels == level - 1) & ~reported & has_children)
+        totals[upper] = children[upper]
+    return codes, levels, totals, np.where(has_children[:, None], children, np.nan), reported
+
+
+def _account_name(code):
+    for length in range(len(code), 2, -1):
+        name = TRIAL_BALANCE_ACCOUNTS.get(code[:length])
+        if name:
+            return name if length == len(code) else f"{name} (TK con)"
+    return ""
+
+
+def _bctc_ledger(declarations):
+    bctc_decl = as_registry(declarations).latest('BCTC')
+    if not bctc_decl: return None
+    accounts, values = trial_balance_ledger(bctc_decl['data'])
+    if not accounts: return None
+    return rollup_trial_balance(accounts, values)
 
 
 def generate_trial_balance_df(declarations):
-    bctc_decl = next((d for d in declarations if 'BCTC' in d['loai_tk']), None)
-    if not bctc_decl: return pd.DataFrame()
-    data = bctc_decl['data']
-
-    accounts = {
-        "ct111": "Tiền mặt", "ct112": "Tiền gửi ngân hàng", "ct121": "Chứng khoán kinh doanh",
-        "ct128": "Đầu tư nắm giữ đến ngày đáo hạn",
-        "ct131": "Phải thu của khách hàng", "ct133": "Thuế GTGT được khấu trừ", "ct141": "Tạm ứng",
-        "ct152": "Nguyên liệu, vật liệu",
-        "ct153": "Công cụ, dụng cụ", "ct154": "Chi phí SX, KD dở dang", "ct155": "Thành phẩm", "ct156": "Hàng hóa",
-        "ct157": "Hàng gửi đi bán", "ct211": "TSCĐ hữu hình", "ct214": "Hao mòn TSCĐ", "ct242": "Chi phí trả trước",
-        "ct331": "Phải trả cho người bán", "ct333": "Thuế và các khoản phải nộp NN", "ct334": "Phải trả người lao động",
-        "ct338": "Phải trả, phải nộp khác", "ct341": "Vay và nợ thuê tài chính", "ct411": "Vốn đầu tư của chủ sở hữu",
-        "ct421": "Lợi nhuận sau thuế chưa phân phối", "ct511": "Doanh thu bán hàng và CCDV",
-        "ct632": "Giá vốn hàng bán",
-        "ct641": "Chi phí bán hàng", "ct642": "Chi phí quản lý doanh nghiệp", "ct711": "Thu nhập khác",
-        "ct811": "Chi phí khác",
-        "ct911": "Xác định kết quả kinh doanh"
-    }
+    ledger = _bctc_ledger(declarations)
+    if ledger is None: return pd.DataFrame()
+    codes, levels, totals, _, reported = ledger
+    keep = np.flatnonzero(totals.any(axis=1))
+    df = pd.DataFrame(totals[keep], columns=TRIAL_BALANCE_COLUMNS)
+    df.insert(0, 'Số hiệu TK', [codes[row] for row in keep])
+    df.insert(1, 'Tên tài khoản', [_account_name(codes[row]) for row in keep])
+    df.insert(2, 'Cấp', levels[keep])
+    df.insert(3, 'Nguồn', np.where(reported[keep], "Kê khai", "Cộng từ TK con"))
+    return df
 
-    trial_balance_data = []
-    for code, name in accounts.items():
-        sddk_no = get_single_value(data, f'sddk_no_{code}', 0)
-        sddk_co = get_single_value(data, f'sddk_co_{code}', 0)
-        ps_no = get_single_value(data, f'ps_no_{code}', 0)
-        ps_co = get_single_value(data, f'ps_co_{code}', 0)
-        sdck_no = get_single_value(data, f'sdck_no_{code}', 0)
-        sdck_co = get_single_value(data, f'sdck_co_{code}', 0)
-
-        if any([sddk_no, sddk_co, ps_no, ps_co, sdck_no, sdck_co]):
-            trial_balance_data.append({
-                'Số hiệu TK': code.replace('ct', ''),
-                'Tên tài khoản': name,
-                'Số dư đầu kỳ - Nợ': sddk_no,
-                'Số dư đầu kỳ - Có': sddk_co,
-                'Số phát sinh trong kỳ - Nợ': ps_no,
-                'Số phát sinh trong kỳ - Có': ps_co,
-                'Số dư cuối kỳ - Nợ': sdck_no,
-                'Số dư cuối kỳ - Có': sdck_co,
-            })
-
-    return pd.DataFrame(trial_balance_data)
+
+def generate_trial_balance_check_df(declarations, tolerance=TRIAL_BALANCE_TOLERANCE):
+    # Kiểm tra CĐTK: tổng Nợ = tổng Có của toàn sổ (TK cấp 1, trừ TK ngoài bảng 0xx), từng tài khoản
+    # dư đầu kỳ + phát sinh = dư cuối kỳ, và tổng các TK con không vượt TK cha đã kê khai
+    # (CĐTK thường chỉ chi tiết một phần TK con, nên TK con nhỏ hơn TK cha không phải là lệch)
+    ledger = _bctc_ledger(declarations)
+    if ledger is None: return pd.DataFrame()
+    codes, levels, totals, children, reported = ledger
+    codes = np.array(codes, dtype=object)
+    rows = []
+
+    on_balance = (levels == 1) & np.array([not code.startswith('0') for code in codes])
+    ledger_total = totals[on_balance].sum(axis=0)
+    for label, column in (("Số dư đầu kỳ", 0), ("Số phát sinh trong kỳ", 2), ("Số dư cuối kỳ", 4)):
+        debit, credit = ledger_total[column], ledger_total[column + 1]
+        rows.append({'Kiểm tra': f"Tổng Nợ = Tổng Có: {label}", 'Số hiệu TK': "Toàn sổ", 'Vế trái': debit,
+                     'Vế phải': credit, 'Chênh lệch': debit - credit})
+
+    opening = totals[:, 0] - totals[:, 1]
+    movement = totals[:, 2] - totals[:, 3]
+    closing = totals[:, 4] - totals[:, 5]
+    gap = opening + movement - closing
+    for row in np.flatnonzero(reported & (np.abs(gap) > tolerance)):
+        rows.append({'Kiểm tra': "Dư đầu kỳ + Phát sinh = Dư cuối kỳ", 'Số hiệu TK': codes[row],
+                     'Vế trái': opening[row] + movement[row], 'Vế phải': closing[row], 'Chênh lệch': gap[row]})
+
+    with np.errstate(invalid='ignore'):
+        mismatched = reported & (children - totals > tolerance).any(axis=1)
+    for row in np.flatnonzero(mismatched):
+        column = int(np.nanargmax(children[row] - totals[row]))
+        rows.append({'Kiểm tra': f"Tổng TK con ≤ TK cha: {TRIAL_BALANCE_COLUMNS[column]}", 'Số hiệu TK': codes[row],
+                     'Vế trái': children[row, column], 'Vế phải': totals[row, column],
+                     'Chênh lệch': children[row, column] - totals[row, column]})
+
+    df = pd.DataFrame(rows, columns=['Kiểm tra', 'Số hiệu TK', 'Vế trái', 'Vế phải', 'Chênh lệch'])
+    df['Trạng thái'] = np.where(np.abs(df['Chênh lệch']) > tolerance, "Lệch", "Khớp")
+    return df
 
 
 def generate_tndn_summary(declarations):
-    tndn_decl = next((d for d in declarations if 'TNDN' in d['loai_tk']), None)
+    tndn_decl = as_registry(declarations).latest('03/TNDN')
     if not tndn_decl: return pd.DataFrame()
     data = tndn_decl['data']
     summary_data = {
@@ -953,7 +3122,7 @@ def generate_tndn_summary(declarations):
 
 
 def generate_tncn_summary(declarations):
-    tncn_decl = next((d for d in declarations if '05/QTT-TNCN' in d['loai_tk']), None)
+    tncn_decl = as_registry(declarations).latest('05/QTT-TNCN')
     if not tncn_decl: return pd.DataFrame(), pd.DataFrame()
     data = tncn_decl['data']
     summary_data = {
@@ -965,16 +3134,11 @@ def generate_tncn_summary(declarations):
         ]}
     summary_df = pd.DataFrame(summary_data)
 
-    def to_list(value):
-        if value is None: return []
-        return value if isinstance(value, list) else [value]
-
     details_data = {
-        'Họ và tên': to_list(data.get(XML_TAG_MAP['05/QTT-TNCN']['pl_ho_ten'])),
-        'Mã số thuế': to_list(data.get(XML_TAG_MAP['05/QTT-TNCN']['pl_mst'])),
-        'Tổng TNCT (VND)': [float(x or 0) for x in to_list(data.get(XML_TAG_MAP['05/QTT-TNCN']['pl_tnct']))],
-        'Số thuế đã khấu trừ (VND)': [float(x or 0) for x in
-                                      to_list(data.get(XML_TAG_MAP['05/QTT-TNCN']['pl_thue_da_khau_tru']))],
+        'Họ và tên': data.list(XML_TAG_MAP['05/QTT-TNCN']['pl_ho_ten']),
+        'Mã số thuế': data.list(XML_TAG_MAP['05/QTT-TNCN']['pl_mst']),
+        'Tổng TNCT (VND)': data.numbers(XML_TAG_MAP['05/QTT-TNCN']['pl_tnct']).tolist(),
+        'Số thuế đã khấu trừ (VND)': data.numbers(XML_TAG_MAP['05/QTT-TNCN']['pl_thue_da_khau_tru']).tolist(),
     }
     try:
         max_len = max(len(v) for v in details_data.values()) if details_data else 0
@@ -988,13 +3152,13 @@ def generate_tncn_summary(declarations):
 
 
 def generate_tncn_kk_summary(declarations):
-    tncn_decls = [d for d in declarations if '05/KK-TNCN' in d['loai_tk']]
-    if not tncn_decls: return pd.DataFrame()
-    periods = sorted(list(set(d['ky'] for d in tncn_decls)))
+    registry = as_registry(declarations)
+    periods = registry.periods('05/KK-TNCN')
+    if not periods: return pd.DataFrame()
     summary_data = {
         'Chỉ tiêu': ['Tổng số người lao động', 'Tổng TNCT trả cho cá nhân', 'Tổng số thuế TNCN đã khấu trừ']}
     for period in periods:
-        p_data = next((d['data'] for d in tncn_decls if d['ky'] == period), {})
+        p_data = registry.get('05/KK-TNCN', period)['data']
         tong_ld = get_single_value(p_data, XML_TAG_MAP['05/KK-TNCN']['tong_so_ld'], 0)
         tong_tnct = get_single_value(p_data, XML_TAG_MAP['05/KK-TNCN']['tong_tnct'], 0)
         tong_thue = get_single_value(p_data, XML_TAG_MAP['05/KK-TNCN']['tong_thue_da_khau_tru'], 0)
@@ -1004,514 +3168,994 @@ def generate_tncn_kk_summary(declarations):
     return df
 
 
-def run_risk_checks(declarations, gtgt_summary_df, tncn_kk_summary_df, accounting_standard,
-                    output_invoice_pre_tax_total=None, input_invoice_data=None):
-    results = []
-    tndn_decl = next((d for d in declarations if 'TNDN' in d['loai_tk']), None)
-    bctc_decl = next((d for d in declarations if 'BCTC' in d['loai_tk']), None)
-    tncn_qtt_decl = next((d for d in declarations if '05/QTT-TNCN' in d['loai_tk']), None)
-
-    tong_dt_gtgt = 0
-    dt_tndn = 0
-    if tndn_decl and not gtgt_summary_df.empty:
-        tong_dt_gtgt_series = gtgt_summary_df.loc[
-            gtgt_summary_df['Chỉ tiêu'] == 'Doanh thu chịu thuế GTGT', 'Tổng cộng']
-        tong_dt_gtgt = tong_dt_gtgt_series.iloc[0] if not tong_dt_gtgt_series.empty else 0
-        dt_tndn_pl = get_single_value(tndn_decl['data'], XML_TAG_MAP['03/TNDN']['tong_doanh_thu_pl'], 0)
-        tn_khac_tndn = get_single_value(tndn_decl['data'], XML_TAG_MAP['03/TNDN']['thu_nhap_khac'], 0)
-        dt_tndn = dt_tndn_pl + tn_khac_tndn
-        chenh_lech = tong_dt_gtgt - dt_tndn
-        results.append({
-            "Nội dung": "Doanh thu GTGT vs. Doanh thu TNDN",
-            "Số liệu A": f"{tong_dt_gtgt:,.0f} (TK GTGT)",
-            "Số liệu B": f"{dt_tndn:,.0f} (QT TNDN)",
-            "Chênh lệch": f"{chenh_lech:,.0f}",
-            "Trạng thái": "Cảnh báo" if chenh_lech != 0 else "Khớp",
-            "Gợi ý": "Đối chiếu DT bán ra trên tờ khai GTGT và QT TNDN."
-        })
-    else:
-        results.append({"Nội dung": "Doanh thu GTGT vs. Doanh thu TNDN", "Số liệu A": "N/A", "Số liệu B": "N/A",
-                        "Chênh lệch": "N/A", "Trạng thái": "Không đủ dữ liệu",
-                        "Gợi ý": "Cần tải lên cả TK GTGT năm và QT TNDN."})
-
-    if output_invoice_pre_tax_total is not None:
-        if not gtgt_summary_df.empty and tong_dt_gtgt > 0:
-            chenh_lech_gtgt = tong_dt_gtgt - output_invoice_pre_tax_total
-            results.append({
-                "Nội dung": "Doanh thu GTGT vs. Bảng kê hóa đơn",
-                "Số liệu A": f"{tong_dt_gtgt:,.0f} (TK GTGT)",
-                "Số liệu B": f"{output_invoice_pre_tax_total:,.0f} (Bảng kê HĐ)",
-                "Chênh lệch": f"{chenh_lech_gtgt:,.0f}",
-                "Trạng thái": "Cảnh báo" if chenh_lech_gtgt != 0 else "Khớp",
-                "Gợi ý": "Kiểm tra chênh lệch giữa tổng doanh thu trên các tờ khai GTGT và tổng doanh thu từ bảng kê hóa đơn bán ra."
-            })
-        if tndn_decl and dt_tndn > 0:
-            chenh_lech_tndn = dt_tndn - output_invoice_pre_tax_total
-            results.append({
-                "Nội dung": "Doanh thu TNDN vs. Bảng kê hóa đơn",
-                "Số liệu A": f"{dt_tndn:,.0f} (QT TNDN)",
-                "Số liệu B": f"{output_invoice_pre_tax_total:,.0f} (Bảng kê HĐ)",
-                "Chênh lệch": f"{chenh_lech_tndn:,.0f}",
-                "Trạng thái": "Cảnh báo" if chenh_lech_tndn != 0 else "Khớp",
-                "Gợi ý": "Kiểm tra chênh lệch giữa tổng doanh thu trên Quyết toán TNDN và tổng doanh thu từ bảng kê hóa đơn bán ra."
-            })
-    else:
-        results.append({"Nội dung": "Đối chiếu Bảng kê hóa đơn bán ra", "Số liệu A": "N/A", "Số liệu B": "N/A",
-                        "Chênh lệch": "N/A", "Trạng thái": "Không đủ dữ liệu",
-                        "Gợi ý": "Hãy tải lên Bảng kê hóa đơn bán ra để thực hiện đối chiếu."})
-
-    if tncn_qtt_decl and not tncn_kk_summary_df.empty:
-        tong_thue_kk_series = tncn_kk_summary_df.loc[
-            tncn_kk_summary_df['Chỉ tiêu'] == 'Tổng số thuế TNCN đã khấu trừ', 'Tổng cộng']
-        tong_thue_kk = tong_thue_kk_series.iloc[0] if not tong_thue_kk_series.empty else 0
-
-        thue_qtt = get_single_value(tncn_qtt_decl['data'], XML_TAG_MAP['05/QTT-TNCN']['tong_thue_da_khau_tru'], 0)
-        chenh_lech_tncn = tong_thue_kk - thue_qtt
-        results.append({
-            "Nội dung": "Đối chiếu thuế TNCN khấu trừ (Khai kỳ vs. Quyết toán)",
-            "Số liệu A": f"{tong_thue_kk:,.0f} (Tổng các kỳ)",
-            "Số liệu B": f"{thue_qtt:,.0f} (Quyết toán năm)",
-            "Chênh lệch": f"{chenh_lech_tncn:,.0f}",
-            "Trạng thái": "Cảnh báo" if chenh_lech_tncn != 0 else "Khớp",
-            "Gợi ý": "Đối chiếu tổng số thuế TNCN đã khấu trừ trên các tờ khai 05/KK-TNCN với chỉ tiêu [31] trên tờ khai 05/QTT-TNCN."
-        })
-    else:
-        results.append({"Nội dung": "Đối chiếu thuế TNCN khấu trừ (Khai kỳ vs. Quyết toán)", "Số liệu A": "N/A",
-                        "Số liệu B": "N/A",
-                        "Chênh lệch": "N/A", "Trạng thái": "Không đủ dữ liệu",
-                        "Gợi ý": "Cần tải lên cả tờ khai 05/KK-TNCN (tháng/quý) và tờ khai 05/QTT-TNCN (năm)."})
-
-    # CẬP NHẬT: Logic đối chiếu thuế GTGT đầu vào
-    gtgt_decls_data = [d['data'] for d in declarations if '01/GTGT' in d['loai_tk']]
-    if input_invoice_data and gtgt_decls_data:
-        total_ct23_from_tk = sum(get_single_value(data, 'ct23') for data in gtgt_decls_data)
-        total_ct24_from_tk = sum(get_single_value(data, 'ct24') for data in gtgt_decls_data)
-        total_ct25_from_tk = sum(get_single_value(data, 'ct25') for data in gtgt_decls_data)
-
-        total_pre_tax_from_invoice = input_invoice_data.get('valid_summary', {}).get('total_pre_tax', 0)
-        total_tax_from_invoice = input_invoice_data.get('valid_summary', {}).get('total_tax', 0)
-
-        chenh_lech_ct23 = total_ct23_from_tk - total_pre_tax_from_invoice
-        results.append({
-            "Nội dung": "GTGT đầu vào: HHDV mua vào (TK vs Bảng kê)",
-            "Số liệu A": f"{total_ct23_from_tk:,.0f} (TK GTGT - CT23)",
-            "Số liệu B": f"{total_pre_tax_from_invoice:,.0f} (Bảng kê HĐ vào)",
-            "Chênh lệch": f"{chenh_lech_ct23:,.0f}",
-            "Trạng thái": "Cảnh báo" if abs(chenh_lech_ct23) > 1 else "Khớp",
-            "Gợi ý": "Đối chiếu tổng giá trị HHDV mua vào trên các tờ khai GTGT với tổng tiền chưa thuế trên bảng kê hóa đơn đầu vào."
-        })
+# Chuỗi kỳ kê khai: mỗi loại tờ khai được xếp theo tháng đầu/cuối của kỳ (tháng, quý hoặc năm, kể cả khi chuyển
+# từ khai tháng sang khai quý); 'carry_in'/'carry_out': chỉ tiêu kỳ này nhận từ / chuyển sang kỳ sau (None = không có)
+PERIOD_CHAIN_SPECS = {
+    '01/GTGT': {'forms': ('01/GTGT',), 'carry_in': 'ct22', 'carry_out': 'ct43'},
+    '05/KK-TNCN': {'forms': ('05/KK-TNCN',), 'carry_in': None, 'carry_out': None},
+}
+PERIOD_CHAIN_COLUMNS = ['MST', 'Tờ khai', 'Kỳ', 'Kỳ trước', 'Chuyển sang kỳ sau (kỳ trước)', 'Nhận từ kỳ trước',
+                        'Chênh lệch', 'Tháng thiếu', 'Trạng thái']
+
+
+def _period_month_span(ky):
+    # (tháng đầu, tháng cuối) của kỳ dưới dạng số thứ tự tháng năm*12+tháng-1; kỳ không đọc được -> (-1, -1)
+    months = declaration_period_months(ky)
+    if not months:
+        return -1, -1
+    return months[0] // 100 * 12 + months[0] % 100 - 1, months[-1] // 100 * 12 + months[-1] % 100 - 1
+
+
+def _month_index_label(index):
+    return f"{index % 12 + 1:02d}/{index // 12}"
+
+
+def analyze_period_chain(entries, carry_in=None, carry_out=None, tolerance=1):
+    # Sắp các tờ khai theo (MST, tháng đầu kỳ) rồi so từng kỳ với kỳ liền trước bằng phép dịch mảng:
+    # kỳ liền sau phải bắt đầu ngay sau tháng cuối của kỳ trước (lớn hơn -> thiếu kỳ, nhỏ hơn -> trùng kỳ)
+    # và chỉ tiêu nhận từ kỳ trước phải bằng chỉ tiêu chuyển sang kỳ sau của kỳ trước.
+    entries = list(entries)
+    if not entries:
+        return pd.DataFrame(columns=PERIOD_CHAIN_COLUMNS)
+    spans = np.array([_period_month_span(e['ky']) for e in entries], dtype=np.int64).reshape(-1, 2)
+    msts = np.array([str(e['data'].mst) for e in entries], dtype=object)
+    mst_codes = np.unique(msts, return_inverse=True)[1]
+    order = np.lexsort((spans[:, 1], spans[:, 0], mst_codes))
+    entries = [entries[i] for i in order]
+    start, end, msts, mst_codes = spans[order, 0], spans[order, 1], msts[order], mst_codes[order]
+    keys = [key for key in (carry_in, carry_out) if key]
+    values = extract_indicator_matrix([e['data'] for e in entries], keys)
+
+    known = start >= 0
+    linked = np.r_[False, (mst_codes[1:] == mst_codes[:-1]) & known[1:] & known[:-1]]
+    prev_end = np.r_[-1, end[:-1]]
+    missing = np.where(linked, start - prev_end - 1, 0)
+    n = len(entries)
+    received = values[:, 0] if carry_in else np.full(n, np.nan)
+    carried = np.r_[np.nan, values[:-1, -1]] if carry_out else np.full(n, np.nan)
+    carried = np.where(linked, carried, np.nan)
+    diff = received - carried
+    with np.errstate(invalid='ignore'):
+        mismatched = np.abs(diff) > tolerance
+
+    status = np.full(n, "Khớp", dtype=object)
+    status[~linked] = "Kỳ đầu"
+    status[mismatched] = "Lệch số chuyển kỳ"
+    status[missing > 0] = "Thiếu kỳ trước"
+    status[missing < 0] = "Trùng kỳ"
+    status[(missing > 0) & mismatched] = "Thiếu kỳ trước; Lệch số chuyển kỳ"
+    status[(missing < 0) & mismatched] = "Trùng kỳ; Lệch số chuyển kỳ"
+    status[~known] = "Không rõ kỳ"
+    gaps = np.where(missing > 0, [
+        _month_index_label(prev + 1) if count == 1 else f"{_month_index_label(prev + 1)} - {_month_index_label(prev + count)}"
+        for prev, count in zip(prev_end, missing)], "")
+    previous = np.where(linked, np.r_[[""], [e['ky'] for e in entries[:-1]]], "")
+    return pd.DataFrame({
+        'MST': msts, 'Tờ khai': [e['loai_tk'] for e in entries], 'Kỳ': [e['ky'] for e in entries],
+        'Kỳ trước': previous, 'Chuyển sang kỳ sau (kỳ trước)': carried, 'Nhận từ kỳ trước': received,
+        'Chênh lệch': diff, 'Tháng thiếu': gaps, 'Trạng thái': status}, columns=PERIOD_CHAIN_COLUMNS)
+
+
+def generate_period_chain_df(declarations, tolerance=1):
+    registry = as_registry(declarations)
+    frames = []
+    for spec in PERIOD_CHAIN_SPECS.values():
+        entries = registry.select(*spec['forms'])
+        if entries:
+            frames.append(analyze_period_chain(entries, spec['carry_in'], spec['carry_out'], tolerance))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+# --- BỘ QUY TẮC RỦI RO (RISK RULES) ---
+# Mỗi quy tắc khai báo:
+#   'id', 'name' (Nội dung), 'kind': 'compare' | 'flag' | 'change' | 'custom' | 'notice'
+#   'standard': None = mọi chế độ kế toán, hoặc "Thông tư 133" / "Thông tư 200" / "Chưa chọn"
+#   'inputs': {bí danh: chỉ tiêu 'nguon:khoa' hoặc tuple chỉ tiêu (cộng dồn)}; thiếu nguồn -> bỏ qua quy tắc
+#   'tolerance': compare = chênh lệch tuyệt đối cho phép (đồng), change = % biến động cho phép
+#   'label_a', 'label_b', 'label_diff': mẫu chuỗi format theo bí danh (+ 'diff', 'pct')
+#   'hint' (khi cảnh báo; 'hint_neg' khi chênh lệch âm), 'hint_ok', 'status_ok', 'emit_ok', 'when', 'weight'
+#   notice: 'requires' (nguồn phải có) và 'missing_any' (thiếu một trong các nguồn -> báo không đủ dữ liệu)
+def _hint_hang_ton_kho(v):
+    hint = ""
+    if v['dt'] > 0 and v['cuoi_ky'] > v['dt'] * 2:
+        hint = f"HTK cuối kỳ ({v['cuoi_ky']:,.0f}) gấp {(v['cuoi_ky'] / v['dt']):.1f} lần doanh thu. "
+    if v['cuoi_ky'] >= v['dau_ky'] and v['dau_ky'] > 0:
+        hint += "HTK không giảm hoặc tăng so với đầu kỳ. Dấu hiệu tồn kho ảo/kém luân chuyển."
+    return hint
+
+
+def _check_lai_vay_lctt(v):
+    tien_chi_tra_lai_vay = abs(v['lctt'])
+    trang_thai, chenh_lech = "Không đủ dữ liệu", "N/A"
+    if tien_chi_tra_lai_vay > 0:
+        chenh_lech_num = v['kqkd'] - tien_chi_tra_lai_vay
+        chenh_lech = f"{chenh_lech_num:,.0f}"
+        trang_thai = "Cảnh báo" if chenh_lech_num != 0 else "Khớp"
+    return {
+        "Nội dung": "Đối chiếu Chi phí lãi vay (TT200)",
+        "Số liệu A": f"{v['kqkd']:,.0f} (CP lãi vay trên KQKD)",
+        "Số liệu B": f"{tien_chi_tra_lai_vay:,.0f} (Tiền trả lãi vay trên LCTT)" if tien_chi_tra_lai_vay > 0 else "Chưa có dữ liệu",
+        "Chênh lệch": chenh_lech,
+        "Trạng thái": trang_thai,
+        "Gợi ý": "Đối chiếu chi phí lãi vay trên KQKD và LCTT. Cần tải file XML có chứa dữ liệu LCTT để phân tích."
+    }
 
-        chenh_lech_24_25 = total_ct24_from_tk - total_ct25_from_tk
-        results.append({
-            "Nội dung": "GTGT đầu vào: Thuế mua vào vs Thuế được khấu trừ (trên TK)",
-            "Số liệu A": f"{total_ct24_from_tk:,.0f} (TK GTGT - CT24)",
-            "Số liệu B": f"{total_ct25_from_tk:,.0f} (TK GTGT - CT25)",
-            "Chênh lệch": f"{chenh_lech_24_25:,.0f}",
-            "Trạng thái": "Cảnh báo" if chenh_lech_24_25 != 0 else "OK",
-            "Gợi ý": "Kiểm tra lý do không được khấu trừ toàn bộ thuế GTGT đầu vào (nếu có)."
-        })
 
-        chenh_lech_ct25 = total_ct25_from_tk - total_tax_from_invoice
-        results.append({
-            "Nội dung": "GTGT đầu vào: Thuế được khấu trừ (TK vs Bảng kê)",
-            "Số liệu A": f"{total_ct25_from_tk:,.0f} (TK GTGT - CT25)",
-            "Số liệu B": f"{total_tax_from_invoice:,.0f} (Bảng kê HĐ vào)",
-            "Chênh lệch": f"{chenh_lech_ct25:,.0f}",
-            "Trạng thái": "Cảnh báo" if abs(chenh_lech_ct25) > 1 else "Khớp",
-            "Gợi ý": "Đối chiếu tổng thuế GTGT được khấu trừ trên các tờ khai với tổng tiền thuế trên bảng kê hóa đơn đầu vào."
-        })
+def _balance_rule(rule_id, key, name, hint, standard="Thông tư 133", emit_ok=True):
+    return {'id': rule_id, 'name': name, 'kind': 'flag', 'standard': standard, 'inputs': {'so_du': f'bctc:{key}'},
+            'flag': lambda v: v['so_du'] > 0, 'label_a': "{so_du:,.0f}", 'hint': hint,
+            'hint_ok': "Không có số dư bất thường.", 'emit_ok': emit_ok}
+
+
+def _provision_rule_tt200(code, name):
+    return {'id': f'tt200_du_phong_{code}', 'name': f"Kiểm tra khoản mục Dự phòng (TT200) - {name}", 'kind': 'flag',
+            'standard': "Thông tư 200", 'inputs': {'sdn': f'bctc:sdn_{code}', 'scn': f'bctc:scn_{code}'},
+            'flag': lambda v: (v['sdn'] > 0) | (v['scn'] > 0), 'emit_ok': False,
+            'label_a': "{sdn:,.0f} (Đầu năm)", 'label_b': "{scn:,.0f} (Cuối năm)",
+            'hint': "Có phát sinh số dư các khoản dự phòng. Yêu cầu DN giải trình về việc trích lập có đúng quy định, hồ sơ kèm theo,..."}
+
+
+def _change_rule_tt200(item, name):
+    return {'id': f'tt200_bien_dong_{item}', 'name': f"Biến động bất thường - {name}", 'kind': 'change',
+            'standard': "Thông tư 200", 'inputs': {'current': f'bctc:kqkd_nn_{item}', 'prior': f'bctc:kqkd_nt_{item}'},
+            'tolerance': 30, 'emit_ok': False,
+            'label_a': "{prior:,.0f} (Năm trước)", 'label_b': "{current:,.0f} (Năm nay)",
+            'hint': "Yêu cầu Doanh nghiệp giải trình về biến động tăng/giảm đột biến (>30%) so với cùng kỳ."}
+
+
+def _anomaly_rules(source, label):
+    # Dấu hiệu bất thường thống kê trên bảng kê (invoice_anomalies); chỉ báo khi vượt ngưỡng
+    return [
+        {'id': f'{source}_benford', 'name': f"Bất thường {label}: Phân phối chữ số đầu (Benford)", 'kind': 'flag',
+         'inputs': {'mad': f'{source}:benford_mad', 'chu_so': f'{source}:benford_chu_so',
+                    'ty_le': f'{source}:benford_ty_le'},
+         'flag': lambda v: v['mad'] > BENFORD_MAD_LIMIT, 'emit_ok': False,
+         'label_a': "{mad:.4f} (MAD chữ số đầu)", 'label_b': "Chữ số {chu_so:.0f} chiếm {ty_le:.1%}",
+         'hint': "Chữ số đầu của tiền chưa thuế lệch xa phân phối Benford. Chọn mẫu hóa đơn có chữ số đầu "
+                 "xuất hiện nhiều bất thường để kiểm tra tính có thật của giao dịch."},
+        {'id': f'{source}_duoi_nguong', 'name': f"Bất thường {label}: Hóa đơn sát dưới ngưỡng 20 triệu đồng",
+         'kind': 'flag', 'inputs': {'ty_le': f'{source}:duoi_nguong_ty_le', 'so_hd': f'{source}:duoi_nguong_so_hd'},
+         'flag': lambda v: v['ty_le'] > THRESHOLD_RATIO_LIMIT, 'emit_ok': False,
+         'label_a': "{so_hd:,.0f} hóa đơn sát dưới ngưỡng", 'label_b': "Gấp {ty_le:,.1f} lần dải trên ngưỡng",
+         'hint': "Nhiều hóa đơn có giá trị thanh toán ngay dưới 20 triệu đồng. Kiểm tra việc chia nhỏ hóa đơn "
+                 "để né thanh toán không dùng tiền mặt."},
+        {'id': f'{source}_cuoi_ky', 'name': f"Bất thường {label}: Dồn hóa đơn cuối tháng", 'kind': 'flag',
+         'inputs': {'so_thang': f'{source}:cuoi_ky_so_thang', 'ty_le': f'{source}:cuoi_ky_ty_le'},
+         'flag': lambda v: v['so_thang'] > 0, 'emit_ok': False,
+         'label_a': "{so_thang:,.0f} tháng", 'label_b': "Cao nhất gấp {ty_le:,.1f} lần bình quân",
+         'hint': f"Số hóa đơn trong {PERIOD_END_DAYS} ngày cuối tháng cao bất thường so với bình quân ngày của tháng. "
+                 "Kiểm tra việc lập hóa đơn dồn cuối kỳ để điều chỉnh số thuế."},
+        {'id': f'{source}_so_tron', 'name': f"Bất thường {label}: Số tiền tròn", 'kind': 'flag',
+         'inputs': {'ty_le': f'{source}:so_tron_ty_le'},
+         'flag': lambda v: v['ty_le'] > ROUND_AMOUNT_SHARE_LIMIT, 'emit_ok': False,
+         'label_a': "{ty_le:.1%} hóa đơn tròn triệu",
+         'hint': "Tỷ lệ hóa đơn có tiền chưa thuế tròn triệu đồng cao bất thường. Kiểm tra chứng từ giao nhận "
+                 "hàng hóa, dịch vụ kèm theo."},
+    ]
+
+
+RISK_RULES = [
+    {'id': 'dt_gtgt_vs_tndn', 'name': "Doanh thu GTGT vs. Doanh thu TNDN", 'kind': 'compare', 'weight': 3.0,
+     'inputs': {'a': 'gtgt:dt', 'b': ('tndn:ct04', 'tndn:ct19')},
+     'label_a': "{a:,.0f} (TK GTGT)", 'label_b': "{b:,.0f} (QT TNDN)",
+     'hint': "Đối chiếu DT bán ra trên tờ khai GTGT và QT TNDN."},
+    {'id': 'thieu_dt_gtgt_tndn', 'name': "Doanh thu GTGT vs. Doanh thu TNDN", 'kind': 'notice',
+     'missing_any': ('gtgt', 'tndn'), 'hint': "Cần tải lên cả TK GTGT năm và QT TNDN."},
+    {'id': 'dt_gtgt_vs_hd_ra', 'name': "Doanh thu GTGT vs. Bảng kê hóa đơn", 'kind': 'compare', 'weight': 3.0,
+     'inputs': {'a': 'gtgt:dt', 'b': 'hd_ra:total_pre_tax'}, 'when': lambda v: v['a'] > 0,
+     'label_a': "{a:,.0f} (TK GTGT)", 'label_b': "{b:,.0f} (Bảng kê HĐ)",
+     'hint': "Kiểm tra chênh lệch giữa tổng doanh thu trên các tờ khai GTGT và tổng doanh thu từ bảng kê hóa đơn bán ra."},
+    {'id': 'dt_tndn_vs_hd_ra', 'name': "Doanh thu TNDN vs. Bảng kê hóa đơn", 'kind': 'compare', 'weight': 3.0,
+     'inputs': {'a': ('tndn:ct04', 'tndn:ct19'), 'b': 'hd_ra:total_pre_tax'}, 'when': lambda v: v['a'] > 0,
+     'label_a': "{a:,.0f} (QT TNDN)", 'label_b': "{b:,.0f} (Bảng kê HĐ)",
+     'hint': "Kiểm tra chênh lệch giữa tổng doanh thu trên Quyết toán TNDN và tổng doanh thu từ bảng kê hóa đơn bán ra."},
+    {'id': 'thieu_hd_ra', 'name': "Đối chiếu Bảng kê hóa đơn bán ra", 'kind': 'notice', 'missing_any': ('hd_ra',),
+     'hint': "Hãy tải lên Bảng kê hóa đơn bán ra để thực hiện đối chiếu."},
+    {'id': 'tncn_kk_vs_qtt', 'name': "Đối chiếu thuế TNCN khấu trừ (Khai kỳ vs. Quyết toán)", 'kind': 'compare',
+     'weight': 2.0, 'inputs': {'a': 'tncn_kk:ct29', 'b': 'tncn_qtt:ct31'},
+     'label_a': "{a:,.0f} (Tổng các kỳ)", 'label_b': "{b:,.0f} (Quyết toán năm)",
+     'hint': "Đối chiếu tổng số thuế TNCN đã khấu trừ trên các tờ khai 05/KK-TNCN với chỉ tiêu [31] trên tờ khai 05/QTT-TNCN."},
+    {'id': 'thieu_tncn', 'name': "Đối chiếu thuế TNCN khấu trừ (Khai kỳ vs. Quyết toán)", 'kind': 'notice',
+     'missing_any': ('tncn_kk', 'tncn_qtt'),
+     'hint': "Cần tải lên cả tờ khai 05/KK-TNCN (tháng/quý) và tờ khai 05/QTT-TNCN (năm)."},
+    {'id': 'gtgt_ct23_vs_hd_vao', 'name': "GTGT đầu vào: HHDV mua vào (TK vs Bảng kê)", 'kind': 'compare',
+     'weight': 2.0, 'tolerance': 1, 'inputs': {'a': 'gtgt01:ct23', 'b': 'hd_vao:total_pre_tax'},
+     'label_a': "{a:,.0f} (TK GTGT - CT23)", 'label_b': "{b:,.0f} (Bảng kê HĐ vào)",
+     'hint': "Đối chiếu tổng giá trị HHDV mua vào trên các tờ khai GTGT với tổng tiền chưa thuế trên bảng kê hóa đơn đầu vào."},
+    {'id': 'gtgt_ct24_vs_ct25', 'name': "GTGT đầu vào: Thuế mua vào vs Thuế được khấu trừ (trên TK)",
+     'kind': 'compare', 'status_ok': "OK", 'requires': ('hd_vao',), 'inputs': {'a': 'gtgt01:ct24', 'b': 'gtgt01:ct25'},
+     'label_a': "{a:,.0f} (TK GTGT - CT24)", 'label_b': "{b:,.0f} (TK GTGT - CT25)",
+     'hint': "Kiểm tra lý do không được khấu trừ toàn bộ thuế GTGT đầu vào (nếu có)."},
+    {'id': 'gtgt_ct25_vs_hd_vao', 'name': "GTGT đầu vào: Thuế được khấu trừ (TK vs Bảng kê)", 'kind': 'compare',
+     'weight': 2.0, 'tolerance': 1, 'inputs': {'a': 'gtgt01:ct25', 'b': 'hd_vao:total_tax'},
+     'label_a': "{a:,.0f} (TK GTGT - CT25)", 'label_b': "{b:,.0f} (Bảng kê HĐ vào)",
+     'hint': "Đối chiếu tổng thuế GTGT được khấu trừ trên các tờ khai với tổng tiền thuế trên bảng kê hóa đơn đầu vào."},
+    {'id': 'thieu_gtgt_dau_vao', 'name': "Đối chiếu thuế GTGT đầu vào", 'kind': 'notice',
+     'missing_any': ('gtgt01', 'hd_vao'), 'hint': "Cần tải lên cả tờ khai GTGT và Bảng kê hóa đơn đầu vào."},
+    *_anomaly_rules('hd_ra_bt', "HĐ bán ra"),
+    *_anomaly_rules('hd_vao_bt', "HĐ mua vào"),
+    {'id': 'chua_chon_che_do', 'name': "Phân tích BCTC", 'kind': 'notice', 'standard': "Chưa chọn", 'requires': ('bctc',),
+     'hint': "Vui lòng chọn Chế độ kế toán (TT133/TT200) để thực hiện đối chiếu BCTC."},
+    {'id': 'thieu_bctc', 'name': "Phân tích BCTC", 'kind': 'notice', 'missing_any': ('bctc',),
+     'hint': "Cần tải lên file Báo cáo tài chính."},
+
+    # Thông tư 133
+    {'id': 'tt133_lai_vay', 'name': "Chi phí lãi vay bất thường", 'kind': 'flag', 'standard': "Thông tư 133",
+     'inputs': {'tien': 'bctc:scn_ct110', 'lai_vay': 'bctc:kqkd_nn_ct23'},
+     'flag': lambda v: (v['tien'] > 1000000000) & (v['lai_vay'] > 0),
+     'label_a': "{tien:,.0f} (Tiền)", 'label_b': "{lai_vay:,.0f} (CP Lãi vay)",
+     'hint': "Xem xét tính hợp lý khi có lượng tiền mặt lớn nhưng vẫn đi vay."},
+    {'id': 'tt133_131', 'name': "Đối chiếu PS Nợ TK 131", 'kind': 'compare', 'standard': "Thông tư 133", 'weight': 2.0,
+     'inputs': {'a': 'bctc:ps_no_ct131', 'b': ('bctc:ps_co_ct511', 'bctc:ps_co_ct3331', 'bctc:ps_co_ct711')},
+     'label_a': "{a:,.0f} (PS Nợ 131)", 'label_b': "{b:,.0f} (PS Có 511+3331+711)",
+     'hint': "PS Nợ 131 > PS Có (511+3331+711). Rủi ro ghi nhận thiếu doanh thu.",
+     'hint_neg': "PS Nợ 131 < PS Có (511+3331+711). Yêu cầu làm rõ, đối chiếu TK đối ứng.", 'hint_ok': "OK"},
+    {'id': 'tt133_dt_kqkd_cdtk', 'name': "Doanh thu trên KQKD vs CĐTK", 'kind': 'compare', 'standard': "Thông tư 133",
+     'inputs': {'a': 'bctc:kqkd_nn_ct01', 'b': ('bctc:ps_co_ct511', 'bctc:ps_co_ct512')},
+     'label_a': "{a:,.0f} (KQKD)", 'label_b': "{b:,.0f} (PS Có 511+512)",
+     'hint': "Đối chiếu số liệu doanh thu giữa các phụ lục BCTC."},
+    {'id': 'tt133_154_155', 'name': "Chi phí dở dang vs. Thành phẩm (TK 154 vs 155)", 'kind': 'compare',
+     'standard': "Thông tư 133", 'weight': 1.5, 'inputs': {'a': 'bctc:ps_no_ct155', 'b': 'bctc:ps_co_ct154'},
+     'label_a': "{b:,.0f} (PS Có 154)", 'label_b': "{a:,.0f} (PS Nợ 155)",
+     'hint': "PS Nợ 155 > PS Có 154. Yêu cầu đối chiếu với PS Nợ 632 và PS Có 511/512.",
+     'hint_neg': "PS Có 154 > PS Nợ 155. Dấu hiệu bán hàng không nhập kho, biếu tặng không ghi nhận doanh thu.",
+     'hint_ok': "OK"},
+    {'id': 'tt133_cpsx_154', 'name': "Kết chuyển chi phí SX (TK 154 vs 621, 622, 627)", 'kind': 'compare',
+     'standard': "Thông tư 133",
+     'inputs': {'a': 'bctc:ps_co_ct154', 'b': ('bctc:ps_no_ct621', 'bctc:ps_no_ct622', 'bctc:ps_no_ct627')},
+     'label_a': "{a:,.0f} (PS Có 154)", 'label_b': "{b:,.0f} (PS Nợ 621+622+627)",
+     'hint': "Kiểm tra việc kết chuyển chi phí sản xuất vào TK 154."},
+    {'id': 'tt133_hang_ban_tra_lai', 'name': "Hàng bán trả lại", 'kind': 'flag', 'standard': "Thông tư 133",
+     'inputs': {'tra_lai': 'bctc:kqkd_nn_ct02'}, 'flag': lambda v: v['tra_lai'] > 0,
+     'label_a': "{tra_lai:,.0f} (Giảm trừ DT)",
+     'hint': "Có phát sinh hàng bán trả lại. Yêu cầu cung cấp chi tiết PS Có TK 632 để kiểm tra việc giảm giá vốn.",
+     'hint_ok': "Không có hàng bán trả lại."},
+    {'id': 'tt133_152_621', 'name': "Xuất kho NVL vs. Chi phí NVL (TK 152 vs 621)", 'kind': 'compare',
+     'standard': "Thông tư 133", 'weight': 1.5, 'inputs': {'a': 'bctc:ps_co_ct152', 'b': 'bctc:ps_no_ct621'},
+     'label_a': "{a:,.0f} (PS Có 152)", 'label_b': "{b:,.0f} (PS Nợ 621)",
+     'hint': "PS Có 152 > PS Nợ 621. Dấu hiệu xuất NVL để trao đổi/bán không ghi nhận doanh thu.",
+     'hint_neg': "PS Có 152 < PS Nợ 621. Nghi vấn ghi nhận chi phí NVL nhưng không xuất kho (thiếu hóa đơn).",
+     'hint_ok': "OK"},
+    {'id': 'tt133_htk_ao', 'name': "Rủi ro hàng tồn kho ảo", 'kind': 'flag', 'standard': "Thông tư 133", 'weight': 2.0,
+     'inputs': {'dt': 'bctc:kqkd_nn_ct01', 'dau_ky': 'bctc:sdn_ct140', 'cuoi_ky': 'bctc:scn_ct140'},
+     'flag': lambda v: ((v['dt'] > 0) & (v['cuoi_ky'] > v['dt'] * 2))
+                       | ((v['cuoi_ky'] >= v['dau_ky']) & (v['dau_ky'] > 0)),
+     'label_a': "{dau_ky:,.0f} (HTK Đầu kỳ)", 'label_b': "{cuoi_ky:,.0f} (HTK Cuối kỳ)",
+     'label_diff': "{htk_tang:,.0f}", 'derived': {'htk_tang': lambda v: v['cuoi_ky'] - v['dau_ky']},
+     'hint': _hint_hang_ton_kho, 'hint_ok': "OK"},
+    _balance_rule('tt133_du_co_131', 'sdck_co_ct131', 'Dư Có TK 131',
+                  'Kiểm tra chi tiết: Nếu là người mua trả trước, kiểm tra hợp đồng. Nếu hàng đã tiêu thụ, phải ghi nhận doanh thu tính thuế.'),
+    _balance_rule('tt133_du_co_337', 'sdck_co_ct337', 'Dư Có TK 337 (Hợp đồng XD)',
+                  'Kiểm tra hợp đồng, tiến độ để ghi nhận doanh thu theo hạng mục hoàn thành.'),
+    _balance_rule('tt133_du_co_3387', 'sdck_co_ct3387', 'Dư Có TK 3387 (DT chưa thực hiện)',
+                  'Kiểm tra chi tiết: Nếu hàng đã giao, BĐS đã bàn giao, hạng mục XD đã hoàn thành, phải ghi nhận doanh thu tính thuế.'),
+    _balance_rule('tt133_du_no_157', 'sdck_no_ct157', 'Dư Nợ TK 157 (Hàng gửi bán)',
+                  'Kiểm tra chi tiết: Nếu hàng đã gửi cho khách hàng, phải ghi nhận doanh thu tính thuế theo quy định.'),
+    _balance_rule('tt133_du_no_136', 'sdck_no_ct136', 'Dư Nợ TK 136 (Phải thu nội bộ)',
+                  'Kiểm tra chi tiết: Nếu là tiền bán hàng nội bộ, phải ghi nhận doanh thu tính thuế.'),
+    _balance_rule('tt133_du_no_138', 'sdck_no_ct138', 'Dư Nợ TK 138 (Phải thu khác)',
+                  'Kiểm tra chi tiết khoản phải thu khác. Nếu là giao dịch hàng hóa/dịch vụ, phải ghi nhận doanh thu.'),
+    _balance_rule('tt133_du_co_138', 'sdck_co_ct138', 'Dư Có TK 138 (Phải trả khác)',
+                  'Kiểm tra chi tiết khoản thu thừa. Nếu là giao dịch hàng hóa/dịch vụ, phải ghi nhận doanh thu.'),
+    {'id': 'tt133_gia_von', 'name': "Xuất kho TP, HH vs. Giá vốn (TK 155, 156 vs 632)", 'kind': 'compare',
+     'standard': "Thông tư 133", 'inputs': {'a': ('bctc:ps_co_ct155', 'bctc:ps_co_ct156'), 'b': 'bctc:ps_no_ct632'},
+     'label_a': "{a:,.0f} (PS Có 155+156)", 'label_b': "{b:,.0f} (PS Nợ 632)",
+     'hint': "Xuất kho > Giá vốn. Dấu hiệu xuất tiêu thụ/biếu tặng không ghi nhận giá vốn, hoặc hàng bán trả lại không giảm giá vốn.",
+     'hint_neg': "Xuất kho < Giá vốn. Có thể do dự phòng giảm giá HTK. Nếu không, có thể là hàng mua bán thẳng không qua kho. Cần đối chiếu PS Có TK 511/512.",
+     'hint_ok': "OK"},
+    {'id': 'tt133_du_phong_2293', 'name': "Dự phòng phải thu khó đòi (TK 2293/139)", 'kind': 'flag',
+     'standard': "Thông tư 133", 'inputs': {'trich_lap': 'bctc:ps_no_ct2293', 'hoan_nhap': 'bctc:ps_co_ct2293'},
+     'flag': lambda v: (v['trich_lap'] > 0) | (v['hoan_nhap'] > 0), 'emit_ok': False,
+     'label_a': "{trich_lap:,.0f} (Trích lập)", 'label_b': "{hoan_nhap:,.0f} (Hoàn nhập)",
+     'hint': "Có phát sinh dự phòng phải thu khó đòi. Yêu cầu kiểm tra sự tương ứng với sự tăng/giảm của các khoản phải thu."},
+    _balance_rule('tt133_du_co_335', 'sdck_co_ct335', 'Dư Có TK 335 (Chi phí phải trả)',
+                  'Kiểm tra chi tiết, đặc biệt là dự phòng bảo hành công trình xây lắp đã hết thời hạn mà chưa hoàn nhập.',
+                  emit_ok=False),
+    _balance_rule('tt133_du_co_352', 'sdck_co_ct352', 'Dư Có TK 352 (Dự phòng phải trả)',
+                  'Kiểm tra chi tiết các khoản dự phòng đã trích lập nhưng không sử dụng hoặc không dùng hết mà chưa hoàn nhập.',
+                  emit_ok=False),
+    _balance_rule('tt133_du_no_242', 'sdck_no_ct242', 'Dư Nợ TK 242 (Chi phí trả trước)',
+                  'Kiểm tra chi tiết các khoản chi phí trả trước để đảm bảo phân bổ đúng kỳ.', emit_ok=False),
+    {'id': 'tt133_thanh_ly_tscd', 'name': "Rủi ro thanh lý TSCĐ, bán phế liệu", 'kind': 'flag',
+     'standard': "Thông tư 133", 'inputs': {'thu_nhap': 'bctc:ps_co_ct711', 'chi_phi': 'bctc:ps_no_ct811'},
+     'flag': lambda v: v['chi_phi'] > 0, 'emit_ok': False,
+     'label_a': "{thu_nhap:,.0f} (Thu nhập khác)", 'label_b': "{chi_phi:,.0f} (Chi phí khác)",
+     'hint': "Có phát sinh Chi phí khác. Yêu cầu cung cấp chi tiết TK 711 và 811 để kiểm tra việc hạch toán thu nhập từ thanh lý TSCĐ, bán phế liệu."},
+
+    # Thông tư 200
+    {'id': 'tt200_lai_vay', 'name': "Rủi ro Tiền và Chi phí lãi vay (TT200)", 'kind': 'flag', 'standard': "Thông tư 200",
+     'inputs': {'tien': 'bctc:scn_ct110', 'lai_vay': 'bctc:kqkd_nn_ct23'},
+     'flag': lambda v: (v['tien'] > 1000000000) & (v['lai_vay'] > 0),
+     'label_a': "{tien:,.0f} (Tiền và TĐT - Mã 110)", 'label_b': "{lai_vay:,.0f} (CP lãi vay - Mã 23)",
+     'hint': "Lượng tiền mặt lớn nhưng vẫn phát sinh chi phí lãi vay. Cần xem xét tính hợp lý của các khoản vay."},
+    {'id': 'tt200_phai_thu_noi_bo', 'name': "Rủi ro Phải thu nội bộ ngắn hạn (TT200)", 'kind': 'flag',
+     'standard': "Thông tư 200", 'inputs': {'so_du': 'bctc:scn_ct133'}, 'flag': lambda v: v['so_du'] > 0,
+     'emit_ok': False, 'label_a': "{so_du:,.0f} (Mã 133)",
+     'hint': "Có phát sinh Phải thu nội bộ. Cần kiểm tra chi tiết các giao dịch trong tập đoàn/công ty mẹ-con để tránh bỏ sót doanh thu."},
+    {'id': 'tt200_phai_thu_khac', 'name': "Rủi ro Phải thu ngắn hạn khác (TT200)", 'kind': 'flag',
+     'standard': "Thông tư 200", 'inputs': {'so_du': 'bctc:scn_ct136'}, 'flag': lambda v: v['so_du'] > 0,
+     'emit_ok': False, 'label_a': "{so_du:,.0f} (Mã 136)",
+     'hint': "Có phát sinh Phải thu ngắn hạn khác. Cần kiểm tra chi tiết để đảm bảo không có doanh thu bị ghi nhận sai vào khoản mục này."},
+    _provision_rule_tt200('ct137', 'Dự phòng phải thu ngắn hạn khó đòi (*)'),
+    _provision_rule_tt200('ct149', 'Dự phòng giảm giá hàng tồn kho (*)'),
+    _provision_rule_tt200('ct219', 'Dự phòng phải thu dài hạn khó đòi (*)'),
+    _provision_rule_tt200('ct321', 'Quỹ khen thưởng, phúc lợi (*)'),
+    {'id': 'tt200_thue_gtgt_kt', 'name': "Đối chiếu Thuế GTGT được khấu trừ (TT200)", 'kind': 'compare',
+     'standard': "Thông tư 200", 'weight': 1.5, 'inputs': {'a': 'bctc:scn_ct152', 'b': 'gtgt01_cuoi:ct43'},
+     'label_a': "{a:,.0f} (BCTC - Mã 152)", 'label_b': "{b:,.0f} (TK GTGT cuối kỳ - Chỉ tiêu 43)",
+     'hint': "Số dư Thuế GTGT được khấu trừ trên BCTC không khớp với số thuế còn được khấu trừ chuyển kỳ sau trên tờ khai GTGT cuối cùng của năm. Yêu cầu DN giải trình."},
+    {'id': 'thieu_gtgt_cuoi_ky', 'name': "Đối chiếu Thuế GTGT được khấu trừ (TT200)", 'kind': 'notice',
+     'standard': "Thông tư 200", 'requires': ('bctc',), 'missing_any': ('gtgt01_cuoi',),
+     'hint': "Cần tải lên tờ khai GTGT của kỳ cuối cùng trong năm để thực hiện đối chiếu."},
+    {'id': 'tt200_giao_dich_lien_ket', 'name': "Kiểm tra Giao dịch liên kết (TT200)", 'kind': 'flag',
+     'standard': "Thông tư 200", 'inputs': {'cty_con': 'bctc:scn_ct251', 'lkld': 'bctc:scn_ct252'},
+     'flag': lambda v: (v['cty_con'] > 0) | (v['lkld'] > 0), 'emit_ok': False,
+     'label_a': "{cty_con:,.0f} (Đầu tư vào cty con)", 'label_b': "{lkld:,.0f} (Đầu tư vào LKLĐ)",
+     'hint': "Có phát sinh các khoản đầu tư vào công ty con/liên kết, liên doanh. Cần kiểm tra xem doanh nghiệp có kê khai Phụ lục giao dịch liên kết kèm theo Tờ khai quyết toán thuế TNDN hay không."},
+    {'id': 'tt200_nguoi_mua_tra_truoc', 'name': "Rủi ro Người mua trả tiền trước (TT200)", 'kind': 'flag',
+     'standard': "Thông tư 200", 'inputs': {'ngan_han': 'bctc:scn_ct312', 'dai_han': 'bctc:scn_ct332'},
+     'flag': lambda v: (v['ngan_han'] > 0) | (v['dai_han'] > 0), 'emit_ok': False,
+     'label_a': "{ngan_han:,.0f} (Ngắn hạn - Mã 312)", 'label_b': "{dai_han:,.0f} (Dài hạn - Mã 332)",
+     'hint': "Có phát sinh khoản người mua trả tiền trước. Yêu cầu DN giải trình chi tiết, có nguy cơ bỏ sót doanh thu."},
+    {'id': 'tt200_phai_tra_nld', 'name': "Rủi ro Phải trả người lao động (TT200)", 'kind': 'flag',
+     'standard': "Thông tư 200", 'inputs': {'so_du': 'bctc:scn_ct314'}, 'flag': lambda v: v['so_du'] > 0,
+     'emit_ok': False, 'label_a': "{so_du:,.0f} (Mã 314)",
+     'hint': "Yêu cầu DN giải trình đến 31/3 năm sau đã chi hết chưa, cung cấp chứng từ. Nếu chi không hết, có thể bị xuất toán chi phí."},
+    {'id': 'tt200_dt_chua_thuc_hien', 'name': "Rủi ro Doanh thu chưa thực hiện (TT200)", 'kind': 'flag',
+     'standard': "Thông tư 200", 'inputs': {'ngan_han': 'bctc:scn_ct318', 'dai_han': 'bctc:scn_ct336'},
+     'flag': lambda v: (v['ngan_han'] > 0) | (v['dai_han'] > 0), 'emit_ok': False,
+     'label_a': "{ngan_han:,.0f} (Ngắn hạn - Mã 318)", 'label_b': "{dai_han:,.0f} (Dài hạn - Mã 336)",
+     'hint': "Có phát sinh doanh thu chưa thực hiện. Yêu cầu DN cung cấp chi tiết để đảm bảo đã ghi nhận đầy đủ doanh thu."},
+    {'id': 'tt200_lai_vay_lctt', 'name': "Đối chiếu Chi phí lãi vay (TT200)", 'kind': 'custom',
+     'standard': "Thông tư 200", 'inputs': {'kqkd': 'bctc:kqkd_nn_ct23', 'lctt': 'bctc:lctt_nn_ct04'},
+     'evaluate': _check_lai_vay_lctt},
+    _change_rule_tt200('ct01', "Doanh thu bán hàng"),
+    _change_rule_tt200('ct11', "Giá vốn hàng bán"),
+    _change_rule_tt200('ct25', "Chi phí bán hàng"),
+    _change_rule_tt200('ct26', "Chi phí QLDN"),
+    _change_rule_tt200('ct31', "Thu nhập khác"),
+]
+
+
+# Khóa không tồn tại trong tờ khai/bảng kê: nhận 0 khi nguồn có mặt, NaN khi vắng mặt
+PRESENCE_KEY = '_co_du_lieu'
+
+
+def _rule_indicators(rule):
+    names = []
+    for spec in rule.get('inputs', {}).values():
+        names.extend(spec if isinstance(spec, tuple) else (spec,))
+    return names
+
+
+def _indicator_source(name):
+    return name.split(':', 1)[0]
+
+
+def rule_sources(rule):
+    # Các nguồn dữ liệu một quy tắc phụ thuộc (dùng để bỏ qua quy tắc thiếu dữ liệu và tính lại từng phần)
+    sources = {_indicator_source(name) for name in _rule_indicators(rule)}
+    return sources | set(rule.get('requires', ())) | set(rule.get('missing_any', ()))
+
+
+def evaluate_rule(rule, values, present, accounting_standard):
+    # Đánh giá một quy tắc trên bộ chỉ tiêu đã lấy sẵn; trả về một dòng kết quả hoặc None nếu không áp dụng
+    standard = rule.get('standard')
+    if standard is not None and standard != accounting_standard:
+        return None
+    if not all(source in present for source in rule.get('requires', ())):
+        return None
+    kind = rule['kind']
+    if kind == 'notice':
+        missing_any = rule.get('missing_any', ())
+        if missing_any and all(source in present for source in missing_any):
+            return None
+        return {"Nội dung": rule['name'], "Số liệu A": "N/A", "Số liệu B": "N/A", "Chênh lệch": "N/A",
+                "Trạng thái": "Không đủ dữ liệu", "Gợi ý": rule['hint']}
+    if not all(_indicator_source(name) in present for name in _rule_indicators(rule)):
+        return None
+
+    v = {alias: sum(values[name] for name in spec) if isinstance(spec, tuple) else values[spec]
+         for alias, spec in rule['inputs'].items()}
+    when = rule.get('when')
+    if when is not None and not when(v):
+        return None
+    if kind == 'custom':
+        return rule['evaluate'](v)
+    for alias, func in rule.get('derived', {}).items():
+        v[alias] = func(v)
+
+    if kind == 'compare':
+        v['diff'] = v['a'] - v['b']
+        flagged = abs(v['diff']) > rule.get('tolerance', 0)
+        label_diff, status_ok = "{diff:,.0f}", "Khớp"
+    elif kind == 'change':
+        if v['prior'] == 0:
+            return None
+        v['pct'] = ((v['current'] - v['prior']) / v['prior']) * 100
+        flagged = abs(v['pct']) > rule.get('tolerance', 0)
+        label_diff, status_ok = "{pct:,.2f}%", "OK"
     else:
-        results.append({"Nội dung": "Đối chiếu thuế GTGT đầu vào", "Số liệu A": "N/A", "Số liệu B": "N/A",
-                        "Chênh lệch": "N/A", "Trạng thái": "Không đủ dữ liệu",
-                        "Gợi ý": "Cần tải lên cả tờ khai GTGT và Bảng kê hóa đơn đầu vào."})
-
-    if bctc_decl:
-        if accounting_standard == "Chưa chọn":
-            results.append({"Nội dung": "Phân tích BCTC", "Số liệu A": "N/A", "Số liệu B": "N/A", "Chênh lệch": "N/A",
-                            "Trạng thái": "Không đủ dữ liệu",
-                            "Gợi ý": "Vui lòng chọn Chế độ kế toán (TT133/TT200) để thực hiện đối chiếu BCTC."})
-
-        elif accounting_standard == "Thông tư 133":
-            bctc_data = bctc_decl.get('data', {})
-            doanh_thu_kqkd = get_single_value(bctc_data, 'kqkd_nn_ct01', 0)
-            tien_mat = get_single_value(bctc_data, 'scn_ct110', 0)
-            chi_phi_lai_vay = get_single_value(bctc_data, 'kqkd_nn_ct23', 0)
-            is_risk = tien_mat > 1000000000 and chi_phi_lai_vay > 0
-            results.append({
-                "Nội dung": "Chi phí lãi vay bất thường",
-                "Số liệu A": f"{tien_mat:,.0f} (Tiền)",
-                "Số liệu B": f"{chi_phi_lai_vay:,.0f} (CP Lãi vay)",
-                "Chênh lệch": "N/A",
-                "Trạng thái": "Cảnh báo" if is_risk else "OK",
-                "Gợi ý": "Xem xét tính hợp lý khi có lượng tiền mặt lớn nhưng vẫn đi vay."
-            })
-
-            ps_no_131 = get_single_value(bctc_data, 'ps_no_ct131', 0)
-            ps_co_511 = get_single_value(bctc_data, 'ps_co_ct511', 0)
-            ps_co_3331 = get_single_value(bctc_data, 'ps_co_ct3331', 0)
-            ps_co_711 = get_single_value(bctc_data, 'ps_co_ct711', 0)
-            tong_co = ps_co_511 + ps_co_3331 + ps_co_711
-            chenh_lech_131 = ps_no_131 - tong_co
-            goi_y_131 = "OK"
-            if chenh_lech_131 > 0:
-                goi_y_131 = "PS Nợ 131 > PS Có (511+3331+711). Rủi ro ghi nhận thiếu doanh thu."
-            elif chenh_lech_131 < 0:
-                goi_y_131 = "PS Nợ 131 < PS Có (511+3331+711). Yêu cầu làm rõ, đối chiếu TK đối ứng."
-            results.append({
-                "Nội dung": "Đối chiếu PS Nợ TK 131",
-                "Số liệu A": f"{ps_no_131:,.0f} (PS Nợ 131)",
-                "Số liệu B": f"{tong_co:,.0f} (PS Có 511+3331+711)",
-                "Chênh lệch": f"{chenh_lech_131:,.0f}",
-                "Trạng thái": "Cảnh báo" if chenh_lech_131 != 0 else "Khớp",
-                "Gợi ý": goi_y_131
-            })
-
-            ps_co_512 = get_single_value(bctc_data, 'ps_co_ct512', 0)
-            tong_ps_co_dt = ps_co_511 + ps_co_512
-            chenh_lech_dt = doanh_thu_kqkd - tong_ps_co_dt
-            results.append({
-                "Nội dung": "Doanh thu trên KQKD vs CĐTK",
-                "Số liệu A": f"{doanh_thu_kqkd:,.0f} (KQKD)",
-                "Số liệu B": f"{tong_ps_co_dt:,.0f} (PS Có 511+512)",
-                "Chênh lệch": f"{chenh_lech_dt:,.0f}",
-                "Trạng thái": "Cảnh báo" if chenh_lech_dt != 0 else "Khớp",
-                "Gợi ý": "Đối chiếu số liệu doanh thu giữa các phụ lục BCTC."
-            })
-
-            ps_co_154 = get_single_value(bctc_data, 'ps_co_ct154', 0)
-            ps_no_155 = get_single_value(bctc_data, 'ps_no_ct155', 0)
-            chenh_lech_154_155 = ps_no_155 - ps_co_154
-            goi_y_154_155 = "OK"
-            if chenh_lech_154_155 != 0:
-                if chenh_lech_154_155 > 0:
-                    goi_y_154_155 = "PS Nợ 155 > PS Có 154. Yêu cầu đối chiếu với PS Nợ 632 và PS Có 511/512."
-                else:
-                    goi_y_154_155 = "PS Có 154 > PS Nợ 155. Dấu hiệu bán hàng không nhập kho, biếu tặng không ghi nhận doanh thu."
-            results.append({
-                "Nội dung": "Chi phí dở dang vs. Thành phẩm (TK 154 vs 155)",
-                "Số liệu A": f"{ps_co_154:,.0f} (PS Có 154)",
-                "Số liệu B": f"{ps_no_155:,.0f} (PS Nợ 155)",
-                "Chênh lệch": f"{chenh_lech_154_155:,.0f}",
-                "Trạng thái": "Cảnh báo" if chenh_lech_154_155 != 0 else "Khớp",
-                "Gợi ý": goi_y_154_155
-            })
-
-            ps_no_621 = get_single_value(bctc_data, 'ps_no_ct621', 0)
-            ps_no_622 = get_single_value(bctc_data, 'ps_no_ct622', 0)
-            ps_no_627 = get_single_value(bctc_data, 'ps_no_ct627', 0)
-            tong_chi_phi_sx = ps_no_621 + ps_no_622 + ps_no_627
-            chenh_lech_cpsx = ps_co_154 - tong_chi_phi_sx
-            results.append({
-                "Nội dung": "Kết chuyển chi phí SX (TK 154 vs 621, 622, 627)",
-                "Số liệu A": f"{ps_co_154:,.0f} (PS Có 154)",
-                "Số liệu B": f"{tong_chi_phi_sx:,.0f} (PS Nợ 621+622+627)",
-                "Chênh lệch": f"{chenh_lech_cpsx:,.0f}",
-                "Trạng thái": "Cảnh báo" if chenh_lech_cpsx != 0 else "Khớp",
-                "Gợi ý": "Kiểm tra việc kết chuyển chi phí sản xuất vào TK 154."
-            })
-
-            hang_ban_tra_lai = get_single_value(bctc_data, 'kqkd_nn_ct02', 0)
-            results.append({
-                "Nội dung": "Hàng bán trả lại",
-                "Số liệu A": f"{hang_ban_tra_lai:,.0f} (Giảm trừ DT)",
-                "Số liệu B": "N/A", "Chênh lệch": "N/A",
-                "Trạng thái": "Cảnh báo" if hang_ban_tra_lai > 0 else "OK",
-                "Gợi ý": "Có phát sinh hàng bán trả lại. Yêu cầu cung cấp chi tiết PS Có TK 632 để kiểm tra việc giảm giá vốn." if hang_ban_tra_lai > 0 else "Không có hàng bán trả lại."
-            })
-
-            ps_co_152 = get_single_value(bctc_data, 'ps_co_ct152', 0)
-            chenh_lech_152_621 = ps_co_152 - ps_no_621
-            goi_y_152_621 = "OK"
-            if chenh_lech_152_621 < 0:
-                goi_y_152_621 = "PS Có 152 < PS Nợ 621. Nghi vấn ghi nhận chi phí NVL nhưng không xuất kho (thiếu hóa đơn)."
-            elif chenh_lech_152_621 > 0:
-                goi_y_152_621 = "PS Có 152 > PS Nợ 621. Dấu hiệu xuất NVL để trao đổi/bán không ghi nhận doanh thu."
-            results.append({
-                "Nội dung": "Xuất kho NVL vs. Chi phí NVL (TK 152 vs 621)",
-                "Số liệu A": f"{ps_co_152:,.0f} (PS Có 152)",
-                "Số liệu B": f"{ps_no_621:,.0f} (PS Nợ 621)",
-                "Chênh lệch": f"{chenh_lech_152_621:,.0f}",
-                "Trạng thái": "Cảnh báo" if chenh_lech_152_621 != 0 else "Khớp",
-                "Gợi ý": goi_y_152_621
-            })
-
-            htk_dau_ky = get_single_value(bctc_data, 'sdn_ct140', 0)
-            htk_cuoi_ky = get_single_value(bctc_data, 'scn_ct140', 0)
-            goi_y_htk = "OK"
-            trang_thai_htk = "OK"
-            if doanh_thu_kqkd > 0 and htk_cuoi_ky > (doanh_thu_kqkd * 2):
-                trang_thai_htk = "Cảnh báo"
-                goi_y_htk = f"HTK cuối kỳ ({htk_cuoi_ky:,.0f}) gấp {(htk_cuoi_ky / doanh_thu_kqkd):.1f} lần doanh thu. "
-            if htk_cuoi_ky >= htk_dau_ky and htk_dau_ky > 0:
-                if trang_thai_htk != "Cảnh báo": goi_y_htk = ""
-                trang_thai_htk = "Cảnh báo"
-                goi_y_htk += "HTK không giảm hoặc tăng so với đầu kỳ. Dấu hiệu tồn kho ảo/kém luân chuyển."
-            results.append({
-                "Nội dung": "Rủi ro hàng tồn kho ảo",
-                "Số liệu A": f"{htk_dau_ky:,.0f} (HTK Đầu kỳ)",
-                "Số liệu B": f"{htk_cuoi_ky:,.0f} (HTK Cuối kỳ)",
-                "Chênh lệch": f"{htk_cuoi_ky - htk_dau_ky:,.0f}",
-                "Trạng thái": trang_thai_htk,
-                "Gợi ý": goi_y_htk
-            })
-
-            balance_checks = [
-                {'tk': 'sdck_co_ct131', 'name': 'Dư Có TK 131',
-                 'hint': 'Kiểm tra chi tiết: Nếu là người mua trả trước, kiểm tra hợp đồng. Nếu hàng đã tiêu thụ, phải ghi nhận doanh thu tính thuế.'},
-                {'tk': 'sdck_co_ct337', 'name': 'Dư Có TK 337 (Hợp đồng XD)',
-                 'hint': 'Kiểm tra hợp đồng, tiến độ để ghi nhận doanh thu theo hạng mục hoàn thành.'},
-                {'tk': 'sdck_co_ct3387', 'name': 'Dư Có TK 3387 (DT chưa thực hiện)',
-                 'hint': 'Kiểm tra chi tiết: Nếu hàng đã giao, BĐS đã bàn giao, hạng mục XD đã hoàn thành, phải ghi nhận doanh thu tính thuế.'},
-                {'tk': 'sdck_no_ct157', 'name': 'Dư Nợ TK 157 (Hàng gửi bán)',
-                 'hint': 'Kiểm tra chi tiết: Nếu hàng đã gửi cho khách hàng, phải ghi nhận doanh thu tính thuế theo quy định.'},
-                {'tk': 'sdck_no_ct136', 'name': 'Dư Nợ TK 136 (Phải thu nội bộ)',
-                 'hint': 'Kiểm tra chi tiết: Nếu là tiền bán hàng nội bộ, phải ghi nhận doanh thu tính thuế.'},
-                {'tk': 'sdck_no_ct138', 'name': 'Dư Nợ TK 138 (Phải thu khác)',
-                 'hint': 'Kiểm tra chi tiết khoản phải thu khác. Nếu là giao dịch hàng hóa/dịch vụ, phải ghi nhận doanh thu.'},
-                {'tk': 'sdck_co_ct138', 'name': 'Dư Có TK 138 (Phải trả khác)',
-                 'hint': 'Kiểm tra chi tiết khoản thu thừa. Nếu là giao dịch hàng hóa/dịch vụ, phải ghi nhận doanh thu.'},
-            ]
-            for check in balance_checks:
-                balance = get_single_value(bctc_data, check['tk'], 0)
-                results.append({
-                    "Nội dung": check['name'],
-                    "Số liệu A": f"{balance:,.0f}",
-                    "Số liệu B": "N/A", "Chênh lệch": "N/A",
-                    "Trạng thái": "Cảnh báo" if balance > 0 else "OK",
-                    "Gợi ý": check['hint'] if balance > 0 else "Không có số dư bất thường."
-                })
-
-            ps_co_155 = get_single_value(bctc_data, 'ps_co_ct155', 0)
-            ps_co_156 = get_single_value(bctc_data, 'ps_co_ct156', 0)
-            ps_no_632 = get_single_value(bctc_data, 'ps_no_ct632', 0)
-            tong_xuat_kho = ps_co_155 + ps_co_156
-            chenh_lech_gvon = tong_xuat_kho - ps_no_632
-            goi_y_gvon = "OK"
-            if chenh_lech_gvon != 0:
-                if chenh_lech_gvon > 0:
-                    goi_y_gvon = "Xuất kho > Giá vốn. Dấu hiệu xuất tiêu thụ/biếu tặng không ghi nhận giá vốn, hoặc hàng bán trả lại không giảm giá vốn."
-                else:
-                    goi_y_gvon = "Xuất kho < Giá vốn. Có thể do dự phòng giảm giá HTK. Nếu không, có thể là hàng mua bán thẳng không qua kho. Cần đối chiếu PS Có TK 511/512."
-            results.append({
-                "Nội dung": "Xuất kho TP, HH vs. Giá vốn (TK 155, 156 vs 632)",
-                "Số liệu A": f"{tong_xuat_kho:,.0f} (PS Có 155+156)",
-                "Số liệu B": f"{ps_no_632:,.0f} (PS Nợ 632)",
-                "Chênh lệch": f"{chenh_lech_gvon:,.0f}",
-                "Trạng thái": "Cảnh báo" if chenh_lech_gvon != 0 else "Khớp",
-                "Gợi ý": goi_y_gvon
-            })
-
-            ps_no_2293 = get_single_value(bctc_data, 'ps_no_ct2293', 0)
-            ps_co_2293 = get_single_value(bctc_data, 'ps_co_ct2293', 0)
-            if ps_no_2293 > 0 or ps_co_2293 > 0:
-                results.append({
-                    "Nội dung": "Dự phòng phải thu khó đòi (TK 2293/139)",
-                    "Số liệu A": f"{ps_no_2293:,.0f} (Trích lập)",
-                    "Số liệu B": f"{ps_co_2293:,.0f} (Hoàn nhập)",
-                    "Chênh lệch": "N/A",
-                    "Trạng thái": "Cảnh báo",
-                    "Gợi ý": "Có phát sinh dự phòng phải thu khó đòi. Yêu cầu kiểm tra sự tương ứng với sự tăng/giảm của các khoản phải thu."
-                })
-
-            balance_checks_provision = [
-                {'tk': 'sdck_co_ct335', 'name': 'Dư Có TK 335 (Chi phí phải trả)',
-                 'hint': 'Kiểm tra chi tiết, đặc biệt là dự phòng bảo hành công trình xây lắp đã hết thời hạn mà chưa hoàn nhập.'},
-                {'tk': 'sdck_co_ct352', 'name': 'Dư Có TK 352 (Dự phòng phải trả)',
-                 'hint': 'Kiểm tra chi tiết các khoản dự phòng đã trích lập nhưng không sử dụng hoặc không dùng hết mà chưa hoàn nhập.'},
-                {'tk': 'sdck_no_ct242', 'name': 'Dư Nợ TK 242 (Chi phí trả trước)',
-                 'hint': 'Kiểm tra chi tiết các khoản chi phí trả trước để đảm bảo phân bổ đúng kỳ.'},
-            ]
-            for check in balance_checks_provision:
-                balance = get_single_value(bctc_data, check['tk'], 0)
-                if balance > 0:
-                    results.append({
-                        "Nội dung": check['name'],
-                        "Số liệu A": f"{balance:,.0f}", "Số liệu B": "N/A", "Chênh lệch": "N/A",
-                        "Trạng thái": "Cảnh báo", "Gợi ý": check['hint']
-                    })
-
-            ps_no_811 = get_single_value(bctc_data, 'ps_no_ct811', 0)
-            ps_co_711 = get_single_value(bctc_data, 'ps_co_ct711', 0)
-            if ps_no_811 > 0:
-                results.append({
-                    "Nội dung": "Rủi ro thanh lý TSCĐ, bán phế liệu",
-                    "Số liệu A": f"{ps_co_711:,.0f} (Thu nhập khác)",
-                    "Số liệu B": f"{ps_no_811:,.0f} (Chi phí khác)",
-                    "Chênh lệch": "N/A",
-                    "Trạng thái": "Cảnh báo",
-                    "Gợi ý": "Có phát sinh Chi phí khác. Yêu cầu cung cấp chi tiết TK 711 và 811 để kiểm tra việc hạch toán thu nhập từ thanh lý TSCĐ, bán phế liệu."
-                })
-
-        elif accounting_standard == "Thông tư 200":
-            bctc_data = bctc_decl.get('data', {})
-
-            tien_mat = get_single_value(bctc_data, 'scn_ct110', 0)
-            chi_phi_lai_vay = get_single_value(bctc_data, 'kqkd_nn_ct23', 0)
-            is_risk_tien_lai_vay = tien_mat > 1000000000 and chi_phi_lai_vay > 0
-            results.append({
-                "Nội dung": "Rủi ro Tiền và Chi phí lãi vay (TT200)",
-                "Số liệu A": f"{tien_mat:,.0f} (Tiền và TĐT - Mã 110)",
-                "Số liệu B": f"{chi_phi_lai_vay:,.0f} (CP lãi vay - Mã 23)",
-                "Chênh lệch": "N/A",
-                "Trạng thái": "Cảnh báo" if is_risk_tien_lai_vay else "OK",
-                "Gợi ý": "Lượng tiền mặt lớn nhưng vẫn phát sinh chi phí lãi vay. Cần xem xét tính hợp lý của các khoản vay."
-            })
-
-            phai_thu_noi_bo = get_single_value(bctc_data, 'scn_ct133', 0)
-            if phai_thu_noi_bo > 0:
-                results.append({
-                    "Nội dung": "Rủi ro Phải thu nội bộ ngắn hạn (TT200)",
-                    "Số liệu A": f"{phai_thu_noi_bo:,.0f} (Mã 133)",
-                    "Số liệu B": "N/A", "Chênh lệch": "N/A",
-                    "Trạng thái": "Cảnh báo",
-                    "Gợi ý": "Có phát sinh Phải thu nội bộ. Cần kiểm tra chi tiết các giao dịch trong tập đoàn/công ty mẹ-con để tránh bỏ sót doanh thu."
-                })
-
-            phai_thu_khac = get_single_value(bctc_data, 'scn_ct136', 0)
-            if phai_thu_khac > 0:
-                results.append({
-                    "Nội dung": "Rủi ro Phải thu ngắn hạn khác (TT200)",
-                    "Số liệu A": f"{phai_thu_khac:,.0f} (Mã 136)",
-                    "Số liệu B": "N/A", "Chênh lệch": "N/A",
-                    "Trạng thái": "Cảnh báo",
-                    "Gợi ý": "Có phát sinh Phải thu ngắn hạn khác. Cần kiểm tra chi tiết để đảm bảo không có doanh thu bị ghi nhận sai vào khoản mục này."
-                })
-
-            provision_checks = [
-                {'code': 'ct137', 'name': 'Dự phòng phải thu ngắn hạn khó đòi (*)'},
-                {'code': 'ct149', 'name': 'Dự phòng giảm giá hàng tồn kho (*)'},
-                {'code': 'ct219', 'name': 'Dự phòng phải thu dài hạn khó đòi (*)'},
-                {'code': 'ct321', 'name': 'Quỹ khen thưởng, phúc lợi (*)'},
-            ]
-            for check in provision_checks:
-                balance_sdn = get_single_value(bctc_data, f"sdn_{check['code']}", 0)
-                balance_scn = get_single_value(bctc_data, f"scn_{check['code']}", 0)
-                if balance_sdn > 0 or balance_scn > 0:
-                    results.append({
-                        "Nội dung": f"Kiểm tra khoản mục Dự phòng (TT200) - {check['name']}",
-                        "Số liệu A": f"{balance_sdn:,.0f} (Đầu năm)",
-                        "Số liệu B": f"{balance_scn:,.0f} (Cuối năm)",
-                        "Chênh lệch": "N/A",
-                        "Trạng thái": "Cảnh báo",
-                        "Gợi ý": "Có phát sinh số dư các khoản dự phòng. Yêu cầu DN giải trình về việc trích lập có đúng quy định, hồ sơ kèm theo,..."
-                    })
-
-            vat_decls_in_year = [d for d in declarations if '01/GTGT' in d['loai_tk']]
-            if vat_decls_in_year:
-                last_vat_decl = max(vat_decls_in_year, key=lambda x: x['ky'])
-                vat_ct43 = get_single_value(last_vat_decl['data'], 'ct43', 0)
-                bctc_ct152 = get_single_value(bctc_data, 'scn_ct152', 0)
-                chenh_lech_vat = bctc_ct152 - vat_ct43
-                results.append({
-                    "Nội dung": "Đối chiếu Thuế GTGT được khấu trừ (TT200)",
-                    "Số liệu A": f"{bctc_ct152:,.0f} (BCTC - Mã 152)",
-                    "Số liệu B": f"{vat_ct43:,.0f} (TK GTGT cuối kỳ - Chỉ tiêu 43)",
-                    "Chênh lệch": f"{chenh_lech_vat:,.0f}",
-                    "Trạng thái": "Cảnh báo" if chenh_lech_vat != 0 else "Khớp",
-                    "Gợi ý": "Số dư Thuế GTGT được khấu trừ trên BCTC không khớp với số thuế còn được khấu trừ chuyển kỳ sau trên tờ khai GTGT cuối cùng của năm. Yêu cầu DN giải trình."
-                })
-            else:
-                results.append({
-                    "Nội dung": "Đối chiếu Thuế GTGT được khấu trừ (TT200)",
-                    "Số liệu A": "N/A", "Số liệu B": "N/A", "Chênh lệch": "N/A",
-                    "Trạng thái": "Không đủ dữ liệu",
-                    "Gợi ý": "Cần tải lên tờ khai GTGT của kỳ cuối cùng trong năm để thực hiện đối chiếu."
-                })
-
-            dau_tu_cty_con = get_single_value(bctc_data, 'scn_ct251', 0)
-            dau_tu_lkld = get_single_value(bctc_data, 'scn_ct252', 0)
-            if dau_tu_cty_con > 0 or dau_tu_lkld > 0:
-                results.append({
-                    "Nội dung": "Kiểm tra Giao dịch liên kết (TT200)",
-                    "Số liệu A": f"{dau_tu_cty_con:,.0f} (Đầu tư vào cty con)",
-                    "Số liệu B": f"{dau_tu_lkld:,.0f} (Đầu tư vào LKLĐ)",
-                    "Chênh lệch": "N/A",
-                    "Trạng thái": "Cảnh báo",
-                    "Gợi ý": "Có phát sinh các khoản đầu tư vào công ty con/liên kết, liên doanh. Cần kiểm tra xem doanh nghiệp có kê khai Phụ lục giao dịch liên kết kèm theo Tờ khai quyết toán thuế TNDN hay không."
-                })
-
-            prepayment_short = get_single_value(bctc_data, 'scn_ct312', 0)
-            prepayment_long = get_single_value(bctc_data, 'scn_ct332', 0)
-            if prepayment_short > 0 or prepayment_long > 0:
-                results.append({
-                    "Nội dung": "Rủi ro Người mua trả tiền trước (TT200)",
-                    "Số liệu A": f"{prepayment_short:,.0f} (Ngắn hạn - Mã 312)",
-                    "Số liệu B": f"{prepayment_long:,.0f} (Dài hạn - Mã 332)",
-                    "Chênh lệch": "N/A",
-                    "Trạng thái": "Cảnh báo",
-                    "Gợi ý": "Có phát sinh khoản người mua trả tiền trước. Yêu cầu DN giải trình chi tiết, có nguy cơ bỏ sót doanh thu."
-                })
-
-            payable_employees = get_single_value(bctc_data, 'scn_ct314', 0)
-            if payable_employees > 0:
-                results.append({
-                    "Nội dung": "Rủi ro Phải trả người lao động (TT200)",
-                    "Số liệu A": f"{payable_employees:,.0f} (Mã 314)",
-                    "Số liệu B": "N/A",
-                    "Chênh lệch": "N/A",
-                    "Trạng thái": "Cảnh báo",
-                    "Gợi ý": "Yêu cầu DN giải trình đến 31/3 năm sau đã chi hết chưa, cung cấp chứng từ. Nếu chi không hết, có thể bị xuất toán chi phí."
-                })
-
-            unearned_revenue_short = get_single_value(bctc_data, 'scn_ct318', 0)
-            unearned_revenue_long = get_single_value(bctc_data, 'scn_ct336', 0)
-            if unearned_revenue_short > 0 or unearned_revenue_long > 0:
-                results.append({
-                    "Nội dung": "Rủi ro Doanh thu chưa thực hiện (TT200)",
-                    "Số liệu A": f"{unearned_revenue_short:,.0f} (Ngắn hạn - Mã 318)",
-                    "Số liệu B": f"{unearned_revenue_long:,.0f} (Dài hạn - Mã 336)",
-                    "Chênh lệch": "N/A",
-                    "Trạng thái": "Cảnh báo",
-                    "Gợi ý": "Có phát sinh doanh thu chưa thực hiện. Yêu cầu DN cung cấp chi tiết để đảm bảo đã ghi nhận đầy đủ doanh thu."
-                })
-
-            cplv_kqkd = get_single_value(bctc_data, 'kqkd_nn_ct23', 0)
-            tien_chi_tra_lai_vay = abs(get_single_value(bctc_data, 'lctt_nn_ct04', 0))
-
-            trang_thai_lctt = "Không đủ dữ liệu"
-            chenh_lech_lctt = "N/A"
-            if tien_chi_tra_lai_vay > 0:
-                chenh_lech_num = cplv_kqkd - tien_chi_tra_lai_vay
-                chenh_lech_lctt = f"{chenh_lech_num:,.0f}"
-                trang_thai_lctt = "Cảnh báo" if chenh_lech_num != 0 else "Khớp"
-
-            results.append({
-                "Nội dung": "Đối chiếu Chi phí lãi vay (TT200)",
-                "Số liệu A": f"{cplv_kqkd:,.0f} (CP lãi vay trên KQKD)",
-                "Số liệu B": f"{tien_chi_tra_lai_vay:,.0f} (Tiền trả lãi vay trên LCTT)" if tien_chi_tra_lai_vay > 0 else "Chưa có dữ liệu",
-                "Chênh lệch": chenh_lech_lctt,
-                "Trạng thái": trang_thai_lctt,
-                "Gợi ý": "Đối chiếu chi phí lãi vay trên KQKD và LCTT. Cần tải file XML có chứa dữ liệu LCTT để phân tích."
-            })
-
-            items_to_check = {
-                "Doanh thu bán hàng": ('kqkd_nn_ct01', 'kqkd_nt_ct01'),
-                "Giá vốn hàng bán": ('kqkd_nn_ct11', 'kqkd_nt_ct11'),
-                "Chi phí bán hàng": ('kqkd_nn_ct25', 'kqkd_nt_ct25'),
-                "Chi phí QLDN": ('kqkd_nn_ct26', 'kqkd_nt_ct26'),
-                "Thu nhập khác": ('kqkd_nn_ct31', 'kqkd_nt_ct31'),
-            }
-            for name, (current_key, prior_key) in items_to_check.items():
-                current_val = get_single_value(bctc_data, current_key, 0)
-                prior_val = get_single_value(bctc_data, prior_key, 0)
-
-                if prior_val != 0:
-                    change_pct = ((current_val - prior_val) / prior_val) * 100
-                    if abs(change_pct) > 30:
-                        results.append({
-                            "Nội dung": f"Biến động bất thường - {name}",
-                            "Số liệu A": f"{prior_val:,.0f} (Năm trước)",
-                            "Số liệu B": f"{current_val:,.0f} (Năm nay)",
-                            "Chênh lệch": f"{change_pct:,.2f}%",
-                            "Trạng thái": "Cảnh báo",
-                            "Gợi ý": "Yêu cầu Doanh nghiệp giải trình về biến động tăng/giảm đột biến (>30%) so với cùng kỳ."
-                        })
+        flagged = bool(rule['flag'](v))
+        label_diff, status_ok = "N/A", "OK"
+    if not flagged and not rule.get('emit_ok', True):
+        return None
 
+    if flagged:
+        hint = rule['hint_neg'] if 'hint_neg' in rule and v['diff'] < 0 else rule['hint']
     else:
-        results.append({"Nội dung": "Phân tích BCTC", "Số liệu A": "N/A", "Số liệu B": "N/A", "Chênh lệch": "N/A",
-                        "Trạng thái": "Không đủ dữ liệu", "Gợi ý": "Cần tải lên file Báo cáo tài chính."})
+        hint = rule.get('hint_ok', rule['hint'])
+    return {
+        "Nội dung": rule['name'],
+        "Số liệu A": rule.get('label_a', "N/A").format(**v),
+        "Số liệu B": rule.get('label_b', "N/A").format(**v),
+        "Chênh lệch": rule.get('label_diff', label_diff).format(**v),
+        "Trạng thái": "Cảnh báo" if flagged else rule.get('status_ok', status_ok),
+        "Gợi ý": hint(v) if callable(hint) else hint
+    }
 
-    return results
+
+def risk_dossier(declarations, output_invoice_data=None, input_invoice_data=None):
+    # Hồ sơ của một người nộp thuế theo định dạng build_indicator_matrix
+    return {'declarations': as_registry(declarations), 'output_invoice_data': output_invoice_data,
+            'input_invoice_data': input_invoice_data}
+
+
+class CompiledRiskRules:
+    # Bộ quy tắc đã biên dịch: gom mọi chỉ tiêu cần dùng để lấy một lượt, ghi nhớ nguồn phụ thuộc của từng quy tắc
+    def __init__(self, rules=None):
+        self.rules = list(RISK_RULES if rules is None else rules)
+        self.sources = {rule['id']: rule_sources(rule) for rule in self.rules}
+        self.indicators = []
+        for rule in self.rules:
+            self.indicators.extend(name for name in _rule_indicators(rule) if name not in self.indicators)
+        # Nguồn chỉ xuất hiện trong điều kiện thiếu dữ liệu vẫn cần một cột để biết có mặt hay không
+        fetched = {_indicator_source(name) for name in self.indicators}
+        for source in sorted(set().union(*self.sources.values()) - fetched):
+            self.indicators.append(f"{source}:{PRESENCE_KEY}")
+
+    def fetch(self, dossier):
+        # Lấy toàn bộ chỉ tiêu một lần; nguồn vắng mặt cho NaN
+        row = build_indicator_matrix({'': dossier}, self.indicators).iloc[0]
+        values = row.to_dict()
+        present = {_indicator_source(name) for name, value in values.items() if not np.isnan(value)}
+        return values, present
+
+    def affected_by(self, sources=(), standard_changed=False):
+        # Các quy tắc cần đánh giá lại khi nguồn dữ liệu thay đổi hoặc khi đổi chế độ kế toán
+        sources = set(sources)
+        return [rule['id'] for rule in self.rules
+                if self.sources[rule['id']] & sources or (standard_changed and rule.get('standard') is not None)]
+
+    def evaluate(self, values, present, accounting_standard, only=None, previous=None, timings=None):
+        # Một lượt qua toàn bộ quy tắc; với previous + only chỉ tính lại các quy tắc trong only
+        outcomes = {}
+        for rule in self.rules:
+            rule_id = rule['id']
+            if only is not None and previous is not None and rule_id not in only and rule_id in previous:
+                outcomes[rule_id] = previous[rule_id]
+                continue
+            started = time.perf_counter()
+            outcomes[rule_id] = evaluate_rule(rule, values, present, accounting_standard)
+            if timings is not None:
+                timings[rule_id] = time.perf_counter() - started
+        return outcomes
+
+    @staticmethod
+    def results(outcomes):
+        return [result for result in outcomes.values() if result is not None]
+
+
+_compiled_risk_rules = None
+
+
+def get_compiled_risk_rules():
+    global _compiled_risk_rules
+    if _compiled_risk_rules is None:
+        _compiled_risk_rules = CompiledRiskRules()
+    return _compiled_risk_rules
+
+
+def run_risk_checks(declarations, accounting_standard, output_invoice_data=None, input_invoice_data=None):
+    compiled = get_compiled_risk_rules()
+    values, present = compiled.fetch(risk_dossier(declarations, output_invoice_data, input_invoice_data))
+    return compiled.results(compiled.evaluate(values, present, accounting_standard))
+
+
+# --- SÀNG LỌC RỦI RO DANH MỤC (NHIỀU NGƯỜI NỘP THUẾ) ---
+def _rel_gap(a, b):
+    # Độ lệch tương đối |a - b| / max(|a|, |b|, 1), dùng làm mức độ nghiêm trọng (0..1) của một chênh lệch
+    return np.minimum(1.0, np.abs(a - b) / np.maximum(np.maximum(np.abs(a), np.abs(b)), 1.0))
+
+
+def portfolio_indicators(rules=None):
+    # Các chỉ tiêu (kèm cột đánh dấu nguồn có mặt) cần cho bộ quy tắc và cho so sánh tỷ số theo nhóm
+    indicators = CompiledRiskRules(rules).indicators
+    return indicators + [name for name in peer_ratio_indicators() if name not in indicators]
+
+
+def _source_declarations(registry, forms, how):
+    # Các tờ khai đóng góp cho một nguồn chỉ tiêu của một người nộp thuế
+    entries = registry.select(*forms)
+    if how == 'latest':
+        return [entries[-1]['data']] if entries else []
+    # Mỗi kỳ chỉ lấy một tờ khai, ưu tiên loại đứng trước trong danh sách (01/GTGT trước 02/GTGT)
+    chosen = {}
+    for entry in entries:
+        current = chosen.get(entry['ky'])
+        if current is None or forms.index(entry['loai_tk']) < forms.index(current['loai_tk']):
+            chosen[entry['ky']] = entry
+    return [entry['data'] for entry in chosen.values()]
+
+
+def build_indicator_matrix(dossiers, indicators=None):
+    # Ma trận người nộp thuế x chỉ tiêu từ nhiều hồ sơ đã bóc tách.
+    # dossiers: {mst: {'declarations': DeclarationRegistry, 'output_invoice_data': ..., 'input_invoice_data': ...}}
+    # Nguồn vắng mặt (không có tờ khai/bảng kê) cho NaN; chỉ tiêu thiếu trong tờ khai có mặt cho 0.
+    msts = list(dossiers)
+    indicators = list(indicators or portfolio_indicators())
+    derived = {name: DERIVED_INDICATORS[name] for name in indicators if name in DERIVED_INDICATORS}
+    base_names = [name for name in indicators if name not in derived]
+    for parts in derived.values():
+        base_names.extend(part for part in parts if part not in base_names)
+
+    by_source = {}
+    for name in base_names:
+        source, key = name.split(':', 1)
+        by_source.setdefault(source, []).append(key)
+
+    columns = {}
+    for source, keys in by_source.items():
+        matrix = np.full((len(msts), len(keys)), np.nan)
+        if source in INVOICE_INDICATOR_SOURCES:
+            data_key, summary_key = INVOICE_INDICATOR_SOURCES[source]
+            for row, mst in enumerate(msts):
+                invoice_data = dossiers[mst].get(data_key)
+                if invoice_data and summary_key in invoice_data:
+                    summary = invoice_data[summary_key]
+                    matrix[row] = [summary.get(key, 0) for key in keys]
+        else:
+            forms, how = INDICATOR_SOURCES[source]
+            owners, declarations = [], []
+            for row, mst in enumerate(msts):
+                for data in _source_declarations(dossiers[mst]['declarations'], forms, how):
+                    owners.append(row)
+                    declarations.append(data)
+            if declarations:
+                owners = np.asarray(owners, dtype=np.intp)
+                values = extract_indicator_matrix(declarations, keys)
+                present = np.unique(owners)
+                matrix[present] = 0.0
+                np.add.at(matrix, owners, values)
+        for i, key in enumerate(keys):
+            columns[f"{source}:{key}"] = matrix[:, i]
+
+    for name, parts in derived.items():
+        columns[name] = np.sum([columns[part] for part in parts], axis=0)
+    frame = pd.DataFrame({name: columns[name] for name in indicators}, index=pd.Index(msts, name='mst'))
+    return frame
+
+
+def rule_severity(rule, values):
+    # Mức độ (0..1) của một quy tắc trên cả cột chỉ tiêu; None với quy tắc không vector hóa được
+    kind = rule['kind']
+    if kind in ('notice', 'custom'):
+        return None
+    v = {alias: np.sum([values[name] for name in spec], axis=0) if isinstance(spec, tuple) else values[spec]
+         for alias, spec in rule['inputs'].items()}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if kind == 'compare':
+            severity = np.where(np.abs(v['a'] - v['b']) > rule.get('tolerance', 0), _rel_gap(v['a'], v['b']), 0.0)
+        elif kind == 'change':
+            change = np.abs(v['current'] - v['prior']) * 100
+            severity = ((v['prior'] != 0) & (change > rule.get('tolerance', 0) * np.abs(v['prior']))) * 1.0
+        else:
+            severity = np.asarray(rule['flag'](v), dtype=np.float64)
+        if rule.get('when') is not None:
+            severity = np.where(rule['when'](v), severity, np.nan)
+    return severity
+
+
+def screen_portfolio(matrix, accounting_standard="Chưa chọn", rules=None):
+    # Chạy các quy tắc dạng cột trên toàn bộ ma trận và xếp hạng điểm rủi ro.
+    # accounting_standard: một giá trị cho cả danh mục hoặc Series theo MST.
+    rules = RISK_RULES if rules is None else rules
+    standards = accounting_standard if isinstance(accounting_standard, pd.Series) else pd.Series(
+        accounting_standard, index=matrix.index)
+    standards = standards.reindex(matrix.index).to_numpy()
+    values = {name: matrix[name].to_numpy(dtype=np.float64) for name in matrix.columns}
+    present = {}
+    for name, column in values.items():
+        present.setdefault(_indicator_source(name), ~np.isnan(column))
+
+    severities = {}
+    score = np.zeros(len(matrix))
+    flags = np.zeros(len(matrix), dtype=np.int64)
+    for rule in rules:
+        severity = rule_severity(rule, values)
+        if severity is None:
+            continue
+        available = np.logical_and.reduce([present[source] for source in rule_sources(rule)])
+        if rule.get('standard') is not None:
+            available &= standards == rule['standard']
+        severity = np.where(available, severity, np.nan)
+        severities[rule['id']] = severity
+        score += rule.get('weight', 1.0) * np.nan_to_num(severity)
+        flags += np.nan_to_num(severity) > 0
+
+    result = pd.DataFrame(severities, index=matrix.index)
+    result.insert(0, 'so_canh_bao', flags)
+    result.insert(0, 'diem_rui_ro', np.round(score, 4))
+    result = result.sort_values(['diem_rui_ro', 'so_canh_bao'], ascending=False, kind='mergesort')
+    result.insert(0, 'hang', np.arange(1, len(result) + 1))
+    return result
+
+
+# --- SO SÁNH TỶ SỐ TÀI CHÍNH VỚI NHÓM NGƯỜI NỘP THUẾ TƯƠNG ĐỒNG ---
+# Tỷ số = tổng chỉ tiêu tử / tổng chỉ tiêu mẫu (mẫu <= 0 -> không tính); 'tail': phía phân phối có rủi ro
+PEER_RATIOS = {
+    'bien_lai_gop': {'label': "Biên lợi nhuận gộp", 'num': ('bctc:kqkd_nn_ct20',), 'den': ('bctc:kqkd_nn_ct10',),
+                     'tail': 'low'},
+    'chi_phi_doanh_thu': {'label': "Giá vốn / Doanh thu (PS TK 632 / PS Có TK 511)", 'num': ('bctc:ps_no_ct632',),
+                          'den': ('bctc:ps_co_ct511',), 'tail': 'high'},
+    'ton_kho_doanh_thu': {'label': "Hàng tồn kho / Doanh thu thuần", 'num': ('bctc:scn_ct140',),
+                          'den': ('bctc:kqkd_nn_ct10',), 'tail': 'high'},
+    'lai_vay_tien': {'label': "Chi phí lãi vay / Tiền", 'num': ('bctc:kqkd_nn_ct23',), 'den': ('bctc:scn_ct110',),
+                     'tail': 'high'},
+}
+# Nhóm mặc định theo quy mô doanh thu thuần (đồng): cận trên của từng nhóm
+PEER_SIZE_BANDS = [(3e9, "Siêu nhỏ (DT ≤ 3 tỷ)"), (50e9, "Nhỏ (DT ≤ 50 tỷ)"), (300e9, "Vừa (DT ≤ 300 tỷ)"),
+                   (np.inf, "Lớn (DT > 300 tỷ)")]
+PEER_REVENUE_INDICATOR = 'bctc:kqkd_nn_ct10'
+PEER_ALL = "Toàn danh mục"
+PEER_MIN_GROUP = 10  # nhóm ít hơn số này so với toàn danh mục
+PEER_TAIL = 0.05
+PEER_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+PEER_CACHE_SIZE = 8
+
+
+def peer_ratio_indicators():
+    names = [PEER_REVENUE_INDICATOR]
+    for spec in PEER_RATIOS.values():
+        names.extend(name for name in spec['num'] + spec['den'] if name not in names)
+    return names
+
+
+def compute_peer_ratios(matrix):
+    # Bảng người nộp thuế x tỷ số từ ma trận chỉ tiêu (build_indicator_matrix), tính theo cột
+    columns = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name, spec in PEER_RATIOS.items():
+            num = np.sum([matrix[key].to_numpy(dtype=np.float64) for key in spec['num']], axis=0)
+            den = np.sum([matrix[key].to_numpy(dtype=np.float64) for key in spec['den']], axis=0)
+            columns[name] = np.where(den > 0, num / den, np.nan)
+    return pd.DataFrame(columns, index=matrix.index)
+
+
+def peer_size_groups(matrix):
+    revenue = matrix[PEER_REVENUE_INDICATOR].to_numpy(dtype=np.float64)
+    bounds = np.array([bound for bound, _ in PEER_SIZE_BANDS])
+    labels = np.array([label for _, label in PEER_SIZE_BANDS] + [PEER_ALL], dtype=object)
+    positions = np.where(np.isnan(revenue), len(PEER_SIZE_BANDS), np.searchsorted(bounds, revenue))
+    return pd.Series(labels[positions], index=matrix.index)
+
+
+class PeerBenchmark:
+    # Phân phối tỷ số của từng nhóm: mỗi (nhóm, tỷ số) giữ mảng giá trị đã sắp xếp và bảng phân vị tính một lần
+    # bằng NumPy; xếp hạng người nộp thuế mới (hoặc cả danh mục) chỉ là searchsorted trên mảng đã sắp xếp.
+    def __init__(self, ratios, groups):
+        self.columns = list(ratios.columns)
+        values = ratios.to_numpy(dtype=np.float64)
+        groups = np.asarray(groups, dtype=object)
+        self.sorted = {}
+        self.sizes = {}
+        quantile_rows = []
+        for group in [PEER_ALL] + sorted(set(groups) - {PEER_ALL}):
+            block = values if group == PEER_ALL else values[groups == group]
+            self.sizes[group] = len(block)
+            counts = (~np.isnan(block)).sum(axis=0)
+            ordered = np.sort(block, axis=0)  # NaN xếp cuối
+            self.sorted[group] = [ordered[:counts[j], j] for j in range(len(self.columns))]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                table = np.nanquantile(block, PEER_QUANTILES, axis=0) if len(block) else np.full(
+                    (len(PEER_QUANTILES), len(self.columns)), np.nan)
+            for j, column in enumerate(self.columns):
+                quantile_rows.append([group, column, counts[j]] + list(table[:, j]))
+        self.quantiles = pd.DataFrame(quantile_rows, columns=['nhom', 'ty_so', 'so_dn'] + [
+            f"p{int(q * 100)}" for q in PEER_QUANTILES])
+
+    def peers(self, group):
+        # Nhóm đủ lớn để so sánh; nhóm ít người nộp thuế hơn PEER_MIN_GROUP so với toàn danh mục
+        return group if self.sizes.get(group, 0) >= PEER_MIN_GROUP else PEER_ALL
+
+    def percentiles(self, ratios, groups):
+        # Thứ hạng phần trăm (0..1, hạng giữa khi trùng giá trị) của từng người nộp thuế trong nhóm so sánh
+        values = ratios[self.columns].to_numpy(dtype=np.float64)
+        compare = np.array([self.peers(group) for group in np.asarray(groups, dtype=object)], dtype=object)
+        result = np.full(values.shape, np.nan)
+        for group in set(compare):
+            rows = compare == group
+            for j, peers in enumerate(self.sorted[group]):
+                if len(peers) < PEER_MIN_GROUP:
+                    continue
+                column = values[rows, j]
+                rank = (np.searchsorted(peers, column, 'left') + np.searchsorted(peers, column, 'right')) / 2
+                result[rows, j] = np.where(np.isnan(column), np.nan, rank / len(peers))
+        return pd.DataFrame(result, index=ratios.index, columns=self.columns), pd.Series(compare, index=ratios.index)
+
+    def rank(self, ratios, group=PEER_ALL):
+        # Xếp hạng một người nộp thuế mới: ratios là dict/Series tỷ số
+        frame = pd.DataFrame([pd.Series(ratios)], columns=self.columns)
+        return self.percentiles(frame, [group])[0].iloc[0]
+
+    def screen(self, ratios, groups):
+        # Tỷ số, thứ hạng phần trăm và cờ nằm ở đuôi rủi ro (PEER_TAIL) của nhóm so sánh
+        percentiles, compare = self.percentiles(ratios, groups)
+        result = pd.DataFrame({'nhom': compare})
+        flags = np.zeros(len(ratios), dtype=np.int64)
+        for name in self.columns:
+            rank = percentiles[name].to_numpy()
+            tail = PEER_RATIOS.get(name, {}).get('tail', 'both')
+            with np.errstate(invalid='ignore'):
+                low, high = rank <= PEER_TAIL, rank >= 1 - PEER_TAIL
+            flagged = low if tail == 'low' else high if tail == 'high' else low | high
+            result[name] = ratios[name].to_numpy()
+            result[f"{name}_phan_vi"] = rank
+            result[f"{name}_canh_bao"] = flagged
+            flags += flagged
+        result.insert(1, 'so_ty_so_bat_thuong', flags)
+        return result.sort_values('so_ty_so_bat_thuong', ascending=False, kind='mergesort')
+
+
+_peer_benchmarks = {}
+
+
+def get_peer_benchmark(ratios, groups):
+    # PeerBenchmark dùng lại theo nội dung (tỷ số + nhóm): dựng lại chỉ khi danh mục thay đổi
+    groups = np.asarray(groups, dtype=object)
+    digest = hashlib.sha256(np.ascontiguousarray(ratios.to_numpy(dtype=np.float64)).tobytes())
+    digest.update("\x1f".join(map(str, ratios.columns)).encode('utf-8'))
+    digest.update("\x1f".join(map(str, groups)).encode('utf-8'))
+    key = digest.hexdigest()
+    benchmark = _peer_benchmarks.get(key)
+    if benchmark is None:
+        if len(_peer_benchmarks) >= PEER_CACHE_SIZE:
+            _peer_benchmarks.pop(next(iter(_peer_benchmarks)))
+        benchmark = _peer_benchmarks[key] = PeerBenchmark(ratios, groups)
+    return benchmark
+
+
+def benchmark_peers(matrix, groups=None):
+    # So sánh nhóm cho cả danh mục: groups là Series MST -> nhóm (mặc định theo quy mô doanh thu)
+    ratios = compute_peer_ratios(matrix)
+    groups = peer_size_groups(matrix) if groups is None else groups.reindex(matrix.index).fillna(PEER_ALL)
+    benchmark = get_peer_benchmark(ratios, groups.to_numpy())
+    return benchmark.screen(ratios, groups.to_numpy()), benchmark
+
+
+# --- CHỈ MỤC ĐỐI TÁC & ĐỒ THỊ HÓA ĐƠN GIỮA CÁC NGƯỜI NỘP THUẾ ---
+# Chênh lệch tối thiểu (VND, chưa thuế) giữa bên bán và bên mua trong một tháng để báo luồng không khớp
+COUNTERPARTY_MIN_GAP = 1_000_000
+COUNTERPARTY_FLOW_COLUMNS = ['MSTNguoiBan', 'MSTNguoiMua', 'Thang', 'Nguon', 'ChuaThue', 'Thue', 'SoDong']
+
+
+def _normalize_mst(values):
+    # Chuẩn hóa MST trên các giá trị khác nhau (factorize) thay vì từng dòng; ô trống -> ''
+    codes, uniques = pd.factorize(values)
+    names = pd.Series(uniques, dtype=object).astype(str).str.replace(r'\s+', '', regex=True).str.upper()
+    names = names.where(~names.isin(('', 'NAN', 'NONE', '<NA>')), '').to_numpy(dtype=object)
+    return np.append(names, '')[codes]  # mã -1 (ô trống) trỏ vào phần tử '' cuối
+
+
+def counterparty_flows(mst, output_invoice_data=None, input_invoice_data=None):
+    # Luồng hóa đơn của một người nộp thuế cộng theo (người bán, người mua, tháng lập): hóa đơn bán ra do
+    # người bán kê ('ban_ra'), hóa đơn mua vào do người mua kê ('mua_vao'). Kết quả nhỏ, gửi được về tiến trình chính.
+    parts = []
+    for source, invoice_data, statuses, counterparty_col in (
+            ('ban_ra', output_invoice_data, VALID_INVOICE_STATUSES, 'MSTNguoiMua'),
+            ('mua_vao', input_invoice_data, None, 'MSTNguoiBan')):
+        if not invoice_data:
+            continue
+        # Cộng theo (đối tác, tháng) trên từng phần của bảng kê rồi gộp các phần
+        totals = []
+        for amounts in invoice_amount_batches(invoice_data, statuses, (counterparty_col,)):
+            if counterparty_col not in amounts.columns:
+                break
+            counterparty = _normalize_mst(amounts[counterparty_col])
+            keep = counterparty != ''
+            amounts = pd.DataFrame({'DoiTac': counterparty[keep], 'Thang': amounts['Thang'].to_numpy()[keep],
+                                    'ChuaThue': amounts['ChuaThue'].to_numpy()[keep],
+                                    'Thue': amounts['Thue'].to_numpy()[keep], 'SoDong': 1})
+            totals.append(amounts.groupby(['DoiTac', 'Thang'], sort=False).sum())
+        if not totals:
+            continue
+        part = (pd.concat(totals).groupby(level=['DoiTac', 'Thang'], sort=False).sum() if len(totals) > 1
+                else totals[0]).reset_index()
+        own = str(mst).strip().upper()
+        part['MSTNguoiBan'], part['MSTNguoiMua'] = (own, part['DoiTac']) if source == 'ban_ra' else (part['DoiTac'], own)
+        part['Nguon'] = source
+        parts.append(part[COUNTERPARTY_FLOW_COLUMNS])
+    if not parts:
+        return pd.DataFrame(columns=COUNTERPARTY_FLOW_COLUMNS)
+    return pd.concat(parts, ignore_index=True)
+
+
+def _peel_acyclic(n, src, dst):
+    # Loại dần các đỉnh không có cạnh vào hoặc cạnh ra (không thể nằm trên chu trình), vector hóa bằng bincount
+    alive = np.ones(n, dtype=bool)
+    while True:
+        edges = alive[src] & alive[dst]
+        keep = alive & (np.bincount(src[edges], minlength=n) > 0) & (np.bincount(dst[edges], minlength=n) > 0)
+        if keep.sum() == alive.sum():
+            return alive
+        alive = keep
+
+
+def _strong_components(indptr, indices):
+    # Tarjan không đệ quy trên đồ thị CSR; trả về mã thành phần liên thông mạnh của từng đỉnh
+    indptr, indices = indptr.tolist(), indices.tolist()
+    n = len(indptr) - 1
+    order, low, component = [-1] * n, [0] * n, [-1] * n
+    on_stack = [False] * n
+    stack, counter, count = [], 0, 0
+    for root in range(n):
+        if order[root] >= 0:
+            continue
+        order[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [[root, indptr[root]]]
+        while work:
+            frame = work[-1]
+            v, i = frame
+            if i < indptr[v + 1]:
+                frame[1] = i + 1
+                w = indices[i]
+                if order[w] < 0:
+                    order[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append([w, indptr[w]])
+                elif on_stack[w] and order[w] < low[v]:
+                    low[v] = order[w]
+                continue
+            work.pop()
+            if work and low[v] < low[work[-1][0]]:
+                low[work[-1][0]] = low[v]
+            if low[v] == order[v]:
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    component[w] = count
+                    if w == v:
+                        break
+                count += 1
+    return np.asarray(component, dtype=np.int64)
+
+
+class CounterpartyIndex:
+    # Chỉ mục luồng hóa đơn giữa các người nộp thuế đã nạp. MST được mã hóa thành số nguyên; mỗi cặp
+    # (người bán -> người mua) là một cạnh, lưu dạng CSR (indptr/indices/weights) sắp theo người bán.
+    # flows: bảng của counterparty_flows (một hoặc nhiều hồ sơ nối lại).
+    # sellers/buyers: MST đã nạp bảng kê bán ra/mua vào; mặc định lấy theo các dòng trong flows.
+    def __init__(self, flows, sellers=None, buyers=None):
+        flows = flows if len(flows) else pd.DataFrame(columns=COUNTERPARTY_FLOW_COLUMNS)
+        if sellers is None:
+            sellers = flows.loc[flows['Nguon'] == 'ban_ra', 'MSTNguoiBan'].unique()
+        if buyers is None:
+            buyers = flows.loc[flows['Nguon'] == 'mua_vao', 'MSTNguoiMua'].unique()
+        self.sellers = {str(mst).strip().upper() for mst in sellers}
+        self.buyers = {str(mst).strip().upper() for mst in buyers}
+
+        codes, self.msts = pd.factorize(pd.concat([flows['MSTNguoiBan'], flows['MSTNguoiMua']], ignore_index=True))
+        self.msts = np.asarray(self.msts, dtype=object)
+        n_flows = len(flows)
+        table = pd.DataFrame({'ban': codes[:n_flows], 'mua': codes[n_flows:],
+                              'Thang': flows['Thang'].to_numpy(dtype=np.int64),
+                              'ban_ra': np.where(flows['Nguon'] == 'ban_ra', flows['ChuaThue'], 0.0),
+                              'mua_vao': np.where(flows['Nguon'] == 'mua_vao', flows['ChuaThue'], 0.0),
+                              'SoDong': flows['SoDong'].to_numpy(dtype=np.int64)})
+        # Mỗi (người bán, người mua, tháng) một dòng: số bên bán kê và số bên mua kê nằm cạnh nhau
+        self.periods = table.groupby(['ban', 'mua', 'Thang'], sort=True).sum().reset_index()
+
+        pairs = self.periods.groupby(['ban', 'mua'], sort=True)[['ban_ra', 'mua_vao']].sum().reset_index()
+        pairs = pairs[pairs['ban'] != pairs['mua']]
+        self.src = pairs['ban'].to_numpy(dtype=np.int64)
+        self.indices = pairs['mua'].to_numpy(dtype=np.int64)
+        # Giá trị cạnh: số lớn hơn giữa hai bên kê khai (hóa đơn chỉ một bên kê vẫn là một luồng tiền)
+        self.weights = np.maximum(pairs['ban_ra'].to_numpy(), pairs['mua_vao'].to_numpy())
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(self.src, minlength=len(self.msts)))))
+
+    def __len__(self):
+        return len(self.msts)
+
+    def neighbors(self, mst):
+        # Các người mua của một người bán kèm giá trị luồng
+        position = np.flatnonzero(self.msts == mst)
+        if not len(position):
+            return pd.Series(dtype=np.float64)
+        start, end = self.indptr[position[0]], self.indptr[position[0] + 1]
+        return pd.Series(self.weights[start:end], index=self.msts[self.indices[start:end]])
+
+    def cycles(self, min_amount=0):
+        # Nhóm người nộp thuế mua bán vòng tròn: thành phần liên thông mạnh (>= 2 MST) trên các cạnh >= min_amount,
+        # kèm một vòng mẫu. Đỉnh không có cạnh vào/ra được loại trước bằng NumPy nên Tarjan chỉ chạy trên phần lõi.
+        columns = ['VongMau', 'SoNguoiNopThue', 'SoCanh', 'TongTienTrongNhom', 'ThanhVien']
+        edges = self.weights >= min_amount
+        src, dst, weights = self.src[edges], self.indices[edges], self.weights[edges]
+        n = len(self.msts)
+        if not len(src):
+            return pd.DataFrame(columns=columns)
+        alive = _peel_acyclic(n, src, dst)
+        core = alive[src] & alive[dst]
+        src, dst, weights = src[core], dst[core], weights[core]
+        if not len(src):
+            return pd.DataFrame(columns=columns)
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=n))))
+        component = _strong_components(indptr, dst)
+
+        internal = component[src] == component[dst]
+        sizes = np.bincount(component, minlength=component.max() + 1)
+        rows = []
+        for comp in np.flatnonzero(sizes >= 2):
+            members = np.flatnonzero(component == comp)
+            inside = internal & (component[src] == comp)
+            rows.append({'VongMau': " -> ".join(self.msts[self._sample_cycle(members[0], src[inside], dst[inside])]),
+                         'SoNguoiNopThue': len(members), 'SoCanh': int(inside.sum()),
+                         'TongTienTrongNhom': weights[inside].sum(),
+                         'ThanhVien': ", ".join(sorted(self.msts[members]))})
+        if not rows:
+            return pd.DataFrame(columns=columns)
+        return pd.DataFrame(rows, columns=columns).sort_values('TongTienTrongNhom', ascending=False,
+                                                               ignore_index=True)
+
+    @staticmethod
+    def _sample_cycle(start, src, dst):
+        # Vòng ngắn nhất qua `start` trong một thành phần liên thông mạnh (BFS theo cạnh của thành phần)
+        order = np.argsort(src, kind='stable')
+        src, dst = src[order], dst[order]
+        parent = {start: None}
+        frontier = [start]
+        while frontier:
+            next_frontier = []
+            for v in frontier:
+                lo, hi = np.searchsorted(src, v), np.searchsorted(src, v, side='right')
+                for w in dst[lo:hi].tolist():
+                    if w == start:
+                        path = [v]
+                        while parent[path[-1]] is not None:
+                            path.append(parent[path[-1]])
+                        return path[::-1] + [start]
+                    if w not in parent:
+                        parent[w] = v
+                        next_frontier.append(w)
+            frontier = next_frontier
+        return [start]
+
+    def unmatched(self, min_gap=COUNTERPARTY_MIN_GAP):
+        # Luồng (người bán, người mua, tháng) mà hai bên kê khai lệch nhau quá min_gap; chỉ xét khi bên còn lại
+        # cũng đã được nạp bảng kê tương ứng (nếu không thì chưa có gì để so).
+        periods = self.periods
+        sellers = pd.Index(self.msts).isin(self.sellers)
+        buyers = pd.Index(self.msts).isin(self.buyers)
+        gap = periods['mua_vao'].to_numpy() - periods['ban_ra'].to_numpy()
+        bought = (gap > min_gap) & sellers[periods['ban'].to_numpy()]
+        sold = (-gap > min_gap) & buyers[periods['mua'].to_numpy()]
+        flagged = periods[bought | sold]
+        result = pd.DataFrame({
+            'MSTNguoiBan': self.msts[flagged['ban'].to_numpy()],
+            'MSTNguoiMua': self.msts[flagged['mua'].to_numpy()],
+            'Ky': [_month_label(code) for code in flagged['Thang']],
+            'BenBanKe': flagged['ban_ra'].to_numpy(),
+            'BenMuaKe': flagged['mua_vao'].to_numpy(),
+            'ChenhLech': gap[bought | sold],
+            'CanhBao': np.where(bought[bought | sold], "Mua vào không có doanh thu bán ra tương ứng",
+                                "Bán ra không được bên mua kê khai"),
+        })
+        return result.reindex(result['ChenhLech'].abs().sort_values(ascending=False).index).reset_index(drop=True)
 
 
 async def get_gemini_analysis(api_key, dfs_dict, risks_df, notes_content=None):
@@ -1626,6 +4270,12 @@ def display_summary_and_risks():
         st.dataframe(
             income_statement_df.style.format({'Năm nay': vietnamese_formatter, 'Năm trước': vietnamese_formatter}))
 
+    trial_balance_check_df = st.session_state.get('trial_balance_check_df', pd.DataFrame())
+    if not trial_balance_check_df.empty:
+        st.subheader("📊 Kiểm tra Bảng Cân đối Tài khoản")
+        st.dataframe(trial_balance_check_df.style.format(formatter=vietnamese_formatter,
+                                                         subset=['Vế trái', 'Vế phải', 'Chênh lệch']))
+
     if not tncn_kk_summary_df.empty:
         st.subheader("📊 Bảng tổng hợp Tờ khai Khấu trừ TNCN (05/KK)")
         st.dataframe(tncn_kk_summary_df.style.format(formatter=vietnamese_formatter,
@@ -1649,6 +4299,16 @@ def display_summary_and_risks():
                 "Các dòng dưới đây có (Thành tiền) khác với (Số lượng * Đơn giá). Vui lòng kiểm tra lại file gốc.")
             st.dataframe(output_invoice_data['mismatch_df'].style.format(formatter=vietnamese_formatter))
 
+        if 'tax_rate_df' in output_invoice_data:
+            st.subheader("📊 Hóa đơn Bán ra theo Thuế suất")
+            st.dataframe(output_invoice_data['tax_rate_df'].style.format(
+                formatter=vietnamese_formatter, subset=['TienChuaThue', 'TienThue']))
+        if 'price_outliers_df' in output_invoice_data and not output_invoice_data['price_outliers_df'].empty:
+            st.subheader("⚠️ Cảnh báo: Đơn giá bất thường trên Bảng kê chi tiết")
+            st.warning("Các dòng dưới đây có đơn giá lệch xa đơn giá thường gặp của cùng mặt hàng/đơn vị tính.")
+            st.dataframe(output_invoice_data['price_outliers_df'].style.format(
+                formatter=vietnamese_formatter, subset=['DonGiaVND', 'DonGiaTrungViNhom', 'TyLeSoVoiTrungVi']))
+
     if input_invoice_data:
         st.subheader("📊 Bảng tổng hợp từ Hóa đơn Mua vào")
         summary_invoice_df = pd.DataFrame.from_dict(input_invoice_data['valid_summary'], orient='index',
@@ -1657,6 +4317,19 @@ def display_summary_and_risks():
                                     'Tổng tiền thanh toán']
         st.dataframe(summary_invoice_df.style.format(vietnamese_formatter))
 
+    gtgt_reconciliation_df = st.session_state.get('gtgt_reconciliation_df', pd.DataFrame())
+    if not gtgt_reconciliation_df.empty:
+        st.subheader("📊 Đối chiếu Bảng kê hóa đơn với Tờ khai 01/GTGT theo kỳ")
+        numeric_cols = list(gtgt_reconciliation_df.columns[2:-1])
+        st.dataframe(gtgt_reconciliation_df.style.format(formatter=vietnamese_formatter, subset=numeric_cols, na_rep=""))
+
+    period_chain_df = st.session_state.get('period_chain_df', pd.DataFrame())
+    if not period_chain_df.empty:
+        st.subheader("📊 Chuỗi kỳ kê khai (thiếu/trùng kỳ, số chuyển kỳ 01/GTGT)")
+        numeric_cols = [c for c in ('Chuyển sang kỳ sau (kỳ trước)', 'Nhận từ kỳ trước', 'Chênh lệch')
+                        if c in period_chain_df.columns]
+        st.dataframe(period_chain_df.style.format(formatter=vietnamese_formatter, subset=numeric_cols, na_rep=""))
+
     st.subheader("🚨 Bảng Đối chiếu & Rà soát Rủi ro")
     df_checks = pd.DataFrame(all_checks)
 
@@ -1677,35 +4350,7 @@ def display_summary_and_risks():
 
     col1, col2 = st.columns(2)
     with col1:
-        dfs_to_export = {
-            "TongHop_GTGT": st.session_state.get('gtgt_summary_df', pd.DataFrame()),
-            "ChiTiet_01_GTGT": st.session_state.get('gtgt_detailed_df', pd.DataFrame()),
-            "TongHop_TNDN": st.session_state.get('tndn_summary_df', pd.DataFrame()),
-            "ChiTiet_03_TNDN": st.session_state.get('tndn_main_df', pd.DataFrame()),
-            "ChiTiet_PL_03_1A": st.session_state.get('tndn_appendix_df', pd.DataFrame()),
-            "BCTHTC_CDKT": st.session_state.get('balance_sheet_df', pd.DataFrame()),
-            "BCKQKD": st.session_state.get('income_statement_df', pd.DataFrame()),
-            "PL_CDTK": st.session_state.get('trial_balance_df', pd.DataFrame()),
-            "TongHop_TNCN_KK": st.session_state.get('tncn_kk_summary_df', pd.DataFrame()),
-            "TongHop_TNCN_QTT": st.session_state.get('tncn_qtt_summary_df', pd.DataFrame()),
-            "ChiTiet_TNCN_QTT": st.session_state.get('tncn_details_df', pd.DataFrame()),
-            "KetQuaDoiChieu": pd.DataFrame(st.session_state.get('all_checks', []))
-        }
-
-        if output_invoice_data:
-            summary_invoice_df = pd.DataFrame.from_dict(output_invoice_data['valid_summary'], orient='index',
-                                                        columns=['Số tiền (VND)'])
-            summary_invoice_df.index = ['Tổng tiền chưa thuế', 'Tổng tiền thuế', 'Tổng tiền chiết khấu',
-                                        'Tổng tiền thanh toán']
-            dfs_to_export["TongHop_HD_DauRa"] = summary_invoice_df
-            if 'full_df' in output_invoice_data:
-                dfs_to_export["BK_HD_DauRa"] = output_invoice_data['full_df']
-            if 'mismatch_df' in output_invoice_data:
-                dfs_to_export["HD_DauRa_SaiLech"] = output_invoice_data['mismatch_df']
-
-        if input_invoice_data:
-            if 'full_df' in input_invoice_data:
-                dfs_to_export["BK_HD_DauVao"] = input_invoice_data['full_df']
+        dfs_to_export = build_export_frames(st.session_state, output_invoice_data, input_invoice_data)
 
         excel_data = convert_df_to_excel(dfs_to_export)
         st.download_button(label="📥 Kết xuất ra Excel", data=excel_data, file_name="Bao_cao_chi_tiet.xlsx",
@@ -1772,6 +4417,59 @@ def display_invoice_details():
         st.dataframe(styled_df)
 
 
+def build_export_frames(results, output_invoice_data=None, input_invoice_data=None):
+    # Các bảng kết xuất theo tên sheet; `results` là st.session_state hoặc kết quả của run_analysis_pipeline
+    dfs_to_export = {
+        "TongHop_GTGT": results.get('gtgt_summary_df', pd.DataFrame()),
+        "ChiTiet_01_GTGT": results.get('gtgt_detailed_df', pd.DataFrame()),
+        "TongHop_TNDN": results.get('tndn_summary_df', pd.DataFrame()),
+        "ChiTiet_03_TNDN": results.get('tndn_main_df', pd.DataFrame()),
+        "ChiTiet_PL_03_1A": results.get('tndn_appendix_df', pd.DataFrame()),
+        "BCTHTC_CDKT": results.get('balance_sheet_df', pd.DataFrame()),
+        "BCKQKD": results.get('income_statement_df', pd.DataFrame()),
+        "PL_CDTK": results.get('trial_balance_df', pd.DataFrame()),
+        "PL_CDTK_KiemTra": results.get('trial_balance_check_df', pd.DataFrame()),
+        "TongHop_TNCN_KK": results.get('tncn_kk_summary_df', pd.DataFrame()),
+        "TongHop_TNCN_QTT": results.get('tncn_qtt_summary_df', pd.DataFrame()),
+        "ChiTiet_TNCN_QTT": results.get('tncn_details_df', pd.DataFrame()),
+        "DoiChieu_GTGT_TheoKy": results.get('gtgt_reconciliation_df', pd.DataFrame()),
+        "ChuoiKy_KeKhai": results.get('period_chain_df', pd.DataFrame()),
+        "KetQuaDoiChieu": pd.DataFrame(results.get('all_checks', []))
+    }
+
+    if output_invoice_data:
+        summary_invoice_df = pd.DataFrame.from_dict(output_invoice_data['valid_summary'], orient='index',
+                                                    columns=['Số tiền (VND)'])
+        summary_invoice_df.index = ['Tổng tiền chưa thuế', 'Tổng tiền thuế', 'Tổng tiền chiết khấu',
+                                    'Tổng tiền thanh toán']
+        dfs_to_export["TongHop_HD_DauRa"] = summary_invoice_df
+        if 'full_df' in output_invoice_data:
+            dfs_to_export["BK_HD_DauRa"] = output_invoice_data['full_df']
+        if 'mismatch_df' in output_invoice_data:
+            dfs_to_export["HD_DauRa_SaiLech"] = output_invoice_data['mismatch_df']
+        if 'chain_df' in output_invoice_data:
+            dfs_to_export["HD_DauRa_ChuoiHieuLuc"] = output_invoice_data['chain_df']
+            dfs_to_export["HD_DauRa_ChuoiCanKiemTra"] = output_invoice_data['chain_issues_df']
+        if 'anomaly_df' in output_invoice_data:
+            dfs_to_export["HD_DauRa_BatThuong"] = output_invoice_data['anomaly_df']
+        if 'invoice_rollup_df' in output_invoice_data:
+            dfs_to_export["HD_DauRa_TheoHoaDon"] = output_invoice_data['invoice_rollup_df']
+            dfs_to_export["HD_DauRa_TheoThueSuat"] = output_invoice_data['tax_rate_df']
+            dfs_to_export["HD_DauRa_DonGia"] = output_invoice_data['price_stats_df']
+            dfs_to_export["HD_DauRa_DonGiaBatThuong"] = output_invoice_data['price_outliers_df']
+        if 'aggregates_df' in output_invoice_data:
+            dfs_to_export["HD_DauRa_TheoKy"] = output_invoice_data['aggregates_df']
+
+    if input_invoice_data:
+        if 'full_df' in input_invoice_data:
+            dfs_to_export["BK_HD_DauVao"] = input_invoice_data['full_df']
+        if 'file_stats' in input_invoice_data:
+            dfs_to_export["BK_HD_DauVao_TheoTep"] = input_invoice_data['file_stats']
+        if 'anomaly_df' in input_invoice_data:
+            dfs_to_export["HD_DauVao_BatThuong"] = input_invoice_data['anomaly_df']
+    return dfs_to_export
+
+
 def convert_df_to_excel(dfs_dict):
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -1848,9 +4546,9 @@ def main():
     params = setup_ui()
 
     if params["start_button"]:
-        for key in list(st.session_state.keys()):
-            if key not in ['analysis_complete']:
-                del st.session_state[key]
+        # Không xóa session_state: các bước có đầu vào không đổi được dùng lại từ lần chạy trước
+        stages = st.session_state.setdefault('pipeline_stages', StageCache())
+        st.session_state.pop('gemini_commentary', None)
 
         progress_bar = st.sidebar.progress(0)
         status_text = st.sidebar.empty()
@@ -1862,33 +4560,43 @@ def main():
             if params.get("uploaded_files"):
                 temp_dir = os.path.join(os.getcwd(), "manual_uploads")
                 if not os.path.exists(temp_dir): os.makedirs(temp_dir)
+                saved_uploads = st.session_state.setdefault('saved_uploads', {})
                 for uploaded_file in params["uploaded_files"]:
                     file_path = os.path.join(temp_dir, uploaded_file.name)
-                    with open(file_path, "wb") as f: f.write(uploaded_file.getbuffer())
+                    digest = file_digest(uploaded_file)
+                    if saved_uploads.get(file_path) != digest or not os.path.exists(file_path):
+                        with open(file_path, "wb") as f: f.write(uploaded_file.getbuffer())
+                        saved_uploads[file_path] = digest
                     files_to_analyze.append(file_path)
         progress_bar.progress(50)
 
         status_text.text("Bước 2/5: Xử lý bảng kê hóa đơn...")
         output_invoice_data = None
         if params.get("output_invoice_file"):
-            if params["output_invoice_type"] == "Chi tiết":
-                output_invoice_data = process_detailed_invoice_data(params["output_invoice_file"])
-            else:
-                output_invoice_data = process_summary_invoice_data(params["output_invoice_file"])
+            output_file, output_type = params["output_invoice_file"], params["output_invoice_type"]
+            processor = process_detailed_invoice_data if output_type == "Chi tiết" else process_summary_invoice_data
+            output_invoice_data, _ = stages.run('output_invoice', (files_fingerprint(output_file), output_type),
+                                                lambda: processor(output_file))
 
         input_invoice_data = None
         if params.get("input_invoice_files"):
-            input_invoice_data = process_input_invoice_data(params["input_invoice_files"])
+            input_files = params["input_invoice_files"]
+            input_fingerprint = files_fingerprint(input_files)
+            input_invoice_data, _ = stages.run('input_invoice', input_fingerprint, lambda: process_input_invoice_data(
+                input_files, digests=[digest for _, digest in input_fingerprint]))
 
         progress_bar.progress(60)
 
         status_text.text("Bước 3/5: Xử lý Thuyết minh BCTC...")
-        notes_content = process_financial_notes(params.get("financial_notes_file"))
+        notes_file = params.get("financial_notes_file")
+        notes_content, _ = stages.run('notes', files_fingerprint(notes_file),
+                                      lambda: process_financial_notes(notes_file))
         progress_bar.progress(70)
 
         status_text.text("Bước 4/5: Phân tích dữ liệu...")
         all_declarations, all_checks, gtgt_summary_df, gtgt_detailed_df, balance_sheet_df, income_statement_df, trial_balance_df, tndn_summary_df, tncn_qtt_summary_df, tncn_details_df, tncn_kk_summary_df = parse_and_analyze(
-            files_to_analyze, params["accounting_standard"], output_invoice_data, input_invoice_data, notes_content)
+            files_to_analyze, params["accounting_standard"], output_invoice_data, input_invoice_data, notes_content,
+            parse_workers=params.get("parse_workers") or None, stages=stages)
         progress_bar.progress(90)
 
         st.session_state['analysis_complete'] = True
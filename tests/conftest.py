@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+import warnings
+
+# Bộ đệm/tệp tạm của ứng dụng đặt trong thư mục riêng của lượt kiểm thử (đọc khi nạp streamlit_app)
+os.environ.setdefault('HSKT_CACHE_DIR', tempfile.mkdtemp(prefix='hskt_test_'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+warnings.filterwarnings('ignore', category=FutureWarning)
@@ -0,0 +1,51 @@
+import pandas as pd
+
+import streamlit_app as app
+
+GTGT_XML = ('<?xml version="1.0" encoding="UTF-8"?><HSoThueDTu xmlns="http://kekhaithue.gdt.gov.vn/TKhaiThue">'
+            '<HSoKhaiThue><TTinChung><TTinTKhaiThue><TKhaiThue><maTKhai>842</maTKhai><kyKKhai>{ky}</kyKKhai>'
+            '<loaiTKhai>C</loaiTKhai><soLan>0</soLan></TKhaiThue><NNT><mst>{mst}</mst></NNT></TTinTKhaiThue>'
+            '</TTinChung><CTieuTKhaiChinh><ct23>{ct23}</ct23><ct24>{ct24}</ct24><ct34>{ct34}</ct34>'
+            '</CTieuTKhaiChinh></HSoKhaiThue></HSoThueDTu>')
+
+
+def quiet(*args, **kwargs):
+    pass
+
+
+def _declaration(tmp_path, mst, ky, ct23=0, ct24=0, ct34=0):
+    path = tmp_path / f"{mst}_{ky.replace('/', '_')}.xml"
+    path.write_text(GTGT_XML.format(mst=mst, ky=ky, ct23=ct23, ct24=ct24, ct34=ct34), encoding='utf-8')
+    return str(path)
+
+
+def _summary_invoices(dates, amounts):
+    df = pd.DataFrame({'NgayLap': pd.to_datetime(dates, dayfirst=True), 'TrangThaiHoaDon': 'Hóa đơn mới',
+                       'TongTienChuaThue': amounts, 'TongTienThue': [a * 0.1 for a in amounts]})
+    return {'full_df': df, 'valid_summary': {'total_pre_tax': float(sum(amounts))}}
+
+
+def test_reconciliation_with_two_msts_in_the_same_period(tmp_path):
+    files = [_declaration(tmp_path, '0101234567', '01/2024', ct34=100),
+             _declaration(tmp_path, '0200000001', '01/2024', ct34=300)]
+    registry = app._parse_declarations(files, 1)['declarations']
+    result = app.generate_gtgt_reconciliation_df(registry, _summary_invoices(['15/01/2024'], [100.0]))
+    assert list(result[['MST', 'Kỳ']].itertuples(index=False, name=None)) == [
+        ('0101234567', '01/2024'), ('0200000001', '01/2024')]
+    assert list(result['Trạng thái']) == ["Khớp", "Cảnh báo"]
+
+
+def test_reconciliation_stage_follows_invoice_file_not_totals(tmp_path):
+    files = [_declaration(tmp_path, '0101234567', '01/2024', ct34=100),
+             _declaration(tmp_path, '0101234567', '02/2024')]
+    stages = app.StageCache()
+
+    def run(digest, invoices):
+        output, _ = stages.run('output_invoice', (('ban_ra.csv', digest), "Tổng hợp"), lambda: invoices)
+        return app.run_analysis_pipeline(files, "Chưa chọn", output, None, None, parse_workers=1, log=quiet,
+                                         stages=stages)['gtgt_reconciliation_df']
+
+    before = run('a', _summary_invoices(['15/01/2024'], [100.0]))
+    after = run('b', _summary_invoices(['15/02/2024'], [100.0]))
+    assert list(before['Trạng thái']) == ["Khớp", "Khớp"]
+    assert list(after['Trạng thái']) == ["Cảnh báo", "Cảnh báo"]
@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import streamlit_app as app
+
+
+@pytest.mark.parametrize('dtype', [object, 'string'])
+def test_convert_to_vnd_blank_currency_is_foreign(dtype):
+    df = pd.DataFrame({'DonViTienTe': pd.Series(['VND', 'USD', None], dtype=dtype), 'TyGia': [1, 25000, 2],
+                       'TongTienChuaThue': [100.0, 2.0, 3.0]})
+    out = app.convert_to_vnd(df, ['TongTienChuaThue'])
+    np.testing.assert_array_equal(out['TongTienChuaThue'].to_numpy(), [100.0, 50000.0, 6.0])
+
+
+def test_convert_to_vnd_without_currency_columns_is_vnd():
+    df = pd.DataFrame({'TongTienChuaThue': [1.0, 2.0]})
+    assert app.convert_to_vnd(df, ['TongTienChuaThue']) is df
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import streamlit_app as app
+
+DETAILED_HEADER = ['Ký hiệu', 'Số hóa đơn', 'Ngày lập', 'Tên người mua', 'MST người mua', 'Tính chất',
+                   'Tên hàng hóa, dịch vụ', 'Đơn vị tính', 'Số lượng', 'Đơn giá', 'Tiền chiết khấu', '', 'Thành tiền',
+                   'Thuế suất', 'Đơn vị tiền tệ', 'Tỷ giá', 'Trạng thái hóa đơn', 'Hóa đơn liên quan',
+                   'Ngày hóa đơn liên quan', 'Đơn vị cung cấp']
+
+
+def quiet(*args, **kwargs):
+    pass
+
+
+def _detailed_csv(tmp_path, rows=200):
+    rng = np.random.default_rng(7)
+    quantity = rng.integers(1, 100, rows)
+    price = rng.integers(1000, 100000, rows)
+    price[::40] *= 30
+    df = pd.DataFrame({
+        'a': 'C24TAA', 'b': rng.integers(1, rows // 3, rows), 'c': '15/03/2024', 'd': 'KH',
+        'e': rng.choice(['0200000001', '0200000002'], rows), 'f': 'Hàng hóa',
+        'g': rng.choice(['Xi măng', 'Thép', 'Cát'], rows), 'h': 'Kg', 'q': quantity, 'p': price, 'k': 0, 'x': '',
+        't': quantity * price, 'r': rng.choice([0.1, 0.08, 0.05], rows), 'cur': 'VND', 'fx': 1,
+        'st': 'Hóa đơn mới', 'rel': '', 'reld': '', 'pv': 'VNPT'})
+    df.loc[[3, 77], 'cur'] = ''
+    df.columns = DETAILED_HEADER
+    path = tmp_path / 'ban_ra_chi_tiet.csv'
+    df.to_csv(path, index=False)
+    return str(path)
+
+
+def _assert_same(streamed, in_memory, keys):
+    for key in keys:
+        if isinstance(in_memory[key], pd.DataFrame):
+            pd.testing.assert_frame_equal(streamed[key].reset_index(drop=True),
+                                          in_memory[key].reset_index(drop=True), check_dtype=False)
+        else:
+            assert streamed[key] == pytest.approx(in_memory[key], nan_ok=True)
+
+
+def test_streamed_detailed_blank_currency_matches_in_memory(tmp_path):
+    path = _detailed_csv(tmp_path)
+    streamed = app.process_detailed_invoice_data(path, log=quiet, stream=True)
+    in_memory = app.process_detailed_invoice_data(path, log=quiet, stream=False)
+    assert streamed is not None and in_memory is not None
+    assert not in_memory['price_outliers_df'].empty
+    _assert_same(streamed, in_memory, ['valid_summary', 'invoice_rollup_df', 'tax_rate_df', 'price_stats_df',
+                                       'price_outliers_df', 'chain_summary', 'anomaly_summary'])
+
+
+SUMMARY_HEADER = ['STT', 'Ký hiệu mẫu số', 'Ký hiệu hóa đơn', 'Số hóa đơn', 'Ngày lập',
+                  'MST người bán/MST người xuất hàng', 'Tên người bán/Tên người xuất hàng',
+                  'MST người mua/MST người nhận hàng', 'Tên người mua/Tên người nhận hàng', 'Địa chỉ người mua',
+                  'Mã số thuế tổ chức cung cấp giải pháp', 'MST tổ chức truyền nhận', 'Tổng tiền chưa thuế',
+                  'Tổng tiền thuế', 'Tổng tiền chiết khấu thương mại', 'Tổng tiền phí', 'Tổng tiền thanh toán',
+                  'Đơn vị tiền tệ', 'Tỷ giá', 'Trạng thái hóa đơn', 'Kết quả kiểm tra hóa đơn']
+
+
+def _summary_csv(tmp_path, rows=200):
+    rng = np.random.default_rng(11)
+    pre_tax = rng.integers(1, 10 ** 8, rows).astype(float)
+    currency = rng.choice(['VND', 'USD'], rows, p=[0.9, 0.1]).astype(object)
+    currency[[5, 120]] = ''
+    df = pd.DataFrame({
+        'STT': np.arange(1, rows + 1), 'mau': 1, 'ky': 'C24TAA', 'so': np.arange(1, rows + 1),
+        'ngay': (pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 366, rows), unit='D')).strftime(
+            '%d/%m/%Y'),
+        'mst_ban': '0101234567', 'ten_ban': 'Cty ABC', 'mst_mua': rng.choice(['0200000001', '0300000003'], rows),
+        'ten_mua': 'KH', 'dia_chi': 'Địa chỉ', 'mst_gp': '0100000000', 'mst_tn': '0100000001', 'chua_thue': pre_tax,
+        'thue': pre_tax * 0.1, 'chiet_khau': 0, 'phi': 0, 'thanh_toan': pre_tax * 1.1, 'tien_te': currency,
+        'ty_gia': np.where(currency == 'USD', 25000, 1), 'trang_thai': 'Hóa đơn mới',
+        'kiem_tra': 'Đã cấp mã hóa đơn'})
+    df.columns = SUMMARY_HEADER
+    path = tmp_path / 'ban_ra_tong_hop.csv'
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write('DANH SÁCH HÓA ĐƠN\n\nTừ ngày 01/01/2024 đến ngày 31/12/2024\n\n\n')
+        df.to_csv(f, index=False)
+    return str(path)
+
+
+def test_streamed_summary_blank_currency_counterparty_flows(tmp_path):
+    path = _summary_csv(tmp_path)
+    streamed = app.process_summary_invoice_data(path, log=quiet, stream=True)
+    in_memory = app.process_summary_invoice_data(path, log=quiet, stream=False)
+    assert streamed is not None and in_memory is not None
+    _assert_same(streamed, in_memory, ['valid_summary', 'anomaly_summary'])
+    pd.testing.assert_frame_equal(app.counterparty_flows('0101234567', streamed),
+                                  app.counterparty_flows('0101234567', in_memory), check_dtype=False)
+
+
+def test_spill_batches_return_object_text_with_nan(tmp_path):
+    result = app.stream_invoice_csv(_detailed_csv(tmp_path), 'detailed', log=quiet)
+    batch = next(app.spill_batches(result['spill_path'], ['KyHieu', 'DonViTienTe', 'ThanhTien']))
+    assert batch['DonViTienTe'].dtype == object
+    assert batch['DonViTienTe'].isna().sum() == 2
+    assert not any(value is pd.NA for value in batch['DonViTienTe'])
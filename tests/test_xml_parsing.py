@@ -0,0 +1,51 @@
+import pytest
+
+import streamlit_app as app
+
+
+def _hostile_declaration(tmp_path):
+    secret = tmp_path / 'secret.txt'
+    secret.write_text('NOI-DUNG-BI-MAT', encoding='utf-8')
+    xml = (f'<?xml version="1.0" encoding="UTF-8"?>'
+           f'<!DOCTYPE HSoThueDTu [<!ENTITY x SYSTEM "{secret.as_uri()}">]>'
+           f'<HSoThueDTu><mst>0101234567</mst><ct21>&x;</ct21><ct22>100</ct22></HSoThueDTu>')
+    path = tmp_path / 'to_khai.xml'
+    path.write_text(xml, encoding='utf-8')
+    return str(path)
+
+
+@pytest.mark.skipif(app.lxml_etree is None, reason="cần lxml")
+def test_lxml_does_not_resolve_external_entities(tmp_path):
+    data = app._read_xml_file(_hostile_declaration(tmp_path), 'lxml')
+    assert 'NOI-DUNG-BI-MAT' not in ''.join(str(value) for value in data.values())
+    assert data['mst'] == '0101234567'
+    assert data['ct22'] == '100'
+
+
+def test_etree_rejects_external_entities(tmp_path):
+    with pytest.raises(app.XML_PARSE_ERRORS):
+        app._read_xml_file(_hostile_declaration(tmp_path), 'etree')
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1234.5', 1234.5),
+    ('1.234', 1.234),
+    ('0.125', 0.125),
+    ('1.234.567', 1234567.0),
+    ('1.234.567,89', 1234567.89),
+    ('1,234,567.89', 1234567.89),
+    ('1,234', 1234.0),
+    ('1,5', 1.5),
+    ('(1.234)', -1234.0),
+    ('(1.234.567)', -1234567.0),
+    ('(1,234)', -1234.0),
+    ('(1.5)', -1.5),
+    ('1\xa0234\xa0567', 1234567.0),
+])
+def test_parse_number_formats(value, expected):
+    assert app.parse_number(value) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('value', [None, '', '  ', 'abc', 'nan', 'inf', float('nan')])
+def test_parse_number_invalid_returns_default(value):
+    assert app.parse_number(value, 0.0) == 0.0